@@ -0,0 +1,220 @@
+# Admission control for upstream calls: global and per-model in-flight caps with a priority wait queue.
+import asyncio
+import heapq
+import itertools
+import statistics
+import time
+from collections import deque
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+
+class Overloaded(Exception):
+    def __init__(self, reason, detail, retry_after, status_code=503):
+        super().__init__(detail)
+        self.reason = reason
+        self.detail = detail
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+def parse_pairs(text):
+    """Parse "a=1,b=2" settings into a dict of strings."""
+    pairs = {}
+    for item in text.split(","):
+        name, sep, value = item.strip().rpartition("=")
+        if sep and name.strip():
+            pairs[name.strip()] = value.strip()
+    return pairs
+
+
+class _Waiter:
+    __slots__ = ("model", "priority", "future", "enqueued")
+
+    def __init__(self, model, priority, future, enqueued):
+        self.model = model
+        self.priority = priority
+        self.future = future
+        self.enqueued = enqueued
+
+
+class Ticket:
+    __slots__ = ("_controller", "model", "_admitted")
+
+    def __init__(self, controller, model, admitted):
+        self._controller = controller
+        self.model = model
+        self._admitted = admitted
+
+    def release(self):
+        if self._controller is not None:
+            self._controller._release(self.model, self._admitted)
+            self._controller = None
+
+
+class AdmissionController:
+    """Caps concurrent upstream calls per worker process, overall and per model.
+
+    Calls over a cap wait in a queue served in priority order ("high",
+    "normal", "low"), oldest first within a priority. A call is refused
+    straight away with Retry-After when
+    - the queue already holds `max_queue` calls (503),
+    - it is low priority and the queue is over `low_priority_share` full, so
+      bulk traffic is shed first and leaves room for the rest (429),
+    - the predicted queue wait exceeds its deadline (503).
+    The prediction is the number of queued calls at the same or a higher
+    priority times a moving average of how long a call holds its slot,
+    divided by the cap. Calls still queued when their deadline passes fail
+    with 503 as well. `max_in_flight=0` disables admission control.
+    """
+
+    def __init__(self, max_in_flight=100, per_model=0, model_limits=None, max_queue=256,
+                 low_priority_share=0.5, alpha=0.2, clock=time.monotonic):
+        self.max_in_flight = max_in_flight
+        self.per_model = per_model
+        self.model_limits = dict(model_limits or {})
+        self.max_queue = max_queue
+        self.low_priority_share = low_priority_share
+        self.alpha = alpha
+        self._clock = clock
+        self._in_flight = 0
+        self._model_in_flight = {}
+        # model -> heap of (priority, sequence, waiter)
+        self._queues = {}
+        self._sequence = itertools.count()
+        self._queued = 0
+        self._queued_by_priority = [0] * len(PRIORITIES)
+        self._model_queued = {}
+        # Moving averages of slot hold time in seconds, overall and per model
+        self._service = None
+        self._model_service = {}
+        self._waits = deque(maxlen=1024)
+        self.admitted = 0
+        self.queued_total = 0
+        self.rejected = {"queue_full": 0, "shed": 0, "deadline": 0, "expired": 0}
+
+    def model_cap(self, model):
+        return self.model_limits.get(model, self.per_model)
+
+    def _has_room(self, model):
+        cap = self.model_cap(model)
+        return self._in_flight < self.max_in_flight and (not cap or self._model_in_flight.get(model, 0) < cap)
+
+    def _take(self, model):
+        self._in_flight += 1
+        self._model_in_flight[model] = self._model_in_flight.get(model, 0) + 1
+        self.admitted += 1
+        return Ticket(self, model, self._clock())
+
+    def predicted_wait(self, model, priority):
+        """Seconds a new call at `priority` for `model` is expected to queue."""
+        rank = PRIORITIES[priority]
+        ahead = sum(self._queued_by_priority[:rank + 1])
+        wait = (ahead + 1) * (self._service or 0.0) / self.max_in_flight
+        cap = self.model_cap(model)
+        if cap:
+            model_ahead = sum(self._model_queued.get(model, [0])[:rank + 1])
+            wait = max(wait, (model_ahead + 1) * self._model_service.get(model, self._service or 0.0) / cap)
+        return wait
+
+    def _reject(self, reason, detail, retry_after, status_code=503):
+        self.rejected[reason] += 1
+        raise Overloaded(reason, detail, max(1, int(retry_after + 0.999)), status_code)
+
+    async def admit(self, model, priority="normal", timeout=None):
+        """Wait for an upstream slot and return a Ticket to release when the call ends.
+
+        `timeout` is how long the caller can still wait, in seconds.
+        """
+        if self.max_in_flight <= 0:
+            self.admitted += 1
+            return Ticket(None, model, 0.0)
+        # Slots are handed to waiters as soon as they free up, so room left now means nobody queued can use it
+        if self._has_room(model):
+            return self._take(model)
+        predicted = self.predicted_wait(model, priority)
+        if self._queued >= self.max_queue:
+            self._reject("queue_full", "Server is overloaded, try again later", predicted)
+        if priority == "low" and self._queued >= self.max_queue * self.low_priority_share:
+            self._reject("shed", "Server is busy; low priority requests are being shed", predicted, 429)
+        if timeout is not None and predicted > timeout:
+            self._reject("deadline", "Server is busy and cannot answer within the request deadline", predicted)
+        return await self._wait(model, priority, timeout, predicted)
+
+    async def _wait(self, model, priority, timeout, predicted):
+        rank = PRIORITIES[priority]
+        waiter = _Waiter(model, rank, asyncio.get_running_loop().create_future(), self._clock())
+        heapq.heappush(self._queues.setdefault(model, []), (rank, next(self._sequence), waiter))
+        self._queued += 1
+        self._queued_by_priority[rank] += 1
+        self._model_queued.setdefault(model, [0] * len(PRIORITIES))[rank] += 1
+        self.queued_total += 1
+        try:
+            return await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                return waiter.future.result()
+            self._reject("expired", "Timed out waiting for upstream capacity", predicted)
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                waiter.future.result().release()
+            raise
+        finally:
+            if not waiter.future.done() or waiter.future.cancelled():
+                # Gave up before a slot was handed over; the heap entry is skipped later
+                self._dequeue(waiter)
+
+    def _dequeue(self, waiter):
+        self._queued -= 1
+        self._queued_by_priority[waiter.priority] -= 1
+        self._model_queued[waiter.model][waiter.priority] -= 1
+
+    def _dispatch(self):
+        while self._in_flight < self.max_in_flight:
+            best = None
+            for model, queue in self._queues.items():
+                while queue and queue[0][2].future.done():
+                    heapq.heappop(queue)
+                if queue and self._has_room(model) and (best is None or queue[0] < best[1][0]):
+                    best = (model, queue)
+            if best is None:
+                return
+            _, _, waiter = heapq.heappop(best[1])
+            self._dequeue(waiter)
+            self._waits.append(self._clock() - waiter.enqueued)
+            waiter.future.set_result(self._take(waiter.model))
+
+    def _release(self, model, admitted):
+        held = self._clock() - admitted
+        a = self.alpha
+        self._service = held if self._service is None else (1 - a) * self._service + a * held
+        previous = self._model_service.get(model)
+        self._model_service[model] = held if previous is None else (1 - a) * previous + a * held
+        self._in_flight -= 1
+        self._model_in_flight[model] -= 1
+        if self._queued:
+            self._dispatch()
+
+    def stats(self):
+        waits = sorted(self._waits)
+        return {
+            "max_in_flight": self.max_in_flight,
+            "per_model": self.per_model,
+            "model_limits": dict(self.model_limits),
+            "max_queue": self.max_queue,
+            "in_flight": self._in_flight,
+            "in_flight_by_model": {m: n for m, n in self._model_in_flight.items() if n},
+            "queued": self._queued,
+            "queued_by_priority": dict(zip(PRIORITIES, self._queued_by_priority)),
+            "admitted": self.admitted,
+            "queued_total": self.queued_total,
+            "rejected": dict(self.rejected),
+            "wait_ms": {
+                "samples": len(waits),
+                "mean": round(statistics.fmean(waits) * 1000, 1) if waits else None,
+                "p50": round(waits[len(waits) // 2] * 1000, 1) if waits else None,
+                "p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else None,
+                "max": round(waits[-1] * 1000, 1) if waits else None,
+            },
+            "service_ms": round(self._service * 1000, 1) if self._service is not None else None,
+        }
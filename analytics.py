@@ -0,0 +1,304 @@
+# Incrementally maintained usage rollups over the usage log.
+import json
+import math
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DIMENSIONS = ("key", "owner", "model", "worktype")
+GRANULARITIES = {"hour": "%Y-%m-%dT%H", "day": "%Y-%m-%d"}
+
+# Latency histogram buckets grow by 20%, so percentiles are accurate to about ±10%
+_RATIO = 1.2
+_LOG_RATIO = math.log(_RATIO)
+
+# Entry layout: [requests, errors, prompt_tokens, completion_tokens, total_tokens, {bucket: count}]
+REQUESTS, ERRORS, PROMPT, COMPLETION, TOTAL, HIST = range(6)
+
+
+def latency_bucket(ms):
+    if ms <= 1:
+        return 0
+    return math.ceil(math.log(ms) / _LOG_RATIO)
+
+
+def percentile(hist, pct):
+    count = sum(hist.values())
+    if not count:
+        return None
+    target = count * pct / 100
+    seen = 0
+    for bucket in sorted(hist, key=int):
+        seen += hist[bucket]
+        if seen >= target:
+            return round(_RATIO ** int(bucket), 1)
+    return None
+
+
+def merge_into(dst, src):
+    for i in range(HIST):
+        dst[i] += src[i]
+    for bucket, count in src[HIST].items():
+        dst[HIST][bucket] = dst[HIST].get(bucket, 0) + count
+
+
+def new_entry():
+    return [0, 0, 0, 0, 0, {}]
+
+
+class UsageAggregator:
+    """Per-hour and per-day totals by key, owner, model and worktype.
+
+    `sync()` scans only the bytes appended to the log since the last
+    checkpoint (memory-mapped) and writes the rollup rows it changed, plus
+    the checkpoint, to a SQLite store. The log writer calls `before_rotate()`
+    right before it rotates a file, so no records are missed across
+    rotations; callers run `sync()` through the writer's `flush(then=...)` so
+    the two never overlap. Hourly buckets older than `hourly_retention_days`
+    are discarded; daily buckets are kept. Each sync is one write
+    transaction that first reads the rows other processes wrote since this
+    one last looked, so processes sharing a log and store take turns. An
+    existing JSON store from older versions at `import_path` is imported
+    when the SQLite store is new.
+    """
+
+    def __init__(self, log_path, store_path, hourly_retention_days=31, import_path=None, busy_timeout=5.0):
+        self.log_path = log_path
+        self.store_path = store_path
+        self.hourly_retention_days = hourly_retention_days
+        self._lock = threading.Lock()
+        self.rollups = {g: {d: {} for d in DIMENSIONS} for g in GRANULARITIES}
+        self.checkpoint = {"inode": None, "offset": 0}
+        self.records = 0
+        self.last_sync = None
+        self.rows_written = 0
+        # (granularity, dim, value, period) of entries changed since the last save
+        self._dirty = set()
+        self._generation = 0
+        self._pruned_before = None
+        self._delete_before = None
+        self._db = sqlite3.connect(store_path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS rollups (
+                    granularity TEXT NOT NULL,
+                    dim TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    period TEXT NOT NULL,
+                    entry TEXT NOT NULL,
+                    generation INTEGER NOT NULL,
+                    PRIMARY KEY (granularity, dim, value, period)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS rollups_generation ON rollups (generation);
+                CREATE TABLE IF NOT EXISTS rollup_state (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    log_inode INTEGER,
+                    log_offset INTEGER NOT NULL,
+                    records INTEGER NOT NULL,
+                    generation INTEGER NOT NULL
+                );
+            """)
+            with self._transaction():
+                self._refresh()
+                if not self._generation and import_path and self._import(import_path):
+                    self._save()
+
+    @contextmanager
+    def _transaction(self):
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def _import(self, path):
+        try:
+            with open(path, "r") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        self.checkpoint = state["checkpoint"]
+        self.records = state.get("records", 0)
+        for granularity, dims in state["rollups"].items():
+            for dim, values in dims.items():
+                self.rollups[granularity][dim] = values
+                self._dirty.update((granularity, dim, value, period)
+                                   for value, periods in values.items() for period in periods)
+        return True
+
+    def _refresh(self):
+        # Pick up what other processes saved; called inside a write transaction
+        row = self._db.execute("SELECT log_inode, log_offset, records, generation FROM rollup_state").fetchone()
+        if row is None or row[3] == self._generation:
+            return
+        inode, offset, records, generation = row
+        if generation < self._generation:
+            # The store was replaced; start over from what it holds
+            self.rollups = {g: {d: {} for d in DIMENSIONS} for g in GRANULARITIES}
+            self._generation = 0
+        for granularity, dim, value, period, entry in self._db.execute(
+                "SELECT granularity, dim, value, period, entry FROM rollups WHERE generation > ?",
+                (self._generation,)):
+            self.rollups[granularity][dim].setdefault(value, {})[period] = json.loads(entry)
+        self.checkpoint = {"inode": inode, "offset": offset}
+        self.records = records
+        self._generation = generation
+
+    def _save(self):
+        generation = self._generation + 1
+        rows = []
+        for granularity, dim, value, period in self._dirty:
+            entry = self.rollups[granularity][dim].get(value, {}).get(period)
+            if entry is not None:
+                rows.append((granularity, dim, value, period, json.dumps(entry, separators=(",", ":")), generation))
+        self._db.executemany("INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?, ?)", rows)
+        if self._delete_before is not None:
+            self._db.execute("DELETE FROM rollups WHERE granularity = 'hour' AND period < ?", (self._delete_before,))
+        self._db.execute("INSERT OR REPLACE INTO rollup_state VALUES (1, ?, ?, ?, ?)",
+                         (self.checkpoint["inode"], self.checkpoint["offset"], self.records, generation))
+        self._generation = generation
+        self._dirty.clear()
+        self._delete_before = None
+        self.rows_written += len(rows)
+
+    def _add(self, record):
+        ts = record.get("ts")
+        if ts is None:
+            return
+        status = record.get("status", 0)
+        bucket = str(latency_bucket(record.get("latency_ms", 0)))
+        gmt = time.gmtime(ts)
+        for granularity, fmt in GRANULARITIES.items():
+            period = time.strftime(fmt, gmt)
+            for dim in DIMENSIONS:
+                value = record.get(dim) or ""
+                periods = self.rollups[granularity][dim].setdefault(value, {})
+                entry = periods.get(period)
+                if entry is None:
+                    entry = periods[period] = new_entry()
+                self._dirty.add((granularity, dim, value, period))
+                entry[REQUESTS] += 1
+                if status >= 400:
+                    entry[ERRORS] += 1
+                entry[PROMPT] += record.get("prompt_tokens", 0)
+                entry[COMPLETION] += record.get("completion_tokens", 0)
+                entry[TOTAL] += record.get("total_tokens", 0)
+                entry[HIST][bucket] = entry[HIST].get(bucket, 0) + 1
+        self.records += 1
+
+    def _scan(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return 0
+        if st.st_ino != self.checkpoint["inode"] or st.st_size < self.checkpoint["offset"]:
+            self.checkpoint = {"inode": st.st_ino, "offset": 0}
+        start = self.checkpoint["offset"]
+        if st.st_size <= start:
+            return 0
+        added = 0
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), st.st_size, access=mmap.ACCESS_READ) as mm:
+            end = mm.rfind(b"\n", start) + 1
+            if end <= start:
+                return 0
+            pos = start
+            while pos < end:
+                nl = mm.find(b"\n", pos, end)
+                line = mm[pos:nl]
+                pos = nl + 1
+                try:
+                    self._add(json.loads(line))
+                    added += 1
+                except ValueError:
+                    continue
+        self.checkpoint["offset"] = end
+        return added
+
+    def _prune(self):
+        cutoff = time.strftime(GRANULARITIES["hour"], time.gmtime(time.time() - self.hourly_retention_days * 86400))
+        if cutoff == self._pruned_before:
+            return
+        for values in self.rollups["hour"].values():
+            for periods in values.values():
+                for period in [p for p in periods if p < cutoff]:
+                    del periods[period]
+        self._pruned_before = self._delete_before = cutoff
+
+    def sync(self):
+        with self._lock, self._transaction():
+            self._refresh()
+            added = self._scan(self.log_path)
+            if added:
+                self._prune()
+                self._save()
+            self.last_sync = time.time()
+            return added
+
+    def before_rotate(self, path):
+        # Catch up on the outgoing file; the next scan starts the new file from zero
+        with self._lock, self._transaction():
+            self._refresh()
+            self._scan(path)
+            self.checkpoint = {"inode": None, "offset": 0}
+            self._save()
+
+    def query(self, group_by="model", granularity="day", since=None, until=None, value=None):
+        """Return per-period rows and per-value totals for one dimension.
+
+        `since`/`until` are inclusive period strings in the granularity's
+        format (a day like 2026-10-01 also works for hourly queries).
+        """
+        rows = []
+        totals = {}
+        with self._lock:
+            values = self.rollups[granularity][group_by]
+            selected = {value: values.get(value, {})} if value is not None else values
+            for name, periods in selected.items():
+                total = totals.setdefault(name, new_entry())
+                for period, entry in periods.items():
+                    if since and period < since:
+                        continue
+                    if until and period[:len(until)] > until:
+                        continue
+                    rows.append(self._row(name, entry, period))
+                    merge_into(total, entry)
+        rows.sort(key=lambda r: (r["period"], r["value"]))
+        return {
+            "group_by": group_by,
+            "granularity": granularity,
+            "rows": rows,
+            "totals": sorted((self._row(name, entry) for name, entry in totals.items() if entry[REQUESTS]),
+                             key=lambda r: (-r["requests"], r["value"])),
+        }
+
+    def _row(self, name, entry, period=None):
+        row = {"value": name}
+        if period is not None:
+            row["period"] = period
+        row.update({
+            "requests": entry[REQUESTS],
+            "errors": entry[ERRORS],
+            "error_rate": round(entry[ERRORS] / entry[REQUESTS], 4) if entry[REQUESTS] else 0.0,
+            "prompt_tokens": entry[PROMPT],
+            "completion_tokens": entry[COMPLETION],
+            "total_tokens": entry[TOTAL],
+            "p50_ms": percentile(entry[HIST], 50),
+            "p95_ms": percentile(entry[HIST], 95),
+        })
+        return row
+
+    def stats(self):
+        return {
+            "store_path": self.store_path,
+            "records": self.records,
+            "checkpoint": dict(self.checkpoint),
+            "last_sync": self.last_sync,
+            "rows_written": self.rows_written,
+        }
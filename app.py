@@ -1,39 +1,197 @@
 # AI API/app.py
 from fastapi import FastAPI, HTTPException, Query, Request, Response, Form, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
-import openai
+import asyncio
+import hashlib
 import os
 import json
+import secrets
+import time
+from contextlib import aclosing, asynccontextmanager
+from typing import Optional
 from dotenv import load_dotenv
+from admission import PRIORITIES, AdmissionController, Overloaded, parse_pairs
+from analytics import DIMENSIONS, GRANULARITIES, UsageAggregator
+from cancellation import ClientDisconnected, RequestTimeout, WorkTracker, run_cancellable, with_deadline
+from batch import BatchParseError, BatchPool, parse_batch_body
+from cache import ResponseCache, make_cache_key
+from jobs import (JobFailed, JobRunner, JobStore, QueueFull, check_webhook_host, parse_networks, public_view,
+                  validate_webhook_url)
+from fallback import FallbackRouter, NoUpstreamAvailable
+from metrics import OVERHEAD_BUCKETS, MetricSet
+from nearcache import NearDuplicateCache
+from openai import APITimeoutError
+from quota import TokenLedger
+from ratelimit import RateLimited, RateLimiter, validate_limits
+from registry import Registry
+from sessions import SessionStore, truncate, validate_messages
+from shared import ConfigBus, MetricsExchange, SharedRateLimiter, claim_worker_slot, idle_worker_slots
+from store import open_store
+from singleflight import SingleFlight, StreamFlight
+from streaming import open_stream, relay_stream, replay_cached, sse_event
+from upstream import UpstreamPool
+from usagelog import UsageLogWriter
+
+load_dotenv()
 
 ADMIN_PASSWORD = "admin123"  # Hardcoded for now
-MODELS_FILE = "allowed_models.json"
-API_KEYS_FILE = "api_keys.json"
+MODELS_FILE = os.getenv("MODELS_FILE", "allowed_models.json")
+API_KEYS_FILE = os.getenv("API_KEYS_FILE", "api_keys.json")
+# "sqlite" (default; seeded from the JSON files when the database is new) or "json"
+STORE_BACKEND = os.getenv("STORE_BACKEND", "sqlite")
+STORE_PATH = os.getenv("STORE_PATH", "routerai.db")
+FALLBACK_CHAINS_FILE = os.getenv("FALLBACK_CHAINS_FILE", "fallback_chains.json")
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+
+# Circuit breaker and fallback ordering settings
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_WINDOW = float(os.getenv("CIRCUIT_WINDOW", "30"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+
+# Upstream connection pool (UPSTREAM_HTTP2 needs the optional 'h2' package)
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() in ("1", "true", "yes")
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "120"))
+UPSTREAM_WRITE_TIMEOUT = float(os.getenv("UPSTREAM_WRITE_TIMEOUT", "30"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "10"))
+UPSTREAM_PREWARM = int(os.getenv("UPSTREAM_PREWARM", "4"))
+UPSTREAM_DRAIN_TIMEOUT = float(os.getenv("UPSTREAM_DRAIN_TIMEOUT", "10"))
+
+# Response cache settings (RESPONSE_CACHE_MAX_ENTRIES=0 disables the cache)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "")
+RESPONSE_CACHE_DISABLED_MODELS = [m.strip() for m in os.getenv("RESPONSE_CACHE_DISABLED_MODELS", "").split(",") if m.strip()]
+# Near-duplicate prompt cache for keys with similar_cache enabled
+SIMILAR_CACHE_MAX_ENTRIES = int(os.getenv("SIMILAR_CACHE_MAX_ENTRIES", "2048"))
+SIMILAR_CACHE_THRESHOLD = float(os.getenv("SIMILAR_CACHE_THRESHOLD", "0.9"))
+
+# /api/chat request size and server-side conversation sessions
+CHAT_MAX_MESSAGES = int(os.getenv("CHAT_MAX_MESSAGES", "200"))
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", "sessions.db")
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+SESSION_MAX_TOKENS = int(os.getenv("SESSION_MAX_TOKENS", "8000"))
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", "200"))
+
+# Batch endpoint limits
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MODEL_CONCURRENCY = int(os.getenv("BATCH_MODEL_CONCURRENCY", "4"))
+
+# Asynchronous jobs (/api/jobs): worker pool size, queue bound, result retention and webhook retries
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_QUEUE = int(os.getenv("JOB_MAX_QUEUE", "1000"))
+JOB_TTL = float(os.getenv("JOB_TTL", "86400"))
+JOB_MAX_WAIT = float(os.getenv("JOB_MAX_WAIT", "60"))
+JOB_WEBHOOK_ATTEMPTS = int(os.getenv("JOB_WEBHOOK_ATTEMPTS", "5"))
+JOB_WEBHOOK_BACKOFF = float(os.getenv("JOB_WEBHOOK_BACKOFF", "1.0"))
+JOB_WEBHOOK_TIMEOUT = float(os.getenv("JOB_WEBHOOK_TIMEOUT", "10"))
+# Webhooks may only target public addresses; list internal hosts or ranges allowed anyway, e.g. "10.0.0.0/8"
+JOB_WEBHOOK_ALLOW_NETWORKS = parse_networks(os.getenv("JOB_WEBHOOK_ALLOW_NETWORKS", ""))
+
+# Usage log (an empty USAGE_LOG_FILE disables it)
+USAGE_LOG_FILE = os.getenv("USAGE_LOG_FILE", "requests.jsonl")
+USAGE_LOG_BATCH_SIZE = int(os.getenv("USAGE_LOG_BATCH_SIZE", "500"))
+USAGE_LOG_FLUSH_INTERVAL = float(os.getenv("USAGE_LOG_FLUSH_INTERVAL", "1.0"))
+USAGE_LOG_MAX_QUEUE = int(os.getenv("USAGE_LOG_MAX_QUEUE", "50000"))
+USAGE_LOG_MAX_BYTES = int(os.getenv("USAGE_LOG_MAX_BYTES", str(64 * 1024 * 1024)))
+USAGE_ROLLUP_FILE = os.getenv("USAGE_ROLLUP_FILE", "usage_rollups.db")
+# Rollups saved as JSON by older versions, imported into a new USAGE_ROLLUP_FILE
+USAGE_ROLLUP_IMPORT = os.getenv("USAGE_ROLLUP_IMPORT", "usage_rollups.json")
+
+# Per-key token counters and daily/monthly budgets
+TOKEN_LEDGER_PATH = os.getenv("TOKEN_LEDGER_PATH", "token_usage.db")
+TOKEN_LEDGER_FLUSH_INTERVAL = float(os.getenv("TOKEN_LEDGER_FLUSH_INTERVAL", "2.0"))
 
-app = FastAPI()
+# When set, /metrics requires "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Multi-worker mode: workers on one host share rate limits and admin changes through files here
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+SHARED_STATE_DIR = os.getenv("SHARED_STATE_DIR", ".routerai-shared" if WEB_CONCURRENCY > 1 else "")
+SHARED_MAX_WORKERS = int(os.getenv("SHARED_MAX_WORKERS", "16"))
+CONFIG_POLL_INTERVAL = float(os.getenv("CONFIG_POLL_INTERVAL", "0.5"))
+# How often each worker writes its metrics for the others to include in /metrics
+METRICS_SHARE_INTERVAL = float(os.getenv("METRICS_SHARE_INTERVAL", "2.0"))
+STORE_CHECK_INTERVAL = float(os.getenv("STORE_CHECK_INTERVAL", "1.0"))
+
+# Admission control: host-wide caps on concurrent upstream calls; the excess waits in a priority queue.
+# Each of the WEB_CONCURRENCY workers enforces an equal share of every cap and of the queue (at least
+# one slot each), so priority order holds within a worker, not across them. ADMISSION_MODEL_LIMITS
+# overrides the per-model cap ("model=4,other=8"); WORKTYPE_PRIORITIES maps a worktype to
+# high/normal/low ("batch=low") for keys without their own priority.
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", str(UPSTREAM_MAX_CONNECTIONS * WEB_CONCURRENCY)))
+ADMISSION_MODEL_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MODEL_MAX_IN_FLIGHT", "0"))
+ADMISSION_MODEL_LIMITS = {m: int(n) for m, n in parse_pairs(os.getenv("ADMISSION_MODEL_LIMITS", "")).items()}
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "30"))
+ADMISSION_LOW_PRIORITY_SHARE = float(os.getenv("ADMISSION_LOW_PRIORITY_SHARE", "0.5"))
+WORKTYPE_PRIORITIES = parse_pairs(os.getenv("WORKTYPE_PRIORITIES", ""))
+
+@asynccontextmanager
+async def lifespan(app):
+    await registry.start()
+    await upstream.start()
+    if usage_log is not None:
+        await usage_log.start()
+    await token_ledger.start()
+    if config_bus is not None:
+        await config_bus.start()
+    if metrics_exchange is not None:
+        await metrics_exchange.start()
+    await job_runner.start()
+    yield
+    await job_runner.stop()
+    await registry.stop()
+    if metrics_exchange is not None:
+        await metrics_exchange.stop()
+    if config_bus is not None:
+        await config_bus.stop()
+    await upstream.close()
+    await token_ledger.stop()
+    if usage_log is not None:
+        await usage_log.stop()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(SessionMiddleware, secret_key="supersecretkey123")
 
-# Helper functions for models
+# Models and API keys live in the configured store
+store = open_store(STORE_BACKEND, STORE_PATH, MODELS_FILE, API_KEYS_FILE)
+
+def load_fallback_chains():
+    try:
+        with open(FALLBACK_CHAINS_FILE, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
 
-def load_models():
-    with open(MODELS_FILE, "r") as f:
-        return json.load(f)
+def save_fallback_chains(chains):
+    with open(FALLBACK_CHAINS_FILE, "w") as f:
+        json.dump(chains, f, indent=2)
 
-def save_models(models):
-    with open(MODELS_FILE, "w") as f:
-        json.dump(models, f, indent=2)
+# Process-wide index used by /api/generate instead of querying the store
+registry = Registry(store, check_interval=STORE_CHECK_INTERVAL)
 
-def load_api_keys():
-    with open(API_KEYS_FILE, "r") as f:
-        return json.load(f)
+# Store changes reach other workers through the store generation; everything
+# else an admin can change at runtime is published on the config bus
+worker_slot = None
+config_bus = None
+if SHARED_STATE_DIR:
+    worker_slot, _worker_lock = claim_worker_slot(SHARED_STATE_DIR, SHARED_MAX_WORKERS)
+    config_bus = ConfigBus(SHARED_STATE_DIR, poll_interval=CONFIG_POLL_INTERVAL)
 
-def save_api_keys(keys):
-    with open(API_KEYS_FILE, "w") as f:
-        json.dump(keys, f, indent=2)
+def publish(event_type, **data):
+    if config_bus is not None:
+        config_bus.publish(event_type, **data)
 
 # Allowlist of models the frontend can use
 ALLOWED_MODELS = {
@@ -91,13 +249,365 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize OpenRouter client
-load_dotenv()
-client = openai.AsyncOpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=os.getenv("OPENROUTER_API_KEY")
+# Initialize OpenRouter client; connections are pre-warmed and drained by the lifespan
+upstream = UpstreamPool(
+    OPENROUTER_BASE_URL,
+    os.getenv("OPENROUTER_API_KEY"),
+    max_connections=UPSTREAM_MAX_CONNECTIONS,
+    max_keepalive=UPSTREAM_MAX_KEEPALIVE,
+    keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+    http2=UPSTREAM_HTTP2,
+    connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+    read_timeout=UPSTREAM_READ_TIMEOUT,
+    write_timeout=UPSTREAM_WRITE_TIMEOUT,
+    pool_timeout=UPSTREAM_POOL_TIMEOUT,
+    # Retries and failover are decided by fallback_router, so each upstream failure counts once
+    max_retries=0,
+    prewarm=UPSTREAM_PREWARM,
+    drain_timeout=UPSTREAM_DRAIN_TIMEOUT,
+)
+
+# Requested models fall back along their configured chain when upstream fails
+fallback_router = FallbackRouter(
+    load_fallback_chains(),
+    is_allowed=registry.is_model_allowed,
+    failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+    window=CIRCUIT_WINDOW,
+    open_seconds=CIRCUIT_OPEN_SECONDS,
+)
+
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    ttl=RESPONSE_CACHE_TTL,
+    disk_dir=RESPONSE_CACHE_DIR,
+    disabled_models=RESPONSE_CACHE_DISABLED_MODELS,
+)
+
+similar_cache = NearDuplicateCache(
+    threshold=SIMILAR_CACHE_THRESHOLD,
+    max_entries=SIMILAR_CACHE_MAX_ENTRIES,
+    ttl=RESPONSE_CACHE_TTL,
+)
+
+# Identical concurrent requests share one upstream call
+inflight = SingleFlight()
+stream_inflight = StreamFlight()
+
+def worker_share(total):
+    # 0 keeps meaning "no cap"
+    return max(1, total // WEB_CONCURRENCY) if total > 0 else total
+
+admission = AdmissionController(
+    max_in_flight=worker_share(ADMISSION_MAX_IN_FLIGHT),
+    per_model=worker_share(ADMISSION_MODEL_MAX_IN_FLIGHT),
+    model_limits={m: worker_share(n) for m, n in ADMISSION_MODEL_LIMITS.items()},
+    max_queue=worker_share(ADMISSION_MAX_QUEUE),
+    low_priority_share=ADMISSION_LOW_PRIORITY_SHARE,
+)
+
+# Requests abandoned by their client or deadline, and the upstream work cancelled with them
+upstream_work = WorkTracker()
+
+batch_pool = BatchPool(BATCH_CONCURRENCY, BATCH_MODEL_CONCURRENCY, is_allowed=registry.is_model_allowed)
+
+# Per-key limits come from the key records (rate_limit_rpm, max_concurrency)
+if SHARED_STATE_DIR:
+    rate_limiter = SharedRateLimiter(SHARED_STATE_DIR, worker_slot, max_workers=SHARED_MAX_WORKERS,
+                                     idle_workers=idle_worker_slots(SHARED_STATE_DIR, SHARED_MAX_WORKERS))
+else:
+    rate_limiter = RateLimiter()
+
+usage_log = UsageLogWriter(
+    USAGE_LOG_FILE,
+    batch_size=USAGE_LOG_BATCH_SIZE,
+    flush_interval=USAGE_LOG_FLUSH_INTERVAL,
+    max_queue=USAGE_LOG_MAX_QUEUE,
+    max_bytes=USAGE_LOG_MAX_BYTES,
+    lock_path=USAGE_LOG_FILE + ".lock" if SHARED_STATE_DIR else None,
+) if USAGE_LOG_FILE else None
+
+# Usage rollups are caught up from the log on demand and right before each rotation
+usage_aggregator = None
+if usage_log is not None:
+    usage_aggregator = UsageAggregator(USAGE_LOG_FILE, USAGE_ROLLUP_FILE, import_path=USAGE_ROLLUP_IMPORT)
+    usage_log.before_rotate.append(usage_aggregator.before_rotate)
+
+sessions = SessionStore(
+    SESSION_STORE_PATH,
+    ttl=SESSION_TTL,
+    max_sessions=SESSION_MAX,
+    max_tokens=SESSION_MAX_TOKENS,
+    max_messages=SESSION_MAX_MESSAGES,
 )
 
+# Token usage per key and model, checked against daily_token_budget / monthly_token_budget
+token_ledger = TokenLedger(TOKEN_LEDGER_PATH, flush_interval=TOKEN_LEDGER_FLUSH_INTERVAL)
+
+# Per-worker metrics; gateway overhead is total latency minus time spent waiting on upstream.
+# With several workers every series carries a worker label and any worker's /metrics includes the
+# others' latest snapshots, so each scrape sees the whole host.
+metrics = MetricSet({"worker": worker_slot} if SHARED_STATE_DIR else None)
+metrics_exchange = None
+if SHARED_STATE_DIR:
+    metrics_exchange = MetricsExchange(SHARED_STATE_DIR, worker_slot, metrics.families,
+                                       max_workers=SHARED_MAX_WORKERS, interval=METRICS_SHARE_INTERVAL)
+REQUEST_LABELS = ("model", "owner", "status", "worktype")
+request_seconds = metrics.histogram(
+    "routerai_request_duration_seconds", "Total time to serve a generation request.", REQUEST_LABELS)
+upstream_wait_seconds = metrics.histogram(
+    "routerai_upstream_wait_seconds", "Time a request spent waiting on the upstream.", REQUEST_LABELS)
+overhead_seconds = metrics.histogram(
+    "routerai_gateway_overhead_seconds", "Request time not spent waiting on the upstream.", REQUEST_LABELS,
+    buckets=OVERHEAD_BUCKETS)
+ttft_seconds = metrics.histogram(
+    "routerai_time_to_first_token_seconds", "Time to the first streamed token.", ("model", "owner", "worktype"))
+upstream_attempt_seconds = metrics.histogram(
+    "routerai_upstream_attempt_seconds", "Upstream call time per model tried (response headers for streams).",
+    ("model", "outcome"))
+admission_wait_seconds = metrics.histogram(
+    "routerai_admission_wait_seconds", "Time spent waiting for an upstream slot.", ("model", "priority"))
+in_flight = metrics.gauge("routerai_in_flight_requests", "Generation requests being served.", ("model",))
+cache_lookups = metrics.counter("routerai_cache_lookups_total", "Response cache outcomes.", ("model", "result"))
+rate_limited = metrics.counter("routerai_rate_limited_total", "Requests refused by per-key limits.", ("owner", "reason"))
+
+@metrics.collector
+def component_metrics():
+    pool = upstream.stats()
+    cache_stats = response_cache.stats()
+    log_stats = usage_log.stats() if usage_log is not None else {}
+    admission_stats = admission.stats()
+    return [
+        ("routerai_upstream_connections", "gauge", "Open upstream connections.", pool["connections"]),
+        ("routerai_upstream_connections_in_use", "gauge", "Upstream connections serving a request.", pool["in_use"]),
+        ("routerai_upstream_pool_waiters", "gauge", "Requests waiting for an upstream connection.", pool["waiters"]),
+        ("routerai_admission_in_flight", "gauge", "Upstream calls holding an admission slot.",
+         admission_stats["in_flight"]),
+        ("routerai_admission_queued", "gauge", "Upstream calls waiting for an admission slot.",
+         admission_stats["queued"]),
+        ("routerai_admission_rejected_total", "counter", "Requests shed by admission control.",
+         sum(admission_stats["rejected"].values())),
+        ("routerai_abandoned_requests_total", "counter", "Requests given up on by a client disconnect or deadline.",
+         sum(upstream_work.abandoned.values())),
+        ("routerai_upstream_cancelled_total", "counter", "Upstream calls cancelled because nobody waited for them.",
+         upstream_work.cancelled_calls),
+        ("routerai_upstream_saved_seconds_total", "counter",
+         "Estimated upstream seconds saved by cancelling abandoned calls.", upstream_work.seconds_saved),
+        ("routerai_cache_entries", "gauge", "Entries in the in-memory response cache.", cache_stats["entries"]),
+        ("routerai_usage_log_queued", "gauge", "Usage records waiting to be written.", log_stats.get("queued")),
+        ("routerai_fallbacks_served_total", "counter", "Responses served by a fallback model.",
+         fallback_router.fallbacks_served),
+        ("routerai_coalesced_requests_total", "counter", "Requests that shared another request's upstream call.",
+         inflight.coalesced + stream_inflight.coalesced),
+        ("routerai_usage_log_dropped_total", "counter", "Usage records dropped or sampled out.",
+         log_stats["dropped"] + log_stats["sampled_out"] if log_stats else None),
+    ]
+
+def generation_params(**params):
+    return {k: v for k, v in params.items() if v is not None}
+
+def wants_no_cache(request: Request):
+    cache_control = request.headers.get("cache-control", "").lower()
+    return "no-cache" in cache_control or "no-store" in cache_control
+
+async def timed_attempt(candidate, call):
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        result = await call
+        outcome = "ok"
+        return result
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        upstream_attempt_seconds.observe(time.perf_counter() - started, candidate, outcome)
+
+async def complete(model, messages, params):
+    served, response = await fallback_router.call(
+        model,
+        lambda candidate: timed_attempt(candidate, upstream.client.chat.completions.create(
+            model=candidate,
+            messages=messages,
+            **params
+        )),
+    )
+    choice = response.choices[0]
+    return {
+        "response": choice.message.content,
+        "model": served,
+        "finish_reason": choice.finish_reason,
+        "usage": response.usage.model_dump(exclude_none=True) if response.usage else None,
+    }
+
+async def cache_lookup(request_key, use_cache):
+    if not use_cache:
+        response_cache.bypasses += 1
+        return None, "BYPASS"
+    cached = await response_cache.get(request_key)
+    return cached, "HIT" if cached is not None else "MISS"
+
+async def similar_lookup(key_obj, model, params, messages):
+    # Returns (similar_key, (value, similarity) or None); similar_key indexes the answer on a miss.
+    # System prompts must match exactly, so a long shared one cannot make different questions look alike;
+    # only the other turns, with their roles, are compared by MinHash.
+    if not key_obj.get("similar_cache") or similar_cache.max_entries <= 0:
+        return None, None
+    system = "\n".join(m["content"] for m in messages if m["role"] == "system")
+    if system:
+        params = {**params, "system": hashlib.sha1(system.encode()).hexdigest()}
+    # Shingling is about a millisecond of pure Python for a long prompt; keep it off the event loop
+    signature = await asyncio.to_thread(similar_cache.signature, "\n".join(
+        f'{m["role"]}: {m["content"]}' for m in messages if m["role"] != "system"))
+    return (params, signature), similar_cache.get(model, params, signature)
+
+def request_priority(key_obj, worktype):
+    # A key's own priority wins over the one configured for the worktype
+    priority = key_obj.get("priority") or WORKTYPE_PRIORITIES.get(worktype)
+    return priority if priority in PRIORITIES else "normal"
+
+async def admit_upstream(key_obj, model, record, deadline=None):
+    timeout = ADMISSION_MAX_WAIT
+    if deadline is not None:
+        timeout = min(timeout, max(0.0, deadline - time.perf_counter()))
+    priority = request_priority(key_obj, record["worktype"])
+    queued = time.perf_counter()
+    try:
+        return await admission.admit(model, priority, timeout)
+    finally:
+        waited = time.perf_counter() - queued
+        record["queue_ms"] = round(waited * 1000, 3)
+        admission_wait_seconds.observe(waited, model, priority)
+
+async def release_after(ticket, model, events):
+    relay_started = time.perf_counter()
+    async with aclosing(events):
+        try:
+            async for event in events:
+                yield event
+        except (asyncio.CancelledError, GeneratorExit):
+            upstream_work.cancelled(model, True, time.perf_counter() - relay_started)
+            raise
+        else:
+            upstream_work.completed(model, True, time.perf_counter() - relay_started)
+        finally:
+            ticket.release()
+
+def acquire_limits(key_obj):
+    try:
+        token_ledger.check(key_obj)
+        return rate_limiter.acquire(key_obj)
+    except RateLimited as e:
+        rate_limited.inc(key_obj.get("owner", ""), e.reason)
+        raise HTTPException(status_code=429, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+
+async def wait_for_limits(key_obj):
+    # For work nobody is blocked on: wait out rate and concurrency limits; an exhausted budget is final
+    while True:
+        try:
+            token_ledger.check(key_obj)
+            return rate_limiter.acquire(key_obj)
+        except RateLimited as e:
+            rate_limited.inc(key_obj.get("owner", ""), e.reason)
+            if e.reason == "budget":
+                raise
+            await asyncio.sleep(e.retry_after)
+
+def new_usage_record(apikey, model, worktype, from_, **extra):
+    # status stays 500 unless the handler records another outcome
+    in_flight.inc(model)
+    return {"ts": round(time.time(), 3), "key": apikey, "owner": "", "model": model,
+            "worktype": worktype, "from": from_, "status": 500, **extra}
+
+def add_usage(record, usage):
+    if usage:
+        for field in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            record[field] = usage.get(field, 0)
+
+def observe_request(record, elapsed):
+    labels = (record["model"], record["owner"], str(record["status"]), record["worktype"])
+    request_seconds.observe(elapsed, *labels)
+    waited = record.get("upstream_ms", 0) / 1000
+    if waited:
+        upstream_wait_seconds.observe(waited, *labels)
+    overhead_seconds.observe(max(0.0, elapsed - waited), *labels)
+    if "ttft_ms" in record:
+        ttft_seconds.observe(record["ttft_ms"] / 1000, record["model"], record["owner"], record["worktype"])
+    if "cache" in record:
+        cache_lookups.inc(record["model"], record["cache"])
+    in_flight.dec(record["model"])
+
+def finish_record(record, started):
+    elapsed = time.perf_counter() - started
+    record["latency_ms"] = round(elapsed * 1000, 1)
+    observe_request(record, elapsed)
+    if usage_log is not None:
+        usage_log.log(record)
+
+def stream_timed_out():
+    upstream_work.abandon("timeout")
+    return sse_event({"detail": "Request timeout exceeded", "status": 504}, event="error")
+
+async def finish_stream(events, lease, record, started, upstream_started=None, on_reply=None, deadline=None):
+    record["status"] = 200
+    reply = []
+    if deadline is not None:
+        events = with_deadline(events, deadline - time.perf_counter(), stream_timed_out)
+    try:
+        async for event in events:
+            if upstream_started is not None and "ttft_ms" not in record and event.startswith("data: "):
+                record["ttft_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            if event.startswith("event: done"):
+                add_usage(record, json.loads(event.split("data: ", 1)[1]).get("usage"))
+                if on_reply is not None:
+                    try:
+                        await on_reply("".join(reply))
+                    except HTTPException as e:
+                        # Headers are gone; the refusal replaces the done event
+                        record["status"] = e.status_code
+                        event = sse_event({"detail": e.detail, "status": e.status_code}, event="error")
+            elif event.startswith("event: error"):
+                record["status"] = json.loads(event.split("data: ", 1)[1]).get("status", 500)
+            elif on_reply is not None and event.startswith("data: "):
+                reply.append(json.loads(event[6:]).get("delta", ""))
+            yield event
+    except BaseException:
+        # Client went away mid-stream
+        record["status"] = 499
+        upstream_work.abandon("disconnect")
+        raise
+    finally:
+        if upstream_started is not None:
+            record["upstream_ms"] = round((time.perf_counter() - upstream_started) * 1000, 3)
+        lease.release()
+        finish_record(record, started)
+
+async def fetch_completion(request_key, model, messages, params, use_cache, key_obj, record, similar_key=None,
+                           deadline=None):
+    # Only the request that actually goes upstream is charged for its tokens
+    async def fetch():
+        ticket = await admit_upstream(key_obj, model, record, deadline)
+        call_started = time.perf_counter()
+        try:
+            result = await complete(model, messages, params)
+        except asyncio.CancelledError:
+            upstream_work.cancelled(model, False, time.perf_counter() - call_started)
+            raise
+        finally:
+            ticket.release()
+        upstream_work.completed(model, False, time.perf_counter() - call_started)
+        token_ledger.record(key_obj["key"], result["model"], result["usage"])
+        if use_cache:
+            await response_cache.set(request_key, model, result)
+        if similar_key is not None:
+            similar_cache.set(model, *similar_key, result)
+        return result
+
+    upstream_started = time.perf_counter()
+    try:
+        return await inflight.do(request_key, fetch)
+    finally:
+        record["upstream_ms"] = round((time.perf_counter() - upstream_started) * 1000, 3)
+
 # Dependency for admin session
 
 def require_admin(request: Request):
@@ -124,8 +634,6 @@ async def admin_dashboard(request: Request):
         </form>
         </div></body></html>
         """)
-    models = load_models()
-    models_json = json.dumps(models)
     return HTMLResponse(f"""
     <html><head><title>Admin Dashboard</title>
     <style>
@@ -163,7 +671,7 @@ async def admin_dashboard(request: Request):
     <div class='container'>
     <h2>Admin Dashboard</h2>
     <div class='search-bar'>
-        <input type='text' id='searchInput' placeholder='Search models...' oninput='renderTable()' />
+        <input type='text' id='searchInput' placeholder='Search models...' oninput='searchModels()' />
     </div>
     <form class='add-form' id='addModelForm' onsubmit='return false;'>
         <input type='text' id='newModel' placeholder='Add new model...' required />
@@ -175,16 +683,33 @@ async def admin_dashboard(request: Request):
     <button class='logout-btn' onclick="logout()">Logout</button>
     </div>
     <script>
-    let models = {models_json};
+    let models = [];
+    let modelTotal = 0;
     let editIdx = -1;
     let searchTerm = '';
     let page = 1;
     const pageSize = 8;
+    let searchTimer = null;
     const msgDiv = document.getElementById('msg');
+    // Only the visible page is fetched; duplicate checks ask the server
+    async function findExisting(url, value, pick) {{
+        const res = await fetch(url + '?' + new URLSearchParams({{q: value, limit: 1000}}).toString());
+        if (!res.ok) return false;
+        const data = await res.json();
+        return data.items.some(item => pick(item).toLowerCase() === value.toLowerCase());
+    }}
+    function pageButtons(current, totalPages, onclick) {{
+        let pages = [];
+        for (let i=1; i<=totalPages; ++i) {{
+            if (i === 1 || i === totalPages || Math.abs(i - current) <= 2) pages.push(i);
+            else if (pages[pages.length - 1] !== '...') pages.push('...');
+        }}
+        return pages.map(i => i === '...' ? `<span>...</span>` : `<button class='${{i===current?'active':''}}' onclick='${{onclick}}(${{i}})'>${{i}}</button>`).join('');
+    }}
     document.getElementById('addModelForm').onsubmit = async function() {{
         const model = document.getElementById('newModel').value.trim();
         if (!model) return;
-        if (models.some(m => m.toLowerCase() === model.toLowerCase())) {{
+        if (await findExisting('/admin/models', model, m => m)) {{
             msgDiv.innerHTML = `<span class='error-msg'>Model name already exists (case-insensitive).</span>`;
             return;
         }}
@@ -197,14 +722,31 @@ async def admin_dashboard(request: Request):
             msgDiv.innerHTML = `<span class='error-msg'>${{data.detail || 'Error adding model.'}}</span>`;
         }}
     }};
+    async function loadModels() {{
+        const params = new URLSearchParams({{q: searchTerm, offset: (page-1)*pageSize, limit: pageSize}});
+        const res = await fetch('/admin/models?' + params.toString());
+        if (!res.ok) {{
+            msgDiv.innerHTML = `<span class='error-msg'>Error loading models.</span>`;
+            return;
+        }}
+        const data = await res.json();
+        models = data.items;
+        modelTotal = data.total;
+        const totalPages = Math.max(1, Math.ceil(modelTotal / pageSize));
+        if (page > totalPages) {{ page = totalPages; return loadModels(); }}
+        renderTable();
+    }}
+    function searchModels() {{
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(() => {{
+            searchTerm = document.getElementById('searchInput').value.trim();
+            page = 1;
+            loadModels();
+        }}, 250);
+    }}
     function renderTable() {{
-        searchTerm = document.getElementById('searchInput').value.trim().toLowerCase();
-        let filtered = models.filter(m => m.toLowerCase().includes(searchTerm));
-        let totalPages = Math.max(1, Math.ceil(filtered.length / pageSize));
-        if (page > totalPages) page = totalPages;
-        let start = (page-1)*pageSize, end = start+pageSize;
-        let rows = filtered.slice(start, end).map((m, i) => {{
-            let idx = models.indexOf(m);
+        let totalPages = Math.max(1, Math.ceil(modelTotal / pageSize));
+        let rows = models.map((m, idx) => {{
             if (editIdx === idx) {{
                 return `<tr><td><input id='editInput' value='${{m}}' style='width:90%' /></td><td>
                 <button class='save-btn' onclick='saveEdit(${{idx}})'>Save</button>
@@ -217,17 +759,15 @@ async def admin_dashboard(request: Request):
         }}).join('');
         document.getElementById('tableContainer').innerHTML = `<table><thead><tr><th>Model Name</th><th style='width:160px;'>Action</th></tr></thead><tbody>${{rows}}</tbody></table>`;
         // Pagination
-        let pagBtns = '';
-        for (let i=1; i<=totalPages; ++i) pagBtns += `<button class='${{i===page?'active':''}}' onclick='gotoPage(${{i}})'>${{i}}</button>`;
-        document.getElementById('pagination').innerHTML = pagBtns;
+        document.getElementById('pagination').innerHTML = pageButtons(page, totalPages, 'gotoPage');
     }}
-    function gotoPage(p) {{ page = p; renderTable(); }}
+    function gotoPage(p) {{ page = p; editIdx = -1; loadModels(); }}
     function editModel(idx) {{ editIdx = idx; renderTable(); }}
     function cancelEdit() {{ editIdx = -1; renderTable(); }}
     async function saveEdit(idx) {{
         const newVal = document.getElementById('editInput').value.trim();
         if (!newVal) {{ msgDiv.innerHTML = `<span class='error-msg'>Model name cannot be empty.</span>`; return; }}
-        if (models.some(m => m.toLowerCase() === newVal.toLowerCase() && models.indexOf(m) !== idx)) {{ msgDiv.innerHTML = `<span class='error-msg'>Duplicate model name (case-insensitive).</span>`; return; }}
+        if (newVal.toLowerCase() !== models[idx].toLowerCase() && await findExisting('/admin/models', newVal, m => m)) {{ msgDiv.innerHTML = `<span class='error-msg'>Duplicate model name (case-insensitive).</span>`; return; }}
         // Remove old, add new
         const delRes = await fetch('/admin/models', {{method:'DELETE',headers:{{'Content-Type':'application/json'}},body:JSON.stringify({{model:models[idx]}})}});
         if (!delRes.ok) {{ msgDiv.innerHTML = `<span class='error-msg'>Error editing model.</span>`; return; }}
@@ -255,17 +795,20 @@ async def admin_dashboard(request: Request):
         location.reload();
     }}
     window.renderTable = renderTable;
+    window.searchModels = searchModels;
+    window.findExisting = findExisting;
+    window.pageButtons = pageButtons;
     window.editModel = editModel;
     window.cancelEdit = cancelEdit;
     window.saveEdit = saveEdit;
     window.deleteModel = deleteModel;
     window.gotoPage = gotoPage;
-    renderTable();
+    loadModels();
     </script>
     <div class='container'>
     <h2>API Key Management</h2>
     <div class='search-bar'>
-        <input type='text' id='apiKeySearchInput' placeholder='Search API keys...' oninput='renderApiKeyTable()' />
+        <input type='text' id='apiKeySearchInput' placeholder='Search API keys...' oninput='searchApiKeys()' />
     </div>
     <form class='add-form' id='addApiKeyForm' onsubmit='return false;'>
         <input type='text' id='newApiKey' placeholder='Add new API key...' required />
@@ -279,17 +822,19 @@ async def admin_dashboard(request: Request):
     </div>
     <script>
     let apiKeys = [];
+    let apiKeyTotal = 0;
     let apiKeyEditIdx = -1;
     let apiKeySearchTerm = '';
     let apiKeyPage = 1;
     const apiKeyPageSize = 8;
+    let apiKeySearchTimer = null;
     const apiKeyMsgDiv = document.getElementById('apiKeyMsg');
     document.getElementById('addApiKeyForm').onsubmit = async function() {{
         const key = document.getElementById('newApiKey').value.trim();
         const owner = document.getElementById('newApiKeyOwner').value.trim();
         const note = document.getElementById('newApiKeyNote').value.trim();
         if (!key) return;
-        if (apiKeys.some(k => k.key.toLowerCase() === key.toLowerCase())) {{
+        if (await findExisting('/admin/api-keys', key, k => k.key)) {{
             apiKeyMsgDiv.innerHTML = `<span class='error-msg'>API key already exists (case-insensitive).</span>`;
             return;
         }}
@@ -303,22 +848,30 @@ async def admin_dashboard(request: Request):
         }}
     }};
     async function loadApiKeys() {{
-        const res = await fetch('/admin/api-keys');
+        const params = new URLSearchParams({{q: apiKeySearchTerm, offset: (apiKeyPage-1)*apiKeyPageSize, limit: apiKeyPageSize}});
+        const res = await fetch('/admin/api-keys?' + params.toString());
         if (res.ok) {{
-            apiKeys = await res.json();
+            const data = await res.json();
+            apiKeys = data.items;
+            apiKeyTotal = data.total;
+            const totalPages = Math.max(1, Math.ceil(apiKeyTotal / apiKeyPageSize));
+            if (apiKeyPage > totalPages) {{ apiKeyPage = totalPages; return loadApiKeys(); }}
             renderApiKeyTable();
         }} else {{
             apiKeyMsgDiv.innerHTML = `<span class='error-msg'>Error loading API keys.</span>`;
         }}
     }}
+    function searchApiKeys() {{
+        clearTimeout(apiKeySearchTimer);
+        apiKeySearchTimer = setTimeout(() => {{
+            apiKeySearchTerm = document.getElementById('apiKeySearchInput').value.trim();
+            apiKeyPage = 1;
+            loadApiKeys();
+        }}, 250);
+    }}
     function renderApiKeyTable() {{
-        apiKeySearchTerm = document.getElementById('apiKeySearchInput').value.trim().toLowerCase();
-        let filtered = apiKeys.filter(k => k.key.toLowerCase().includes(apiKeySearchTerm) || k.owner.toLowerCase().includes(apiKeySearchTerm));
-        let totalPages = Math.max(1, Math.ceil(filtered.length / apiKeyPageSize));
-        if (apiKeyPage > totalPages) apiKeyPage = totalPages;
-        let start = (apiKeyPage-1)*apiKeyPageSize, end = start+apiKeyPageSize;
-        let rows = filtered.slice(start, end).map((k, i) => {{
-            let idx = apiKeys.indexOf(k);
+        let totalPages = Math.max(1, Math.ceil(apiKeyTotal / apiKeyPageSize));
+        let rows = apiKeys.map((k, idx) => {{
             if (apiKeyEditIdx === idx) {{
                 return `<tr><td><input id='editApiKeyInput' value='${{k.key}}' style='width:90%' /></td><td><input id='editApiKeyOwnerInput' value='${{k.owner}}' style='width:90%' /></td><td><input id='editApiKeyNoteInput' value='${{k.note}}' style='width:90%' /></td><td>
                 <button class='save-btn' onclick='saveApiKeyEdit(${{idx}})'>Save</button>
@@ -332,11 +885,9 @@ async def admin_dashboard(request: Request):
         }}).join('');
         document.getElementById('apiKeyTableContainer').innerHTML = `<table><thead><tr><th>API Key</th><th>Owner</th><th>Note</th><th>Status</th><th style='width:160px;'>Action</th></tr></thead><tbody>${{rows}}</tbody></table>`;
         // Pagination
-        let pagBtns = '';
-        for (let i=1; i<=totalPages; ++i) pagBtns += `<button class='${{i===apiKeyPage?'active':''}}' onclick='gotoApiKeyPage(${{i}})'>${{i}}</button>`;
-        document.getElementById('apiKeyPagination').innerHTML = pagBtns;
+        document.getElementById('apiKeyPagination').innerHTML = pageButtons(apiKeyPage, totalPages, 'gotoApiKeyPage');
     }}
-    function gotoApiKeyPage(p) {{ apiKeyPage = p; renderApiKeyTable(); }}
+    function gotoApiKeyPage(p) {{ apiKeyPage = p; apiKeyEditIdx = -1; loadApiKeys(); }}
     function editApiKey(idx) {{ apiKeyEditIdx = idx; renderApiKeyTable(); }}
     function cancelApiKeyEdit() {{ apiKeyEditIdx = -1; renderApiKeyTable(); }}
     async function saveApiKeyEdit(idx) {{
@@ -344,7 +895,7 @@ async def admin_dashboard(request: Request):
         const newOwner = document.getElementById('editApiKeyOwnerInput').value.trim();
         const newNote = document.getElementById('editApiKeyNoteInput').value.trim();
         if (!newKey) {{ apiKeyMsgDiv.innerHTML = `<span class='error-msg'>API key cannot be empty.</span>`; return; }}
-        if (apiKeys.some(k => k.key.toLowerCase() === newKey.toLowerCase() && apiKeys.indexOf(k) !== idx)) {{ apiKeyMsgDiv.innerHTML = `<span class='error-msg'>Duplicate API key (case-insensitive).</span>`; return; }}
+        if (newKey.toLowerCase() !== apiKeys[idx].key.toLowerCase() && await findExisting('/admin/api-keys', newKey, k => k.key)) {{ apiKeyMsgDiv.innerHTML = `<span class='error-msg'>Duplicate API key (case-insensitive).</span>`; return; }}
         const res = await fetch('/admin/api-keys', {{method:'PUT',headers:{{'Content-Type':'application/json'}},body:JSON.stringify({{key:newKey, owner:newOwner, note:newNote, active:apiKeys[idx].active}})}});
         if (res.ok) {{
             apiKeyMsgDiv.innerHTML = '<span class="success-msg">API key updated!</span>';
@@ -375,6 +926,7 @@ async def admin_dashboard(request: Request):
         }}
     }}
     window.renderApiKeyTable = renderApiKeyTable;
+    window.searchApiKeys = searchApiKeys;
     window.editApiKey = editApiKey;
     window.cancelApiKeyEdit = cancelApiKeyEdit;
     window.saveApiKeyEdit = saveApiKeyEdit;
@@ -428,6 +980,47 @@ async def admin_dashboard(request: Request):
         border-radius: 50%;
     }}
     </style>
+    <div class='container'>
+    <h2>Usage</h2>
+    <div class='search-bar'>
+        <select id='usageGroupBy' onchange='loadUsage()'>
+            <option value='model'>By model</option>
+            <option value='owner'>By owner</option>
+            <option value='key'>By API key</option>
+            <option value='worktype'>By worktype</option>
+        </select>
+        <select id='usageGranularity' onchange='loadUsage()'>
+            <option value='day'>Daily</option>
+            <option value='hour'>Hourly</option>
+        </select>
+        <input type='date' id='usageSince' onchange='loadUsage()' />
+        <input type='date' id='usageUntil' onchange='loadUsage()' />
+    </div>
+    <div id='usageMsg'></div>
+    <div id='usageTableContainer'></div>
+    </div>
+    <script>
+    async function loadUsage() {{
+        const params = new URLSearchParams({{
+            group_by: document.getElementById('usageGroupBy').value,
+            granularity: document.getElementById('usageGranularity').value
+        }});
+        const since = document.getElementById('usageSince').value;
+        const until = document.getElementById('usageUntil').value;
+        if (since) params.set('since', since);
+        if (until) params.set('until', until);
+        const res = await fetch('/admin/usage?' + params.toString());
+        if (!res.ok) {{
+            document.getElementById('usageMsg').innerHTML = `<span class='error-msg'>Error loading usage.</span>`;
+            return;
+        }}
+        const data = await res.json();
+        let rows = data.totals.map(t => `<tr><td>${{t.value || '-'}}</td><td>${{t.requests}}</td><td>${{(t.error_rate * 100).toFixed(1)}}%</td><td>${{t.total_tokens}}</td><td>${{t.p50_ms ?? '-'}}</td><td>${{t.p95_ms ?? '-'}}</td></tr>`).join('');
+        document.getElementById('usageTableContainer').innerHTML = `<table><thead><tr><th>${{data.group_by}}</th><th>Requests</th><th>Errors</th><th>Tokens</th><th>p50 ms</th><th>p95 ms</th></tr></thead><tbody>${{rows}}</tbody></table>`;
+    }}
+    window.loadUsage = loadUsage;
+    loadUsage();
+    </script>
     </body></html>
     """)
 
@@ -443,96 +1036,738 @@ async def admin_logout(request: Request):
     request.session.clear()
     return Response(status_code=204)
 
+# Without any of these parameters the admin lists are returned whole, as a bare list
+LIST_PARAMS = ("q", "match", "sort", "order", "offset", "cursor", "limit")
+
+async def list_page(request, index, **query):
+    paged = any(name in request.query_params for name in LIST_PARAMS)
+    # The ETag covers the store generation and the query, so an unchanged page revalidates as 304
+    digest = hashlib.sha1(repr((registry.generation, paged, sorted(query.items()))).encode()).hexdigest()[:20]
+    headers = {"ETag": f'W/"{digest}"', "Cache-Control": "private, no-cache"}
+    if headers["ETag"] in request.headers.get("if-none-match", ""):
+        return None, headers
+    await index.ensure()
+    if not paged:
+        return index.page(limit=len(index.records))["items"], headers
+    try:
+        return index.page(**query), headers
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/admin/models")
-async def get_models(request: Request, admin: None = Depends(require_admin)):
-    return load_models()
+async def get_models(
+    request: Request,
+    q: str = Query(""),
+    match: str = Query("substring"),
+    sort: str = Query("created"),
+    order: str = Query("asc"),
+    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=1000),
+    admin: None = Depends(require_admin)
+):
+    page, headers = await list_page(request, registry.model_index, q=q, match=match, sort=sort, order=order,
+                                    offset=offset, cursor=cursor, limit=limit)
+    if page is None:
+        return Response(status_code=304, headers=headers)
+    if isinstance(page, list):
+        return JSONResponse([item["model"] for item in page], headers=headers)
+    page["items"] = [item["model"] for item in page["items"]]
+    return JSONResponse(page, headers=headers)
 
 @app.post("/admin/models")
 async def add_model(request: Request, data: dict, admin: None = Depends(require_admin)):
-    models = load_models()
     model = data.get("model")
-    if not model or model in models:
+    generation = await asyncio.to_thread(store.add_model, model) if model else None
+    if generation is None:
         raise HTTPException(status_code=400, detail="Invalid or duplicate model")
-    models.append(model)
-    save_models(models)
+    await registry.put_model(model, generation)
     return {"success": True}
 
 @app.delete("/admin/models")
 async def delete_model(request: Request, data: dict, admin: None = Depends(require_admin)):
-    models = load_models()
     model = data.get("model")
-    if not model or model not in models:
+    generation = await asyncio.to_thread(store.remove_model, model) if model else None
+    if generation is None:
         raise HTTPException(status_code=400, detail="Model not found")
-    models.remove(model)
-    save_models(models)
+    await registry.drop_model(model, generation)
     return {"success": True}
 
 @app.get("/admin/api-keys")
-async def get_api_keys(request: Request, admin: None = Depends(require_admin)):
-    return load_api_keys()
+async def get_api_keys(
+    request: Request,
+    q: str = Query(""),
+    match: str = Query("substring"),
+    sort: str = Query("created"),
+    order: str = Query("asc"),
+    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=1000),
+    admin: None = Depends(require_admin)
+):
+    page, headers = await list_page(request, registry.key_index, q=q, match=match, sort=sort, order=order,
+                                    offset=offset, cursor=cursor, limit=limit)
+    if page is None:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(page, headers=headers)
+
+def validate_key_options(data):
+    options = {}
+    if "similar_cache" in data:
+        if not isinstance(data["similar_cache"], bool):
+            raise ValueError("similar_cache must be true or false")
+        options["similar_cache"] = data["similar_cache"]
+    if "max_timeout" in data:
+        value = data["max_timeout"]
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0):
+            raise ValueError("max_timeout must be a positive number of seconds or null")
+        options["max_timeout"] = value
+    if "priority" in data:
+        if data["priority"] is not None and data["priority"] not in PRIORITIES:
+            raise ValueError(f"priority must be one of {list(PRIORITIES)} or null")
+        options["priority"] = data["priority"]
+    if "webhook_secret" in data:
+        if not isinstance(data["webhook_secret"], str) or len(data["webhook_secret"]) < 16:
+            raise ValueError("webhook_secret must be a string of at least 16 characters")
+        options["webhook_secret"] = data["webhook_secret"]
+    return options
 
 @app.post("/admin/api-keys")
 async def add_api_key(request: Request, data: dict, admin: None = Depends(require_admin)):
-    keys = load_api_keys()
     key = data.get("key")
     owner = data.get("owner", "")
     note = data.get("note", "")
-    if not key or any(k["key"] == key for k in keys):
+    try:
+        limits = validate_limits(data)
+        options = validate_key_options(data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    record = {"key": key, "owner": owner, "active": True, "note": note,
+              "webhook_secret": secrets.token_hex(32), **limits, **options}
+    generation = await asyncio.to_thread(store.add_key, record) if key else None
+    if generation is None:
         raise HTTPException(status_code=400, detail="Invalid or duplicate key")
-    keys.append({"key": key, "owner": owner, "active": True, "note": note})
-    save_api_keys(keys)
+    await registry.put_key(record, generation)
     return {"success": True}
 
 @app.put("/admin/api-keys")
 async def update_api_key(request: Request, data: dict, admin: None = Depends(require_admin)):
-    keys = load_api_keys()
     key = data.get("key")
-    for k in keys:
-        if k["key"] == key:
-            k["owner"] = data.get("owner", k["owner"])
-            k["note"] = data.get("note", k["note"])
-            k["active"] = data.get("active", k["active"])
-            save_api_keys(keys)
-            return {"success": True}
-    raise HTTPException(status_code=404, detail="Key not found")
+    try:
+        limits = validate_limits(data)
+        options = validate_key_options(data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    changes = {field: data[field] for field in ("owner", "note", "active") if field in data}
+    record, generation = await asyncio.to_thread(store.update_key, key, {**changes, **limits, **options})
+    if record is None:
+        raise HTTPException(status_code=404, detail="Key not found")
+    await registry.put_key(record, generation)
+    return {"success": True}
 
 @app.delete("/admin/api-keys")
 async def delete_api_key(request: Request, data: dict, admin: None = Depends(require_admin)):
-    keys = load_api_keys()
     key = data.get("key")
-    new_keys = [k for k in keys if k["key"] != key]
-    if len(new_keys) == len(keys):
+    generation = await asyncio.to_thread(store.remove_key, key)
+    if generation is None:
         raise HTTPException(status_code=404, detail="Key not found")
-    save_api_keys(new_keys)
+    await registry.drop_key(key, generation)
+    rate_limiter.forget(key)
+    token_ledger.forget(key)
     return {"success": True}
 
+@app.get("/admin/stats")
+async def get_stats(request: Request, admin: None = Depends(require_admin)):
+    return {
+        "cache": {**response_cache.stats(), "similar": similar_cache.stats()},
+        "coalescing": {"requests": inflight.stats(), "streams": stream_inflight.stats()},
+        "batch": batch_pool.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "upstreams": fallback_router.stats(),
+        "upstream_pool": upstream.stats(),
+        "usage_log": usage_log.stats() if usage_log is not None else None,
+        "usage_rollups": usage_aggregator.stats() if usage_aggregator is not None else None,
+        "token_ledger": token_ledger.stats(),
+        "sessions": await asyncio.to_thread(sessions.stats),
+        "admission": admission.stats(),
+        "cancellation": upstream_work.stats(),
+        "jobs": await asyncio.to_thread(job_runner.stats),
+        "worker": {"pid": os.getpid(), "slot": worker_slot,
+                   "config_bus": config_bus.stats() if config_bus is not None else None},
+    }
+
+@app.get("/admin/fallbacks")
+async def get_fallbacks(request: Request, admin: None = Depends(require_admin)):
+    return {"chains": fallback_router.chains, **fallback_router.stats()}
+
+@app.put("/admin/fallbacks")
+async def update_fallbacks(request: Request, data: dict, admin: None = Depends(require_admin)):
+    chains = data.get("chains")
+    if not isinstance(chains, dict) or not all(
+        isinstance(chain, list) and all(isinstance(m, str) for m in chain) for chain in chains.values()
+    ):
+        raise HTTPException(status_code=400, detail="chains must map a model to a list of fallback models")
+    save_fallback_chains(chains)
+    fallback_router.chains = dict(chains)
+    publish("fallbacks")
+    return {"success": True}
+
+@app.get("/admin/usage")
+async def get_usage(
+    request: Request,
+    group_by: str = Query("model"),
+    granularity: str = Query("day"),
+    since: Optional[str] = Query(None),
+    until: Optional[str] = Query(None),
+    value: Optional[str] = Query(None),
+    admin: None = Depends(require_admin)
+):
+    if usage_aggregator is None:
+        raise HTTPException(status_code=404, detail="Usage logging is disabled")
+    if group_by not in DIMENSIONS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {list(DIMENSIONS)}")
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity must be one of {list(GRANULARITIES)}")
+    # Flush what is queued so the numbers include the latest requests
+    await usage_log.flush(then=usage_aggregator.sync)
+    return await asyncio.to_thread(usage_aggregator.query, group_by, granularity, since, until, value)
+
+@app.get("/admin/token-usage")
+async def get_token_usage(
+    request: Request,
+    key: Optional[str] = Query(None),
+    model: Optional[str] = Query(None),
+    granularity: str = Query("day"),
+    since: Optional[str] = Query(None),
+    until: Optional[str] = Query(None),
+    admin: None = Depends(require_admin)
+):
+    if granularity not in ("day", "month"):
+        raise HTTPException(status_code=400, detail="granularity must be 'day' or 'month'")
+    # Write out this worker's pending counts; other workers flush on their own interval
+    await token_ledger.flush()
+    rows = await asyncio.to_thread(token_ledger.usage, key, model, granularity, since, until)
+    result = {"granularity": granularity, "rows": rows}
+    if key is not None:
+        key_obj = registry.keys.get(key) or {}
+        await token_ledger.refresh([key])
+        day_tokens, month_tokens = token_ledger.current(key)
+        result["budget"] = {
+            "daily_token_budget": key_obj.get("daily_token_budget"),
+            "monthly_token_budget": key_obj.get("monthly_token_budget"),
+            "day_tokens": day_tokens,
+            "month_tokens": month_tokens,
+        }
+    return result
+
+@app.get("/admin/cache")
+async def get_cache(request: Request, admin: None = Depends(require_admin)):
+    return {**response_cache.stats(), "similar": similar_cache.stats()}
+
+def apply_cache_settings(data):
+    # Validate everything before changing anything
+    disabled_models = set(data["disabled_models"] or []) if "disabled_models" in data else None
+    ttl = float(data["ttl"]) if "ttl" in data else None
+    threshold = float(data["similarity_threshold"]) if "similarity_threshold" in data else None
+    if threshold is not None and not 0 < threshold <= 1:
+        raise ValueError("similarity_threshold must be in (0, 1]")
+    if disabled_models is not None:
+        response_cache.disabled_models = disabled_models
+    if ttl is not None:
+        response_cache.ttl = similar_cache.ttl = ttl
+    if threshold is not None:
+        similar_cache.threshold = threshold
+
+@app.put("/admin/cache")
+async def update_cache(request: Request, data: dict, admin: None = Depends(require_admin)):
+    settings = {k: data[k] for k in ("disabled_models", "ttl", "similarity_threshold") if k in data}
+    try:
+        apply_cache_settings(settings)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="ttl and similarity_threshold must be numbers, "
+                                                    "similarity_threshold in (0, 1], and disabled_models a list")
+    publish("cache_settings", **settings)
+    return {**response_cache.stats(), "similar": similar_cache.stats()}
+
+@app.delete("/admin/cache")
+async def purge_cache(request: Request, data: Optional[dict] = None, admin: None = Depends(require_admin)):
+    model = (data or {}).get("model")
+    removed = await response_cache.purge(model)
+    removed["similar"] = similar_cache.purge(model)
+    # The disk tier is shared, so other workers only drop their memory entries
+    publish("cache_purge", model=model)
+    return {"success": True, "removed": removed}
+
+if config_bus is not None:
+    config_bus.on("fallbacks", lambda: setattr(fallback_router, "chains", load_fallback_chains()))
+    config_bus.on("cache_settings", lambda **data: apply_cache_settings(data))
+    async def purge_local_caches(model=None):
+        similar_cache.purge(model)
+        await response_cache.purge(model, disk=False)
+
+    config_bus.on("cache_purge", purge_local_caches)
+
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    others = await asyncio.to_thread(metrics_exchange.others) if metrics_exchange is not None else ()
+    return Response(metrics.render(others), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+async def serve_generation(request, record, started, key_obj, model, messages, params, stream, cache,
+                           on_reply=None, headers=None, body=None, deadline=None):
+    """Answer one generation from the cache or upstream and finish its usage record.
+
+    `await on_reply(text)` runs with the assistant's answer once it is complete
+    and may raise HTTPException to refuse it;
+    `headers` and `body` are added to the response. `deadline` is the
+    time.perf_counter() value by which the caller wants an answer.
+    """
+
+    async def open_admitted():
+        ticket = await admit_upstream(key_obj, model, record, deadline)
+        try:
+            return ticket, await fallback_router.call(
+                model,
+                lambda candidate: timed_attempt(candidate, open_stream(upstream.client, candidate, messages, **params)),
+            )
+        except BaseException:
+            ticket.release()
+            raise
+
+    def relay_admitted(opened):
+        ticket, (served, events) = opened
+        return release_after(ticket, model, relay_stream(
+            events, served, started,
+            on_done=lambda summary: token_ledger.record(key_obj["key"], summary["model"], summary["usage"]),
+            on_error=lambda e: fallback_router.record(served, False),
+        ))
+
+    lease = None
+    # A streaming response takes the lease and usage record over and finishes them when the stream ends
+    handed_over = False
+    try:
+        lease = acquire_limits(key_obj)
+        use_cache = cache and response_cache.enabled_for(model) and not wants_no_cache(request)
+        request_key = make_cache_key(model, messages, params)
+        cached, cache_status = await cache_lookup(request_key, use_cache)
+        similar_key = None
+        cache_headers = {"X-Cache": cache_status, **(headers or {})}
+        if cached is None and use_cache:
+            similar_key, near = await similar_lookup(key_obj, model, params, messages)
+            if near is not None:
+                cached, similarity = near
+                cache_status = "SIMILAR"
+                record["similarity"] = similarity
+                cache_headers.update({"X-Cache": cache_status, "X-Cache-Similarity": f"{similarity:.3f}"})
+        record["cache"] = cache_status
+        if stream:
+            sse_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **cache_headers}
+            upstream_started = None
+            if cached is not None:
+                events = replay_cached(cached, model)
+            else:
+                upstream_started = time.perf_counter()
+                try:
+                    events = await run_cancellable(
+                        stream_inflight.subscribe(request_key, open_admitted, relay_admitted),
+                        request.receive, remaining(deadline),
+                    )
+                except ClientDisconnected:
+                    upstream_work.abandon("disconnect")
+                    raise HTTPException(status_code=499, detail="Client closed the request")
+                except (RequestTimeout, APITimeoutError):
+                    upstream_work.abandon("timeout")
+                    raise HTTPException(status_code=504, detail="Upstream did not answer within the request timeout")
+                except Overloaded as e:
+                    raise HTTPException(status_code=e.status_code, detail=e.detail,
+                                        headers={"Retry-After": str(e.retry_after)})
+                except NoUpstreamAvailable as e:
+                    raise HTTPException(status_code=503, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+                except Exception as e:
+                    raise HTTPException(status_code=500, detail=str(e))
+            # Streamed completions are not buffered for the cache so memory stays flat
+            handed_over = True
+            return StreamingResponse(
+                finish_stream(events, lease, record, started, upstream_started, on_reply, deadline),
+                media_type="text/event-stream",
+                headers=sse_headers,
+            )
+        if cached is not None:
+            result = cached
+        else:
+            try:
+                result = await run_cancellable(
+                    fetch_completion(request_key, model, messages, params, use_cache, key_obj, record, similar_key,
+                                     deadline),
+                    request.receive, remaining(deadline),
+                )
+            except ClientDisconnected:
+                upstream_work.abandon("disconnect")
+                raise HTTPException(status_code=499, detail="Client closed the request")
+            except (RequestTimeout, APITimeoutError):
+                upstream_work.abandon("timeout")
+                raise HTTPException(status_code=504, detail="Upstream did not answer within the request timeout")
+            except Overloaded as e:
+                raise HTTPException(status_code=e.status_code, detail=e.detail,
+                                    headers={"Retry-After": str(e.retry_after)})
+            except NoUpstreamAvailable as e:
+                raise HTTPException(status_code=503, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=str(e))
+        add_usage(record, result["usage"])
+        record["served_model"] = result["model"]
+        record["status"] = 200
+        if on_reply is not None:
+            await on_reply(result["response"])
+        return JSONResponse(
+            {"response": result["response"], "model": result["model"], **(body or {})},
+            headers={**cache_headers, "X-Served-Model": result["model"]},
+        )
+    except HTTPException as e:
+        record["status"] = e.status_code
+        raise
+    finally:
+        if not handed_over:
+            if lease is not None:
+                lease.release()
+            finish_record(record, started)
+
+def fail_record(record, started, e):
+    # For errors raised before serve_generation takes the record over
+    record["status"] = e.status_code
+    finish_record(record, started)
+
+def request_deadline(started, timeout, key_obj):
+    # A key's max_timeout caps the requested timeout and applies when none is given
+    if timeout is not None and timeout <= 0:
+        raise HTTPException(status_code=400, detail="timeout must be a positive number of seconds")
+    cap = key_obj.get("max_timeout")
+    if cap and (timeout is None or timeout > cap):
+        timeout = cap
+    return None if timeout is None else started + timeout
+
+def remaining(deadline):
+    return None if deadline is None else max(0.0, deadline - time.perf_counter())
+
+def check_model_and_key(model, apikey):
+    if not registry.is_model_allowed(model):
+        raise HTTPException(
+            status_code=403,
+            detail=f"Model '{model}' is not allowed. Choose from: {list(registry.models)}"
+        )
+    # API key validation
+    key_obj = registry.get_active_key(apikey)
+    if not key_obj:
+        raise HTTPException(status_code=401, detail="Invalid or inactive API key")
+    return key_obj
+
 @app.post("/api/generate")
 async def generate_text(
+    request: Request,
     prompt: str = Query(...),
     model: str = Query("deepseek/deepseek-r1:free"),
     apikey: str = Query(...),
     worktype: str = Query(""),
-    from_: str = Query("", alias="from")
+    from_: str = Query("", alias="from"),
+    stream: bool = Query(False),
+    cache: bool = Query(True),
+    temperature: Optional[float] = Query(None),
+    top_p: Optional[float] = Query(None),
+    max_tokens: Optional[int] = Query(None),
+    timeout: Optional[float] = Query(None)
 ):
-    if not prompt:
-        raise HTTPException(status_code=400, detail="Prompt cannot be empty")
-    allowed_models = set(load_models())
-    if model not in allowed_models:
-        raise HTTPException(
-            status_code=403,
-            detail=f"Model '{model}' is not allowed. Choose from: {list(allowed_models)}"
-        )
-    # API key validation
-    api_keys = load_api_keys()
-    key_obj = next((k for k in api_keys if k["key"] == apikey and k["active"]), None)
+    started = time.perf_counter()
+    record = new_usage_record(apikey, model, worktype, from_, stream=stream)
+    try:
+        if not prompt:
+            raise HTTPException(status_code=400, detail="Prompt cannot be empty")
+        key_obj = check_model_and_key(model, apikey)
+        deadline = request_deadline(started, timeout, key_obj)
+    except HTTPException as e:
+        fail_record(record, started, e)
+        raise
+    record["owner"] = key_obj.get("owner", "")
+    messages = [{"role": "user", "content": prompt}]
+    params = generation_params(temperature=temperature, top_p=top_p, max_tokens=max_tokens)
+    return await serve_generation(request, record, started, key_obj, model, messages, params, stream, cache,
+                                  deadline=deadline)
+
+def body_number(data, field, kind):
+    value = data.get(field)
+    if value is not None and (isinstance(value, bool) or not isinstance(value, kind)):
+        raise HTTPException(status_code=400, detail=f"{field} must be a number")
+    return value
+
+@app.post("/api/chat")
+async def chat(request: Request, data: dict):
+    """Chat completion from a JSON body with a full `messages` array.
+
+    With "session": true the gateway stores the conversation and returns its
+    id (X-Session-Id header, and "session_id" in JSON responses); later
+    requests send "session_id" and only the new messages.
+    """
+    started = time.perf_counter()
+    model = data.get("model") or "deepseek/deepseek-r1:free"
+    apikey = data.get("apikey") or ""
+    stream = data.get("stream") is True
+    record = new_usage_record(apikey, model, str(data.get("worktype") or ""), str(data.get("from") or ""),
+                              stream=stream)
+    try:
+        key_obj = check_model_and_key(model, apikey)
+        try:
+            messages = validate_messages(data.get("messages"), CHAT_MAX_MESSAGES)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        params = generation_params(temperature=body_number(data, "temperature", (int, float)),
+                                   top_p=body_number(data, "top_p", (int, float)),
+                                   max_tokens=body_number(data, "max_tokens", int))
+        deadline = request_deadline(started, body_number(data, "timeout", (int, float)), key_obj)
+        session_id = data.get("session_id")
+        # None creates the session when the reply is saved
+        version = None
+        if session_id is not None:
+            session_id = str(session_id)
+            found = await asyncio.to_thread(sessions.get, session_id, apikey)
+            if found is None:
+                raise HTTPException(status_code=404, detail="Session not found or expired")
+            history, version = found
+            messages, _ = truncate(history + messages, SESSION_MAX_TOKENS, SESSION_MAX_MESSAGES)
+        elif data.get("session") is True:
+            # Stored only once the first reply succeeds, so failed requests leave no empty sessions
+            session_id = sessions.new_id()
+            messages, _ = truncate(messages, SESSION_MAX_TOKENS, SESSION_MAX_MESSAGES)
+    except HTTPException as e:
+        fail_record(record, started, e)
+        raise
+    record["owner"] = key_obj.get("owner", "")
+    if session_id is None:
+        return await serve_generation(request, record, started, key_obj, model, messages, params, stream,
+                                      data.get("cache", True) is not False, deadline=deadline)
+    record["session"] = True
+
+    async def save_reply(reply):
+        saved = await asyncio.to_thread(sessions.save, session_id, apikey,
+                                        messages + [{"role": "assistant", "content": reply}], version)
+        if not saved:
+            raise HTTPException(status_code=409, detail="Another turn was saved to this session meanwhile; "
+                                                        "this reply was not stored")
+
+    return await serve_generation(
+        request, record, started, key_obj, model, messages, params, stream, data.get("cache", True) is not False,
+        on_reply=save_reply,
+        headers={"X-Session-Id": session_id},
+        body={"session_id": session_id},
+        deadline=deadline,
+    )
+
+@app.get("/api/chat/sessions/{session_id}")
+async def get_chat_session(session_id: str, apikey: str = Query(...)):
+    found = await asyncio.to_thread(sessions.get, session_id, apikey)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return {"session_id": session_id, "messages": found[0]}
+
+@app.delete("/api/chat/sessions/{session_id}")
+async def delete_chat_session(session_id: str, apikey: str = Query(...)):
+    if not await asyncio.to_thread(sessions.delete, session_id, apikey):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {"success": True}
+
+async def run_job(job):
+    data = job["request"]
+    model = data["model"]
+    started = time.perf_counter()
+    record = new_usage_record(job["apikey"], model, data["worktype"], data["from"], job=True)
+    try:
+        key_obj = registry.get_active_key(job["apikey"])
+        if not key_obj:
+            raise JobFailed(401, "Invalid or inactive API key")
+        record["owner"] = key_obj.get("owner", "")
+        deadline = request_deadline(started, data.get("timeout"), key_obj)
+        try:
+            lease = await wait_for_limits(key_obj)
+        except RateLimited as e:
+            raise JobFailed(429, e.detail)
+        try:
+            messages, params = data["messages"], data["params"]
+            use_cache = data["cache"] and response_cache.enabled_for(model)
+            request_key = make_cache_key(model, messages, params)
+            result, cache_status = await cache_lookup(request_key, use_cache)
+            record["cache"] = cache_status
+            while result is None:
+                try:
+                    result = await asyncio.wait_for(
+                        fetch_completion(request_key, model, messages, params, use_cache, key_obj, record,
+                                         deadline=deadline),
+                        remaining(deadline),
+                    )
+                except Overloaded as e:
+                    # Jobs wait for capacity rather than fail
+                    await asyncio.sleep(e.retry_after)
+                except (asyncio.TimeoutError, APITimeoutError):
+                    raise JobFailed(504, "Upstream did not answer within the job timeout")
+                except NoUpstreamAvailable as e:
+                    raise JobFailed(503, e.detail)
+                except Exception as e:
+                    raise JobFailed(500, str(e))
+        finally:
+            lease.release()
+        add_usage(record, result["usage"])
+        record["served_model"] = result["model"]
+        record["status"] = 200
+        return {"response": result["response"], "model": result["model"], "cache": cache_status}
+    except JobFailed as e:
+        record["status"] = e.status_code
+        raise
+    finally:
+        finish_record(record, started)
+
+job_runner = JobRunner(
+    JobStore(JOB_STORE_PATH, ttl=JOB_TTL),
+    run_job,
+    lambda apikey: registry.keys.get(apikey, {}).get("webhook_secret"),
+    workers=JOB_WORKERS,
+    max_queue=JOB_MAX_QUEUE,
+    webhook_attempts=JOB_WEBHOOK_ATTEMPTS,
+    webhook_backoff=JOB_WEBHOOK_BACKOFF,
+    webhook_timeout=JOB_WEBHOOK_TIMEOUT,
+    webhook_allow=JOB_WEBHOOK_ALLOW_NETWORKS,
+)
+
+@app.post("/api/jobs")
+async def submit_job(data: dict):
+    """Queue a generation and return its id straight away.
+
+    Takes the /api/chat body ("messages", or a single "prompt") plus an
+    optional "webhook_url" that receives the finished job as a JSON POST,
+    signed with the key's webhook_secret (see JobRunner).
+    Poll GET /api/jobs/{id}, adding ?wait=<seconds> to long-poll.
+    """
+    model = data.get("model") or "deepseek/deepseek-r1:free"
+    apikey = data.get("apikey") or ""
+    key_obj = check_model_and_key(model, apikey)
+    try:
+        if "messages" in data:
+            messages = validate_messages(data["messages"], CHAT_MAX_MESSAGES)
+        elif isinstance(data.get("prompt"), str) and data["prompt"]:
+            messages = [{"role": "user", "content": data["prompt"]}]
+        else:
+            raise ValueError("Send a non-empty prompt or a messages list")
+        webhook_url = validate_webhook_url(data["webhook_url"]) if data.get("webhook_url") else None
+        if webhook_url:
+            if not key_obj.get("webhook_secret"):
+                raise ValueError("This API key has no webhook_secret to sign webhooks with; ask an admin to set one")
+            await check_webhook_host(webhook_url, JOB_WEBHOOK_ALLOW_NETWORKS)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    params = generation_params(temperature=body_number(data, "temperature", (int, float)),
+                               top_p=body_number(data, "top_p", (int, float)),
+                               max_tokens=body_number(data, "max_tokens", int))
+    timeout = body_number(data, "timeout", (int, float))
+    if timeout is not None and timeout <= 0:
+        raise HTTPException(status_code=400, detail="timeout must be a positive number of seconds")
+    try:
+        token_ledger.check(key_obj)
+    except RateLimited as e:
+        raise HTTPException(status_code=429, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    job = {"model": model, "messages": messages, "params": params, "cache": data.get("cache", True) is not False,
+           "worktype": str(data.get("worktype") or ""), "from": str(data.get("from") or ""), "timeout": timeout}
+    try:
+        job_id = await job_runner.submit(apikey, job, webhook_url)
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    return JSONResponse({"id": job_id, "status": "queued", "status_url": f"/api/jobs/{job_id}"},
+                        status_code=202, headers={"Location": f"/api/jobs/{job_id}"})
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str, apikey: str = Query(...), wait: float = Query(0)):
+    if wait < 0:
+        raise HTTPException(status_code=400, detail="wait must not be negative")
+    job = await job_runner.wait(job_id, apikey, min(wait, JOB_MAX_WAIT))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return public_view(job)
+
+@app.post("/api/generate/batch")
+async def generate_batch(
+    request: Request,
+    apikey: str = Query(...),
+    model: str = Query("deepseek/deepseek-r1:free"),
+    worktype: str = Query(""),
+    from_: str = Query("", alias="from"),
+    cache: bool = Query(True),
+    temperature: Optional[float] = Query(None),
+    top_p: Optional[float] = Query(None),
+    max_tokens: Optional[int] = Query(None)
+):
+    key_obj = registry.get_active_key(apikey)
     if not key_obj:
         raise HTTPException(status_code=401, detail="Invalid or inactive API key")
-    # Optionally: log worktype/from_/apikey usage here
     try:
-        response = await client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}]
-        )
-        return {"response": response.choices[0].message.content}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        items = parse_batch_body(await request.body(), BATCH_MAX_ITEMS)
+    except BatchParseError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    defaults = generation_params(temperature=temperature, top_p=top_p, max_tokens=max_tokens)
+    no_cache = wants_no_cache(request)
+
+    async def run_item(index, item):
+        started = time.perf_counter()
+        item_model = item.get("model") if isinstance(item, dict) else model
+        record = new_usage_record(apikey, item_model, worktype, from_, batch=True)
+        record["owner"] = key_obj.get("owner", "")
+        line = await process_item(index, item, record)
+        record["status"] = line["status"]
+        finish_record(record, started)
+        return line
+
+    async def process_item(index, item, record):
+        if not isinstance(item, dict):
+            return {"index": index, "status": 400, "error": "Item must be a prompt string or an object"}
+        line = {"index": index}
+        if "id" in item:
+            line["id"] = item["id"]
+        item_model = item.get("model") or model
+        prompt = item.get("prompt")
+        if not prompt:
+            return {**line, "status": 400, "error": "Prompt cannot be empty"}
+        if not registry.is_model_allowed(item_model):
+            return {**line, "status": 403, "error": f"Model '{item_model}' is not allowed"}
+        messages = [{"role": "user", "content": prompt}]
+        params = {**defaults, **generation_params(
+            temperature=item.get("temperature"), top_p=item.get("top_p"), max_tokens=item.get("max_tokens")
+        )}
+        use_cache = cache and item.get("cache", True) and response_cache.enabled_for(item_model) and not no_cache
+        try:
+            lease = await wait_for_limits(key_obj)
+        except RateLimited as e:
+            return {**line, "status": 429, "error": e.detail, "retry_after": e.retry_after}
+        try:
+            request_key = make_cache_key(item_model, messages, params)
+            result, cache_status = await cache_lookup(request_key, use_cache)
+            if result is None:
+                try:
+                    result = await fetch_completion(request_key, item_model, messages, params, use_cache, key_obj, record)
+                except Overloaded as e:
+                    return {**line, "status": e.status_code, "error": e.detail, "retry_after": e.retry_after}
+                except APITimeoutError:
+                    return {**line, "status": 504, "error": "Upstream did not answer in time"}
+                except NoUpstreamAvailable as e:
+                    return {**line, "status": 503, "error": e.detail, "retry_after": e.retry_after}
+                except Exception as e:
+                    return {**line, "status": 500, "error": str(e)}
+        finally:
+            lease.release()
+        record["cache"] = cache_status
+        add_usage(record, result["usage"])
+        return {**line, "status": 200, "model": result["model"], "response": result["response"], "cache": cache_status}
+
+    async def ndjson():
+        # Per-model semaphores are keyed on the resolved model
+        for item in items:
+            if isinstance(item, dict) and not item.get("model"):
+                item["model"] = model
+        async for line in batch_pool.run(items, run_item):
+            yield json.dumps(line) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
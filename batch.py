@@ -0,0 +1,91 @@
+# Helpers for /api/generate/batch: body parsing and a bounded fan-out pool.
+import asyncio
+import json
+
+
+class BatchParseError(ValueError):
+    pass
+
+
+def parse_batch_body(body, max_items):
+    """Accept a JSON array or JSONL body; each item is a prompt string or an object."""
+    text = body.decode("utf-8").strip()
+    if not text:
+        raise BatchParseError("Batch body is empty")
+    try:
+        if text.startswith("["):
+            items = json.loads(text)
+        else:
+            items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    except ValueError as e:
+        raise BatchParseError(f"Invalid batch body: {e}")
+    if len(items) > max_items:
+        raise BatchParseError(f"Batch has {len(items)} items; the limit is {max_items}")
+    return [{"prompt": item} if isinstance(item, str) else item for item in items]
+
+
+class BatchPool:
+    """Process-wide concurrency limits for batch items, overall and per model.
+
+    Shared across batch requests so several concurrent batches cannot
+    multiply the load sent upstream. Only models passing `is_allowed` get
+    their own limit; items naming anything else share one, so unchecked
+    model names cannot grow the table.
+    """
+
+    def __init__(self, concurrency, per_model, is_allowed=lambda model: True):
+        self.concurrency = concurrency
+        self.per_model = per_model
+        self.is_allowed = is_allowed
+        self._global = asyncio.Semaphore(concurrency)
+        self._models = {}
+        self.active = 0
+        self.completed = 0
+
+    async def _run_one(self, index, item, worker, results):
+        model = item.get("model") if isinstance(item, dict) else None
+        if not isinstance(model, str) or not self.is_allowed(model):
+            model = None
+        model_slot = self._models.get(model)
+        if model_slot is None:
+            model_slot = self._models[model] = asyncio.Semaphore(self.per_model)
+        async with model_slot, self._global:
+            self.active += 1
+            try:
+                result = await worker(index, item)
+            finally:
+                self.active -= 1
+                self.completed += 1
+        results.put_nowait(result)
+
+    async def run(self, items, worker):
+        """Yield `worker(index, item)` results in completion order.
+
+        `worker` is expected to turn per-item failures into result values;
+        anything it raises is reported as a 500 for that item.
+        """
+        results = asyncio.Queue()
+
+        async def guarded(index, item):
+            try:
+                await self._run_one(index, item, worker, results)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                results.put_nowait({"index": index, "status": 500, "error": str(e)})
+
+        tasks = [asyncio.ensure_future(guarded(i, item)) for i, item in enumerate(items)]
+        try:
+            for _ in range(len(tasks)):
+                yield await results.get()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        return {
+            "concurrency": self.concurrency,
+            "per_model": self.per_model,
+            "active": self.active,
+            "completed": self.completed,
+        }
@@ -0,0 +1,77 @@
+# Per-request auth overhead: re-reading the JSON files vs the in-memory registry.
+#
+#   python bench/bench_auth.py
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from registry import Registry  # noqa: E402
+from store import JsonStore  # noqa: E402
+
+MODEL = "deepseek/deepseek-r1:free"
+
+
+def write_files(tmpdir, n_keys):
+    models_file = os.path.join(tmpdir, "allowed_models.json")
+    keys_file = os.path.join(tmpdir, "api_keys.json")
+    with open(models_file, "w") as f:
+        json.dump([MODEL, "openai/gpt-4o-mini"], f)
+    keys = [{"key": f"key-{i}", "owner": f"owner-{i % 50}", "active": True, "note": ""} for i in range(n_keys)]
+    with open(keys_file, "w") as f:
+        json.dump(keys, f)
+    return models_file, keys_file
+
+
+def timed(fn, min_seconds=1.0):
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return elapsed / calls * 1e6, calls
+
+
+def run(n_keys):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        models_file, keys_file = write_files(tmpdir, n_keys)
+
+        def load_models():
+            with open(models_file) as f:
+                return json.load(f)
+
+        def load_api_keys():
+            with open(keys_file) as f:
+                return json.load(f)
+
+        # Worst case for the linear scan: the last key in the file
+        apikey = f"key-{n_keys - 1}"
+
+        def legacy():
+            assert MODEL in set(load_models())
+            keys = load_api_keys()
+            assert next((k for k in keys if k["key"] == apikey and k["active"]), None)
+
+        registry = Registry(JsonStore(models_file, keys_file))
+        asyncio.run(registry.reload())
+
+        def indexed():
+            assert registry.is_model_allowed(MODEL)
+            assert registry.get_active_key(apikey)
+
+        legacy_us, legacy_calls = timed(legacy)
+        indexed_us, indexed_calls = timed(indexed)
+        print(f"{n_keys:>7} keys  legacy {legacy_us:>12.2f} us/req ({legacy_calls} calls)"
+              f"  registry {indexed_us:>8.2f} us/req ({indexed_calls} calls)"
+              f"  speedup {legacy_us / indexed_us:>9.0f}x")
+
+
+if __name__ == "__main__":
+    for n in (10, 100_000):
+        run(n)
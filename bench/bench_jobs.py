@@ -0,0 +1,138 @@
+# End-to-end check of /api/jobs against the mock upstream and bench/webhook_receiver.py.
+#
+# Every job asks for a webhook; half of them are also collected by polling
+# every --poll-interval seconds and half by long-polling. Reports submit
+# latency, how long after a job finished each method noticed, the number of
+# status requests, and webhook attempts (--fail-first makes the receiver
+# refuse the first deliveries so retries are exercised).
+#
+#   python bench/bench_jobs.py [--jobs 40] [--latency 0.5] [--job-workers 4] [--fail-first 1]
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from loadtest import ROOT, free_port, percentile, start_server, stop_server, wait_ready, write_keys  # noqa: E402
+
+
+def summary(values):
+    values = sorted(values)
+    if not values:
+        return "n/a"
+    return f"p50 {percentile(values, 50) * 1000:.0f} ms  p95 {percentile(values, 95) * 1000:.0f} ms" \
+           f"  max {values[-1] * 1000:.0f} ms"
+
+
+async def collect_polling(client, base, key, job_id, interval, counter):
+    while True:
+        counter["polling"] += 1
+        job = (await client.get(f"{base}/api/jobs/{job_id}", params={"apikey": key})).json()
+        if job["status"] in ("succeeded", "failed"):
+            return job, time.time()
+        await asyncio.sleep(interval)
+
+
+async def collect_long_poll(client, base, key, job_id, counter):
+    while True:
+        counter["long_poll"] += 1
+        job = (await client.get(f"{base}/api/jobs/{job_id}", params={"apikey": key, "wait": 30})).json()
+        if job["status"] in ("succeeded", "failed"):
+            return job, time.time()
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="routerai-jobs-")
+    mock_port, receiver_port, port = free_port(), free_port(), free_port()
+    mock = start_server("bench.mock_upstream:app", mock_port,
+                        {**os.environ, "MOCK_CONFIG": json.dumps({"latency": args.latency})},
+                        os.path.join(workdir, "mock.log"))
+    secret = "bench-webhook-secret"
+    receiver = start_server("bench.webhook_receiver:app", receiver_port,
+                            {**os.environ, "RECEIVER_FAIL_FIRST": str(args.fail_first), "RECEIVER_SECRET": secret},
+                            os.path.join(workdir, "receiver.log"))
+    keys_path = os.path.join(workdir, "api_keys.json")
+    key = write_keys(keys_path, 1)[0]
+    with open(keys_path, "w") as f:
+        json.dump([{"key": key, "owner": "bench", "active": True, "note": "", "webhook_secret": secret}], f)
+    env = {
+        "UPSTREAM_PREWARM": "0",
+        **os.environ,
+        "OPENROUTER_BASE_URL": f"http://127.0.0.1:{mock_port}/v1",
+        "OPENROUTER_API_KEY": "bench",
+        "API_KEYS_FILE": os.path.join(workdir, "api_keys.json"),
+        "MODELS_FILE": os.path.join(ROOT, "allowed_models.json"),
+        "FALLBACK_CHAINS_FILE": os.path.join(workdir, "fallback_chains.json"),
+        "USAGE_LOG_FILE": os.path.join(workdir, "requests.jsonl"),
+        "USAGE_ROLLUP_FILE": os.path.join(workdir, "usage_rollups.db"),
+        "STORE_PATH": os.path.join(workdir, "routerai.db"),
+        "TOKEN_LEDGER_PATH": os.path.join(workdir, "token_usage.db"),
+        "SESSION_STORE_PATH": os.path.join(workdir, "sessions.db"),
+        "JOB_STORE_PATH": os.path.join(workdir, "jobs.db"),
+        "JOB_WORKERS": str(args.job_workers),
+        "JOB_WEBHOOK_BACKOFF": str(args.backoff),
+        "JOB_WEBHOOK_ALLOW_NETWORKS": "127.0.0.1",
+    }
+    gateway = start_server("app:app", port, env, os.path.join(workdir, "gateway.log"))
+    base = f"http://127.0.0.1:{port}"
+    receiver_url = f"http://127.0.0.1:{receiver_port}"
+    try:
+        await wait_ready(f"{receiver_url}/deliveries", receiver)
+        await wait_ready(f"http://127.0.0.1:{mock_port}/mock/stats", mock)
+        await wait_ready(f"{base}/metrics", gateway)
+        async with httpx.AsyncClient(timeout=60) as client:
+            submit_times, job_ids = [], []
+            for i in range(args.jobs):
+                t0 = time.perf_counter()
+                r = await client.post(f"{base}/api/jobs", json={
+                    "apikey": key, "prompt": f"job {i}", "cache": False, "webhook_url": f"{receiver_url}/hook"})
+                submit_times.append(time.perf_counter() - t0)
+                r.raise_for_status()
+                job_ids.append(r.json()["id"])
+            counter = {"polling": 0, "long_poll": 0}
+            half = len(job_ids) // 2
+            collected = await asyncio.gather(
+                *(collect_polling(client, base, key, j, args.poll_interval, counter) for j in job_ids[:half]),
+                *(collect_long_poll(client, base, key, j, counter) for j in job_ids[half:]),
+            )
+            finished = {job["id"]: job["finished"] for job, _ in collected}
+            failed = sum(1 for job, _ in collected if job["status"] != "succeeded")
+            # Deliveries lag the job by at most the retry backoff
+            deadline = time.monotonic() + args.backoff * 2 ** args.fail_first + 10
+            while time.monotonic() < deadline:
+                received = (await client.get(f"{receiver_url}/deliveries")).json()
+                if received["count"] >= len(job_ids):
+                    break
+                await asyncio.sleep(0.2)
+        lag = lambda pairs: [max(0.0, seen - finished[job["id"]]) for job, seen in pairs]  # noqa: E731
+        webhook_lag = [d["received"] - finished[d["job"]["id"]] for d in received["deliveries"]]
+        print(f"{args.jobs} jobs, {args.job_workers} job workers, upstream latency {args.latency}s, {failed} failed")
+        print(f"submit:    {summary(submit_times)}")
+        print(f"polling:   noticed {summary(lag(collected[:half]))} after finishing,"
+              f" {counter['polling']} requests for {half} jobs")
+        print(f"long-poll: noticed {summary(lag(collected[half:]))} after finishing,"
+              f" {counter['long_poll']} requests for {len(job_ids) - half} jobs")
+        print(f"webhook:   {received['count']}/{len(job_ids)} delivered, {summary(webhook_lag)} after finishing,"
+              f" {sum(received['attempts'].values())} attempts, {received['bad_signatures']} bad signatures")
+    finally:
+        stop_server(gateway)
+        stop_server(receiver)
+        stop_server(mock)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--job-workers", type=int, default=4)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--fail-first", type=int, default=1)
+    parser.add_argument("--backoff", type=float, default=0.5)
+    args = parser.parse_args()
+    asyncio.run(run(args))
@@ -0,0 +1,45 @@
+# Cost of recording one request's metrics (what finish_record adds to the hot path).
+#
+#   python bench/bench_metrics.py [--requests 200000] [--series 500]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from metrics import OVERHEAD_BUCKETS, MetricSet  # noqa: E402
+
+
+def run(n, n_series):
+    metrics = MetricSet()
+    labels = ("model", "owner", "status", "worktype")
+    total = metrics.histogram("total_seconds", "t", labels)
+    waited = metrics.histogram("upstream_seconds", "u", labels)
+    overhead = metrics.histogram("overhead_seconds", "o", labels, buckets=OVERHEAD_BUCKETS)
+    cache = metrics.counter("cache_total", "c", ("model", "result"))
+    in_flight = metrics.gauge("in_flight", "i", ("model",))
+    series = [(f"model-{i % 20}", f"owner-{i}", "200", f"wt-{i % 7}") for i in range(n_series)]
+    samples = [(random.choice(series), random.lognormvariate(0, 1), random.random() / 1000) for _ in range(n)]
+    t0 = time.perf_counter()
+    for label_values, upstream, gateway in samples:
+        in_flight.inc(label_values[0])
+        total.observe(upstream + gateway, *label_values)
+        waited.observe(upstream, *label_values)
+        overhead.observe(gateway, *label_values)
+        cache.inc(label_values[0], "MISS")
+        in_flight.dec(label_values[0])
+    elapsed = time.perf_counter() - t0
+    print(f"{n} requests, {n_series} label sets: {elapsed / n * 1e6:.2f} us per request ({n / elapsed:,.0f} req/s)")
+    t0 = time.perf_counter()
+    body = metrics.render()
+    print(f"render: {(time.perf_counter() - t0) * 1000:.1f} ms, {len(body) / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200_000)
+    parser.add_argument("--series", type=int, default=500)
+    args = parser.parse_args()
+    run(args.requests, args.series)
@@ -0,0 +1,84 @@
+# Near-duplicate cache: lookup cost and how often templated prompt variants are matched.
+#
+#   python bench/bench_nearcache.py [--entries 2048] [--lookups 2000] [--threshold 0.9]
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from nearcache import NearDuplicateCache, normalize, shingles  # noqa: E402
+
+TEMPLATE = ("Summarize the following support ticket in two sentences and tag it by urgency. "
+            "Customer {name} reports that the {device} on floor {floor} {problem} since {day}.")
+NAMES = ["Ana", "Bo", "Chen", "Dara", "Eli", "Femi", "Gus", "Hana"]
+DEVICES = ["printer", "scanner", "projector", "badge reader", "coffee machine"]
+PROBLEMS = ["keeps jamming", "shows an error light", "does not power on", "is very slow"]
+DAYS = ["Monday", "Tuesday", "Wednesday", "last week"]
+
+
+def prompt(rng):
+    return TEMPLATE.format(name=rng.choice(NAMES), device=rng.choice(DEVICES), floor=rng.randint(1, 9),
+                           problem=rng.choice(PROBLEMS), day=rng.choice(DAYS))
+
+
+def vary(rng, text):
+    # Same request with different casing and spacing, sometimes with a word changed
+    text = text.upper() if rng.random() < 0.3 else text
+    text = text.replace(" ", "  ") if rng.random() < 0.3 else text
+    if rng.random() < 0.5:
+        words = text.split(" ")
+        words[rng.randrange(len(words))] = "please"
+        text = " ".join(words)
+    return text
+
+
+def jaccard(a, b):
+    a, b = shingles(normalize(a), 5), shingles(normalize(b), 5)
+    return len(a & b) / len(a | b)
+
+
+def run(n_entries, n_lookups, threshold):
+    rng = random.Random(7)
+    cache = NearDuplicateCache(threshold=threshold, max_entries=n_entries)
+    stored = [prompt(rng) for _ in range(n_entries)]
+    t0 = time.perf_counter()
+    for i, text in enumerate(stored):
+        cache.set("model", {}, cache.signature(text), {"response": i})
+    print(f"indexed {n_entries} prompts in {(time.perf_counter() - t0) * 1000:.0f} ms")
+    samples, signing = [], []
+    hits = true_matches = false_hits = 0
+    for _ in range(n_lookups):
+        original = rng.choice(stored)
+        query = vary(rng, original)
+        t0 = time.perf_counter_ns()
+        signature = cache.signature(query)
+        t1 = time.perf_counter_ns()
+        found = cache.get("model", {}, signature)
+        signing.append(t1 - t0)
+        samples.append(time.perf_counter_ns() - t1)
+        above = jaccard(original, query) >= threshold
+        true_matches += above
+        if found is not None:
+            hits += 1
+            false_hits += jaccard(stored[found[0]["response"]], query) < threshold
+    samples.sort()
+    signing.sort()
+    print(f"{n_lookups} lookups: signature mean {statistics.fmean(signing) / 1000:.0f} us"
+          f"  p99 {signing[int(len(signing) * 0.99)] / 1000:.0f} us (off the event loop in the app);"
+          f" get mean {statistics.fmean(samples) / 1000:.0f} us  p99 {samples[int(len(samples) * 0.99)] / 1000:.0f} us")
+    print(f"hits {hits}, queries with a stored prompt above the threshold {true_matches},"
+          f" hits below the threshold {false_hits}")
+    print(cache.stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=2048)
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--threshold", type=float, default=0.9)
+    args = parser.parse_args()
+    run(args.entries, args.lookups, args.threshold)
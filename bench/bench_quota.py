@@ -0,0 +1,68 @@
+# Cost of the token budget check and usage recording on the request path, and of one batched flush.
+#
+#   python bench/bench_quota.py [--keys 10000] [--requests 200000] [--models 4]
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from quota import TokenLedger  # noqa: E402
+from ratelimit import RateLimited  # noqa: E402
+
+
+def percentile(sorted_values, pct):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+async def run(n_keys, n_requests, n_models):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # A long flush interval so the background task stays out of the timings
+        ledger = TokenLedger(os.path.join(tmpdir, "token_usage.db"), flush_interval=3600)
+        keys = [{"key": f"key-{i}", "daily_token_budget": 10_000_000, "monthly_token_budget": 100_000_000}
+                for i in range(n_keys)]
+        models = [f"model-{i}" for i in range(n_models)]
+        usage = {"prompt_tokens": 40, "completion_tokens": 60, "total_tokens": 100}
+        samples = []
+        rejected = 0
+        for i in range(n_requests):
+            key_obj = random.choice(keys)
+            t0 = time.perf_counter_ns()
+            try:
+                ledger.check(key_obj)
+                ledger.record(key_obj["key"], random.choice(models), usage)
+            except RateLimited:
+                rejected += 1
+            samples.append(time.perf_counter_ns() - t0)
+        samples.sort()
+        print(f"{n_requests} requests, {n_keys} keys, {n_models} models, {rejected} rejected")
+        print(f"check + record per request: mean {statistics.fmean(samples) / 1000:.2f} us"
+              f"  p50 {percentile(samples, 50) / 1000:.2f} us  p99 {percentile(samples, 99) / 1000:.2f} us"
+              f"  max {samples[-1] / 1000:.2f} us")
+        t0 = time.perf_counter()
+        rows = await ledger.flush()
+        print(f"flush: {rows} rows in {(time.perf_counter() - t0) * 1000:.1f} ms")
+        # Second round hits existing rows, so every row is an update
+        for i in range(n_requests // 10):
+            ledger.record(random.choice(keys)["key"], random.choice(models), usage)
+        t0 = time.perf_counter()
+        rows = await ledger.flush()
+        print(f"flush (updates): {rows} rows in {(time.perf_counter() - t0) * 1000:.1f} ms")
+        t0 = time.perf_counter()
+        ledger.usage(granularity="month")
+        print(f"monthly usage query over all keys: {(time.perf_counter() - t0) * 1000:.1f} ms")
+        ledger.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--models", type=int, default=4)
+    args = parser.parse_args()
+    asyncio.run(run(args.keys, args.requests, args.models))
@@ -0,0 +1,70 @@
+# Cost of the per-key limiter on the request path, paced at a target request rate.
+#
+#   python bench/bench_ratelimit.py [--rate 5000] [--seconds 5] [--keys 10000]
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ratelimit import RateLimited, RateLimiter  # noqa: E402
+
+
+def percentile(sorted_values, pct):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+async def run(rate, seconds, n_keys):
+    limiter = RateLimiter()
+    keys = [
+        {"key": f"key-{i}", "rate_limit_rpm": 600, "max_concurrency": 8}
+        for i in range(n_keys)
+    ]
+    samples = []
+    rejected = 0
+    interval = 1.0 / rate
+    total = int(rate * seconds)
+    start = time.perf_counter()
+    for i in range(total):
+        key_obj = random.choice(keys)
+        t0 = time.perf_counter_ns()
+        try:
+            lease = limiter.acquire(key_obj)
+            lease.release()
+        except RateLimited:
+            rejected += 1
+        samples.append(time.perf_counter_ns() - t0)
+        # Pace to the target rate the way a live event loop would see requests arrive
+        delay = start + (i + 1) * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    elapsed = time.perf_counter() - start
+    samples.sort()
+    print(f"{total} requests over {elapsed:.2f}s ({total / elapsed:.0f} req/s, target {rate}), {n_keys} keys, {rejected} rejected")
+    print(f"limiter cost per request: mean {statistics.fmean(samples) / 1000:.2f} us"
+          f"  p50 {percentile(samples, 50) / 1000:.2f} us  p99 {percentile(samples, 99) / 1000:.2f} us"
+          f"  max {samples[-1] / 1000:.2f} us")
+    budget_us = 1e6 / rate
+    print(f"share of the per-request time budget at {rate} req/s: {statistics.fmean(samples) / 1000 / budget_us * 100:.3f}%")
+    # Unpaced: how many checks per second a single worker can sustain
+    n = 200_000
+    t0 = time.perf_counter()
+    for i in range(n):
+        try:
+            limiter.acquire(keys[i % n_keys]).release()
+        except RateLimited:
+            pass
+    print(f"unpaced throughput: {n / (time.perf_counter() - t0):,.0f} checks/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=int, default=5000)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--keys", type=int, default=10000)
+    args = parser.parse_args()
+    asyncio.run(run(args.rate, args.seconds, args.keys))
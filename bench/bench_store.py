@@ -0,0 +1,55 @@
+# Cost of one admin write (add, update, delete a key) per store backend and key-list size.
+#
+#   python bench/bench_store.py [--keys 10,10000,100000] [--ops 20]
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from store import JsonStore, SqliteStore, import_json  # noqa: E402
+
+
+def seed(tmpdir, n_keys):
+    models_file = os.path.join(tmpdir, "allowed_models.json")
+    keys_file = os.path.join(tmpdir, "api_keys.json")
+    with open(models_file, "w") as f:
+        json.dump(["deepseek/deepseek-r1:free"], f)
+    with open(keys_file, "w") as f:
+        json.dump([{"key": f"key-{i}", "owner": f"owner-{i % 50}", "active": True, "note": ""}
+                   for i in range(n_keys)], f)
+    return models_file, keys_file
+
+
+def timed_ms(fn, ops):
+    start = time.perf_counter()
+    for i in range(ops):
+        fn(i)
+    return (time.perf_counter() - start) / ops * 1000
+
+
+def run(n_keys, ops):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        models_file, keys_file = seed(tmpdir, n_keys)
+        sqlite_store = SqliteStore(os.path.join(tmpdir, "routerai.db"))
+        import_json(sqlite_store, models_file, keys_file)
+        for store in (JsonStore(models_file, keys_file), sqlite_store):
+            add = timed_ms(lambda i: store.add_key({"key": f"new-{i}", "owner": "bench", "active": True, "note": ""}), ops)
+            update = timed_ms(lambda i: store.update_key(f"new-{i}", {"active": False}), ops)
+            remove = timed_ms(lambda i: store.remove_key(f"new-{i}"), ops)
+            lookup = timed_ms(lambda i: store.get_key(f"key-{n_keys - 1}"), ops)
+            print(f"{n_keys:>7} keys  {store.backend:<6}  add {add:>8.3f} ms  update {update:>8.3f} ms"
+                  f"  delete {remove:>8.3f} ms  lookup {lookup:>8.3f} ms")
+        sqlite_store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keys", default="10,10000,100000")
+    parser.add_argument("--ops", type=int, default=20)
+    args = parser.parse_args()
+    for n in args.keys.split(","):
+        run(int(n), args.ops)
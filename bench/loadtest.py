@@ -0,0 +1,309 @@
+# Load driver: req/s and latency percentiles for /api/generate and the admin endpoints.
+#
+# Starts bench/mock_upstream.py and the gateway (one per key-list size, with a
+# generated api_keys.json), drives each scenario at each concurrency for a
+# fixed time, and saves the results as bench/results/<commit>.json.
+#
+#   python bench/loadtest.py run --concurrency 1,16,64 --keys 10,10000 --duration 5
+#   python bench/loadtest.py run --mock-config '{"latency": {"dist": "lognormal", "median": 0.2, "sigma": 0.5}}'
+#   python bench/loadtest.py run --workers 1,2,4 --mock-workers 4 --scenarios generate
+#   python bench/loadtest.py compare bench/results/abc1234.json bench/results/def5678.json
+#
+# --workers runs the gateway with each number of uvicorn worker processes, to
+# check throughput scaling; the mock needs enough workers not to be the limit.
+#
+# Extra environment variables (e.g. UPSTREAM_MAX_CONNECTIONS) are passed on to the gateway.
+# Errors injected by the mock are not retried; they fail over along the fallback chain.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+SCENARIOS = ("generate", "stream", "admin_keys", "admin_models", "admin_stats")
+MODEL = "deepseek/deepseek-r1:free"
+ADMIN_PASSWORD = "admin123"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+def write_keys(path, n_keys):
+    keys = [{"key": f"bench-key-{i}", "owner": f"owner-{i % 100}", "active": True, "note": "load test"}
+            for i in range(n_keys)]
+    with open(path, "w") as f:
+        json.dump(keys, f)
+    return [k["key"] for k in keys]
+
+
+def start_server(module, port, env, log_path, workers=1):
+    log = open(log_path, "w")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", module, "--port", str(port), "--log-level", "warning",
+         "--workers", str(workers)],
+        cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+
+
+async def wait_ready(url, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"server for {url} exited with {proc.returncode}")
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+class Scenario:
+    def __init__(self, name, keys, cache):
+        self.name = name
+        self.keys = keys
+        self.cache = cache
+        self.counter = 0
+
+    def request(self):
+        if self.name in ("generate", "stream"):
+            self.counter += 1
+            params = {
+                "apikey": random.choice(self.keys),
+                "model": MODEL,
+                "prompt": "load test" if self.cache else f"load test {self.counter}",
+                "worktype": "bench",
+            }
+            if not self.cache:
+                params["cache"] = "false"
+            if self.name == "stream":
+                params["stream"] = "true"
+            return "POST", "/api/generate", params
+        path = {"admin_keys": "/admin/api-keys", "admin_models": "/admin/models", "admin_stats": "/admin/stats"}
+        return "GET", path[self.name], None
+
+
+async def drive(base_url, scenario, concurrency, duration, warmup):
+    # Requests started during the measured window count, even if they finish after it
+    latencies = []
+    errors = 0
+    last_finish = 0.0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        if scenario.name.startswith("admin"):
+            await client.post("/admin/login", data={"password": ADMIN_PASSWORD})
+        start = time.perf_counter()
+        measure_from = start + warmup
+        deadline = measure_from + duration
+
+        async def worker():
+            nonlocal errors, last_finish
+            while True:
+                t0 = time.perf_counter()
+                if t0 >= deadline:
+                    return
+                method, path, params = scenario.request()
+                try:
+                    async with client.stream(method, path, params=params) as response:
+                        await response.aread()
+                        ok = response.status_code < 400 and b"event: error" not in response.content
+                except httpx.HTTPError:
+                    ok = False
+                t1 = time.perf_counter()
+                if t0 < measure_from:
+                    continue
+                latencies.append(t1 - t0)
+                last_finish = max(last_finish, t1)
+                if not ok:
+                    errors += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 2) if v is not None else None  # noqa: E731
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / max(duration, last_finish - measure_from), 1),
+        "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "max_ms": ms(latencies[-1]) if latencies else None,
+    }
+
+
+def print_row(row):
+    print(f"{row['scenario']:<13} {row['keys']:>7} {row['workers']:>7} {row['concurrency']:>5} {row['rps']:>9}"
+          f" {row['errors']:>6} {row['p50_ms']!s:>9} {row['p95_ms']!s:>9} {row['p99_ms']!s:>9}")
+
+
+async def run(args):
+    scenarios = args.scenarios.split(",")
+    for name in scenarios:
+        if name not in SCENARIOS:
+            raise SystemExit(f"unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+    concurrencies = [int(c) for c in args.concurrency.split(",")]
+    key_counts = [int(k) for k in args.keys.split(",")]
+    worker_counts = [int(w) for w in args.workers.split(",")]
+    workdir = tempfile.mkdtemp(prefix="routerai-bench-")
+    mock_port = free_port()
+    mock_env = {**os.environ, "MOCK_CONFIG": args.mock_config}
+    mock = start_server("bench.mock_upstream:app", mock_port, mock_env, os.path.join(workdir, "mock.log"),
+                        workers=args.mock_workers)
+    rows = []
+    print(f"{'scenario':<13} {'keys':>7} {'workers':>7} {'conc':>5} {'req/s':>9} {'errors':>6}"
+          f" {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    try:
+        await wait_ready(f"http://127.0.0.1:{mock_port}/mock/stats", mock)
+        for n_keys, workers in [(k, w) for k in key_counts for w in worker_counts]:
+            keys = write_keys(os.path.join(workdir, "api_keys.json"), n_keys)
+            port = free_port()
+            env = {
+                "UPSTREAM_PREWARM": "0",
+                **os.environ,
+                "OPENROUTER_BASE_URL": f"http://127.0.0.1:{mock_port}/v1",
+                "OPENROUTER_API_KEY": "bench",
+                "API_KEYS_FILE": os.path.join(workdir, "api_keys.json"),
+                "MODELS_FILE": os.path.join(ROOT, "allowed_models.json"),
+                "FALLBACK_CHAINS_FILE": os.path.join(workdir, "fallback_chains.json"),
+                "USAGE_LOG_FILE": os.path.join(workdir, "requests.jsonl"),
+                "USAGE_ROLLUP_FILE": os.path.join(workdir, "usage_rollups.db"),
+                "STORE_PATH": os.path.join(workdir, f"routerai-{n_keys}-{workers}.db"),
+                "TOKEN_LEDGER_PATH": os.path.join(workdir, f"token_usage-{n_keys}-{workers}.db"),
+                "SESSION_STORE_PATH": os.path.join(workdir, f"sessions-{n_keys}-{workers}.db"),
+                "JOB_STORE_PATH": os.path.join(workdir, f"jobs-{n_keys}-{workers}.db"),
+                "WEB_CONCURRENCY": str(workers),
+                "SHARED_STATE_DIR": os.path.join(workdir, f"shared-{n_keys}-{workers}") if workers > 1 else "",
+            }
+            gateway = start_server("app:app", port, env, os.path.join(workdir, f"gateway-{n_keys}-{workers}.log"),
+                                   workers=workers)
+            try:
+                await wait_ready(f"http://127.0.0.1:{port}/metrics", gateway)
+                for name in scenarios:
+                    for concurrency in concurrencies:
+                        result = await drive(f"http://127.0.0.1:{port}", Scenario(name, keys, args.cache),
+                                             concurrency, args.duration, args.warmup)
+                        row = {"scenario": name, "keys": n_keys, "workers": workers, "concurrency": concurrency,
+                               **result}
+                        rows.append(row)
+                        print_row(row)
+            finally:
+                stop_server(gateway)
+    finally:
+        stop_server(mock)
+    commit = git_commit()
+    results = {
+        "commit": commit,
+        "label": args.label,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": {"duration": args.duration, "warmup": args.warmup, "cache": args.cache,
+                     "mock_workers": args.mock_workers,
+                     "mock_config": json.loads(args.mock_config)},
+        "rows": rows,
+    }
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"{commit}{'-' + args.label if args.label else ''}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"saved {path} (logs in {workdir})")
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"base {base['commit']} ({base['created']})  vs  new {new['commit']} ({new['created']})")
+    print(f"{'scenario':<13} {'keys':>7} {'workers':>7} {'conc':>5} {'req/s':>21} {'p95 ms':>23} {'p99 ms':>23}")
+    row_id = lambda r: (r["scenario"], r["keys"], r.get("workers", 1), r["concurrency"])  # noqa: E731
+    indexed = {row_id(r): r for r in base["rows"]}
+    regressions = 0
+
+    def delta(old, value, higher_is_better):
+        if not old or value is None:
+            return f"{value!s:>21}", False
+        change = (value - old) / old * 100
+        worse = -change if higher_is_better else change
+        return f"{old:>8} -> {value:<8} {change:+5.0f}%", worse > args.threshold
+
+    for row in new["rows"]:
+        old = indexed.get(row_id(row))
+        if old is None:
+            continue
+        rps, rps_bad = delta(old["rps"], row["rps"], True)
+        p95, p95_bad = delta(old["p95_ms"], row["p95_ms"], False)
+        p99, _ = delta(old["p99_ms"], row["p99_ms"], False)
+        flag = "  REGRESSION" if rps_bad or p95_bad else ""
+        regressions += bool(flag)
+        print(f"{row['scenario']:<13} {row['keys']:>7} {row.get('workers', 1):>7} {row['concurrency']:>5}"
+              f" {rps} {p95} {p99}{flag}")
+    print(f"{regressions} regression(s) beyond {args.threshold}%")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    run_parser.add_argument("--concurrency", default="1,16,64")
+    run_parser.add_argument("--keys", default="10,10000")
+    run_parser.add_argument("--workers", default="1", help="gateway worker counts, e.g. 1,2,4")
+    run_parser.add_argument("--mock-workers", type=int, default=1)
+    run_parser.add_argument("--duration", type=float, default=5)
+    run_parser.add_argument("--warmup", type=float, default=1)
+    run_parser.add_argument("--cache", action="store_true", help="repeat one prompt so the response cache is hit")
+    run_parser.add_argument("--mock-config", default='{"latency": 0.05}')
+    run_parser.add_argument("--label", default="")
+    run_parser.add_argument("--out", default=RESULTS_DIR)
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=10, help="percent change flagged as a regression")
+    args = parser.parse_args()
+    if args.command == "run":
+        asyncio.run(run(args))
+    else:
+        sys.exit(compare(args))
@@ -0,0 +1,193 @@
+# Local OpenAI-compatible stand-in for OpenRouter, for fallback and load testing.
+#
+#   uvicorn bench.mock_upstream:app --port 9100
+#   OPENROUTER_BASE_URL=http://127.0.0.1:9100/v1 uvicorn app:app
+#
+# Behaviour can be changed at runtime, e.g. to make one model fail:
+#   curl -X POST localhost:9100/mock/config -H 'Content-Type: application/json' \
+#        -d '{"models": {"deepseek/deepseek-r1:free": {"status": 503}}}'
+#
+# or to draw latencies from a distribution, stream 40 tokens/s and fail 1% of calls:
+#   -d '{"latency": {"dist": "lognormal", "median": 0.3, "sigma": 0.6},
+#        "tokens_per_second": 40, "completion_tokens": 64, "error_rate": 0.01}'
+#
+# MOCK_CONFIG may hold the same JSON to set the initial configuration.
+import asyncio
+import json
+import os
+import random
+import time
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI()
+
+DEFAULTS = {
+    # Seconds before the response starts: a number, or {"dist": ..., params} (see sample_latency)
+    "latency": 0.05,
+    # Pace of streamed (and, in total, non-streamed) completion tokens; 0 means as fast as possible
+    "tokens_per_second": 0,
+    # Filler tokens appended to the echoed prompt
+    "completion_tokens": 0,
+    # Always answer with this status
+    "status": None,
+    # Probability of answering with error_status instead
+    "error_rate": 0.0,
+    "error_status": 503,
+    # Probability of not answering for hang_seconds (client timeouts)
+    "hang_rate": 0.0,
+    "hang_seconds": 300,
+    # Probability of cutting a stream off halfway
+    "stream_abort_rate": 0.0,
+}
+
+# Per-model entries in "models" override the top-level settings
+config = {**DEFAULTS, "models": {}, "seed": None}
+counters = {}
+rng = random.Random()
+
+
+def reset_counters():
+    counters.clear()
+    counters.update({"requests": 0, "by_model": {}, "errors_injected": 0, "hangs": 0, "aborts": 0,
+                     "in_flight": 0, "max_in_flight": 0})
+
+
+def apply_config(data):
+    for field in DEFAULTS:
+        if field in data:
+            config[field] = data[field]
+    if "models" in data:
+        config["models"] = data["models"]
+    if "seed" in data:
+        config["seed"] = data["seed"]
+        rng.seed(data["seed"])
+
+
+def sample_latency(spec):
+    if not isinstance(spec, dict):
+        return float(spec or 0)
+    dist = spec.get("dist", "fixed")
+    if dist == "fixed":
+        value = spec.get("value", 0)
+    elif dist == "uniform":
+        value = rng.uniform(spec.get("low", 0), spec.get("high", 0))
+    elif dist == "normal":
+        value = rng.gauss(spec.get("mean", 0), spec.get("stddev", 0))
+    elif dist == "lognormal":
+        value = spec.get("median", 0) * rng.lognormvariate(0, spec.get("sigma", 0))
+    elif dist == "exponential":
+        value = rng.expovariate(1 / spec["mean"]) if spec.get("mean") else 0
+    else:
+        raise ValueError(f"unknown latency distribution {dist!r}")
+    return max(0.0, value)
+
+
+def model_config(model):
+    settings = {k: config[k] for k in DEFAULTS}
+    settings.update(config["models"].get(model, {}))
+    return settings
+
+
+def completion_words(model, prompt, filler):
+    return f"[{model}] {prompt}".split(" ") + [f"tok{i}" for i in range(filler)]
+
+
+def usage_for(prompt, words):
+    prompt_tokens = max(1, len(prompt) // 4)
+    completion_tokens = max(1, len(words))
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+@app.post("/mock/config")
+async def set_config(data: dict):
+    try:
+        for spec in [data.get("latency")] + [m.get("latency") for m in (data.get("models") or {}).values()]:
+            sample_latency(spec)
+    except (ValueError, TypeError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    apply_config(data)
+    return config
+
+
+@app.get("/mock/stats")
+async def get_stats():
+    return counters
+
+
+@app.post("/mock/reset")
+async def reset():
+    reset_counters()
+    return counters
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"data": [{"id": m, "object": "model"} for m in config["models"]]}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "")
+    counters["requests"] += 1
+    counters["by_model"][model] = counters["by_model"].get(model, 0) + 1
+    settings = model_config(model)
+    counters["in_flight"] += 1
+    counters["max_in_flight"] = max(counters["max_in_flight"], counters["in_flight"])
+    try:
+        if settings["hang_rate"] and rng.random() < settings["hang_rate"]:
+            counters["hangs"] += 1
+            await asyncio.sleep(settings["hang_seconds"])
+        await asyncio.sleep(sample_latency(settings["latency"]))
+    finally:
+        counters["in_flight"] -= 1
+    status = settings["status"]
+    if not status and settings["error_rate"] and rng.random() < settings["error_rate"]:
+        counters["errors_injected"] += 1
+        status = settings["error_status"]
+    if status:
+        return JSONResponse({"error": {"message": f"mock failure for {model}", "code": status}},
+                            status_code=status)
+    prompt = body["messages"][-1]["content"] if body.get("messages") else ""
+    words = completion_words(model, prompt, settings["completion_tokens"])
+    usage = usage_for(prompt, words)
+    created = int(time.time())
+    delay = 1 / settings["tokens_per_second"] if settings["tokens_per_second"] else 0
+    if not body.get("stream"):
+        await asyncio.sleep(delay * len(words))
+        return {
+            "id": "mock-1", "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)},
+                         "finish_reason": "stop"}],
+            "usage": usage,
+        }
+    abort_at = len(words) // 2 if settings["stream_abort_rate"] and rng.random() < settings["stream_abort_rate"] else None
+
+    async def events():
+        for i, word in enumerate(words):
+            if i == abort_at:
+                counters["aborts"] += 1
+                raise RuntimeError("mock stream aborted")
+            if delay and i:
+                await asyncio.sleep(delay)
+            chunk = {"id": "mock-1", "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+        chunk = {"id": "mock-1", "object": "chat.completion.chunk", "created": created, "model": model,
+                 "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        yield f"data: {json.dumps(chunk)}\n\n"
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunk = {"id": "mock-1", "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [], "usage": usage}
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+reset_counters()
+if os.getenv("MOCK_CONFIG"):
+    apply_config(json.loads(os.getenv("MOCK_CONFIG")))
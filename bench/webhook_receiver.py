@@ -0,0 +1,68 @@
+# Local webhook endpoint for testing /api/jobs callbacks.
+#
+#   uvicorn bench.webhook_receiver:app --port 9200
+#   curl -X POST localhost:8000/api/jobs -H 'Content-Type: application/json' \
+#        -d '{"apikey": "...", "prompt": "hi", "webhook_url": "http://127.0.0.1:9200/hook"}'
+#   curl localhost:9200/deliveries
+#
+# With RECEIVER_SECRET set to the key's webhook_secret, deliveries with a wrong
+# X-RouterAI-Signature are refused with 401 and counted.
+#
+# To exercise retries, fail the first N attempts for every job:
+#   curl -X POST localhost:9200/receiver/config -H 'Content-Type: application/json' -d '{"fail_first": 2}'
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+app = FastAPI()
+
+config = {"fail_first": int(os.getenv("RECEIVER_FAIL_FIRST", "0")), "fail_status": 503}
+attempts = {}
+deliveries = []
+bad_signatures = 0
+secret = os.getenv("RECEIVER_SECRET", "")
+
+
+@app.post("/receiver/config")
+async def set_config(data: dict):
+    config.update({k: data[k] for k in config if k in data})
+    return config
+
+
+@app.post("/receiver/reset")
+async def reset():
+    global bad_signatures
+    attempts.clear()
+    deliveries.clear()
+    bad_signatures = 0
+    return {"success": True}
+
+
+@app.post("/hook")
+async def hook(request: Request):
+    global bad_signatures
+    raw = await request.body()
+    if secret:
+        timestamp = request.headers.get("X-RouterAI-Timestamp", "")
+        expected = "sha256=" + hmac.new(secret.encode(), f"{timestamp}.".encode() + raw, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, request.headers.get("X-RouterAI-Signature", "")):
+            bad_signatures += 1
+            return JSONResponse({"error": "bad signature"}, status_code=401)
+    body = json.loads(raw)
+    job_id = body.get("id")
+    attempts[job_id] = attempts.get(job_id, 0) + 1
+    if attempts[job_id] <= config["fail_first"]:
+        return JSONResponse({"error": "injected failure"}, status_code=config["fail_status"])
+    deliveries.append({"received": time.time(), "attempt": attempts[job_id], "job": body})
+    return {"success": True}
+
+
+@app.get("/deliveries")
+async def get_deliveries():
+    return {"count": len(deliveries), "attempts": attempts, "bad_signatures": bad_signatures,
+            "deliveries": deliveries}
@@ -0,0 +1,155 @@
+# Exact-match response cache: bounded in-memory LRU with TTL and an optional disk tier.
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+
+def make_cache_key(model, messages, params):
+    canonical = json.dumps(
+        {"model": model, "messages": messages, "params": params},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LRU of completed responses keyed by `make_cache_key`.
+
+    Entries expire `ttl` seconds after being stored. When `disk_dir` is set,
+    entries are also written there (one JSON file per key) so they survive
+    restarts; disk access always happens off the event loop.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, disk_dir=None, disabled_models=()):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir or None
+        self.disabled_models = set(disabled_models)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def enabled_for(self, model):
+        return self.max_entries > 0 and model not in self.disabled_models
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".json")
+
+    def _get_memory(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, model, value = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _put_memory(self, key, model, value, expires_at):
+        self._entries[key] = (expires_at, model, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _read_disk(self, key):
+        try:
+            with open(self._path(key), "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if entry["expires_at"] < time.time():
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            return None
+        return entry
+
+    def _write_disk(self, key, model, value, expires_at):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"expires_at": expires_at, "model": model, "value": value}, f)
+        os.replace(tmp, path)
+
+    async def get(self, key):
+        value = self._get_memory(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if self.disk_dir:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None:
+                self.disk_hits += 1
+                self._put_memory(key, entry["model"], entry["value"], entry["expires_at"])
+                return entry["value"]
+        self.misses += 1
+        return None
+
+    async def set(self, key, model, value):
+        expires_at = time.time() + self.ttl
+        self._put_memory(key, model, value, expires_at)
+        if self.disk_dir:
+            await asyncio.to_thread(self._write_disk, key, model, value, expires_at)
+
+    def _purge_disk(self, model):
+        removed = 0
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if model is not None:
+                    try:
+                        with open(path, "r") as f:
+                            if json.load(f).get("model") != model:
+                                continue
+                    except (FileNotFoundError, ValueError):
+                        pass
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    async def purge(self, model=None, disk=True):
+        if model is None:
+            removed = len(self._entries)
+            self._entries.clear()
+        else:
+            keys = [k for k, (_, m, _) in self._entries.items() if m == model]
+            for k in keys:
+                del self._entries[k]
+            removed = len(keys)
+        disk_removed = 0
+        if disk and self.disk_dir:
+            disk_removed = await asyncio.to_thread(self._purge_disk, model)
+        return {"memory": removed, "disk": disk_removed}
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "disk_dir": self.disk_dir,
+            "disabled_models": sorted(self.disabled_models),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,97 @@
+# Stop upstream work nobody is waiting for: client disconnects, request deadlines and saved-work counters.
+import asyncio
+from contextlib import aclosing
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class RequestTimeout(Exception):
+    pass
+
+
+async def wait_for_disconnect(receive):
+    # The request body has been read (or is empty), so the next message only comes when the client leaves
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def run_cancellable(coro, receive, timeout=None):
+    """Await `coro` unless the client disconnects or `timeout` seconds pass first.
+
+    In those cases `coro` is cancelled and ClientDisconnected or
+    RequestTimeout is raised instead.
+    """
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        done, _ = await asyncio.wait({task, watcher}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+    if task in done:
+        return task.result()
+    try:
+        await task
+    except BaseException:
+        pass
+    if watcher in done:
+        raise ClientDisconnected()
+    raise RequestTimeout()
+
+
+async def with_deadline(events, timeout, on_timeout):
+    """Relay `events` for at most `timeout` seconds, then yield `on_timeout()` and stop."""
+    loop = asyncio.get_running_loop()
+    end = loop.time() + timeout
+    async with aclosing(events):
+        while True:
+            try:
+                event = await asyncio.wait_for(events.__anext__(), max(0.0, end - loop.time()))
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                yield on_timeout()
+                return
+            yield event
+
+
+class WorkTracker:
+    """Counts abandoned requests and the upstream calls cancelled because of them.
+
+    A moving average of how long completed calls take, per model and
+    streaming or not, estimates the upstream time each cancellation saved.
+    """
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self._durations = {}
+        self.abandoned = {"disconnect": 0, "timeout": 0}
+        self.cancelled_calls = 0
+        self.seconds_spent = 0.0
+        self.seconds_saved = 0.0
+
+    def completed(self, model, stream, seconds):
+        previous = self._durations.get((model, stream))
+        self._durations[(model, stream)] = seconds if previous is None else (
+            (1 - self.alpha) * previous + self.alpha * seconds)
+
+    def cancelled(self, model, stream, seconds):
+        self.cancelled_calls += 1
+        self.seconds_spent += seconds
+        expected = self._durations.get((model, stream))
+        if expected is not None:
+            self.seconds_saved += max(0.0, expected - seconds)
+
+    def abandon(self, reason):
+        self.abandoned[reason] += 1
+
+    def stats(self):
+        return {
+            "abandoned_requests": dict(self.abandoned),
+            "cancelled_upstream_calls": self.cancelled_calls,
+            "upstream_seconds_before_cancel": round(self.seconds_spent, 3),
+            "upstream_seconds_saved_estimate": round(self.seconds_saved, 3),
+        }
@@ -0,0 +1,208 @@
+# Model fallback chains with per-model circuit breakers and latency/success-aware ordering.
+import asyncio
+import time
+
+import openai
+
+
+class NoUpstreamAvailable(Exception):
+    def __init__(self, detail, retry_after):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def is_retryable(error):
+    """Errors worth trying another model for: timeouts, connection failures, 429 and 5xx."""
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` failures within `window` seconds.
+
+    While open, calls are refused for `open_seconds`; then a single probe is
+    let through (half-open). A successful probe closes the breaker, a failed
+    one re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, window=30.0, open_seconds=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.open_seconds = open_seconds
+        self._clock = clock
+        self.state = "closed"
+        self._failures = []
+        self._opened_at = 0.0
+        self._probing = False
+        self.opens = 0
+
+    def retry_after(self):
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self._opened_at + self.open_seconds - self._clock())
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open" and self.retry_after() <= 0:
+            self.state = "half_open"
+            self._probing = False
+        if self.state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def abandon(self):
+        # A probe that ended without an upstream verdict (e.g. the client went away)
+        self._probing = False
+
+    def record_success(self):
+        self.state = "closed"
+        self._probing = False
+        self._failures.clear()
+
+    def record_failure(self):
+        now = self._clock()
+        if self.state == "half_open":
+            self._open(now)
+            return
+        self._failures = [t for t in self._failures if now - t < self.window]
+        self._failures.append(now)
+        if len(self._failures) >= self.failure_threshold:
+            self._open(now)
+
+    def _open(self, now):
+        self.state = "open"
+        self._opened_at = now
+        self._probing = False
+        self._failures.clear()
+        self.opens += 1
+
+
+class ModelHealth:
+    """Exponentially weighted moving averages of latency and success rate."""
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.latency = None
+        self.success = 1.0
+        self.samples = 0
+
+    def record(self, ok, latency=None):
+        a = self.alpha
+        self.success = (1 - a) * self.success + a * (1.0 if ok else 0.0)
+        if latency is not None:
+            self.latency = latency if self.latency is None else (1 - a) * self.latency + a * latency
+        self.samples += 1
+
+    def expected_cost(self):
+        # Expected seconds per successful response; None until a latency has been observed
+        if self.latency is None:
+            return None
+        return self.latency / max(self.success, 0.05)
+
+
+class FallbackRouter:
+    """Routes a requested model through its fallback chain.
+
+    `chains` maps a requested model to the models that may stand in for it.
+    The requested model is always tried first, so it is back in use as soon
+    as its breaker lets calls through; fallbacks follow in order of expected
+    cost. Candidates whose breaker is open are skipped.
+    """
+
+    def __init__(self, chains=None, is_allowed=None, failure_threshold=5, window=30.0, open_seconds=30.0):
+        self.chains = dict(chains or {})
+        self.is_allowed = is_allowed or (lambda model: True)
+        self._breaker_args = (failure_threshold, window, open_seconds)
+        self.breakers = {}
+        self.health = {}
+        self.fallbacks_served = 0
+
+    def breaker(self, model):
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(*self._breaker_args)
+        return breaker
+
+    def model_health(self, model):
+        health = self.health.get(model)
+        if health is None:
+            health = self.health[model] = ModelHealth()
+        return health
+
+    def candidates(self, model):
+        fallbacks = [m for m in self.chains.get(model, []) if m != model and self.is_allowed(m)]
+        # Only fallbacks are ranked: a fallback's fresh latency must not outrank the requested model's stale one.
+        # Models without observations rank as if they matched the requested model.
+        default = self.model_health(model).expected_cost() or 0.0
+        ranked = []
+        for position, candidate in enumerate(fallbacks):
+            cost = self.model_health(candidate).expected_cost()
+            ranked.append((default if cost is None else cost, position, candidate))
+        ranked.sort()
+        return [model] + [candidate for _, _, candidate in ranked]
+
+    def record(self, model, ok, latency=None):
+        breaker = self.breaker(model)
+        if ok:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+        self.model_health(model).record(ok, latency)
+
+    async def call(self, model, fn):
+        """Run `fn(candidate)` down the chain; returns (served_model, result).
+
+        Non-retryable errors (e.g. a 400 for a bad request) are raised
+        straight away since another model would fail the same way.
+        """
+        last_error = None
+        for candidate in self.candidates(model):
+            if not self.breaker(candidate).allow():
+                continue
+            started = time.perf_counter()
+            try:
+                result = await fn(candidate)
+            except asyncio.CancelledError:
+                self.breaker(candidate).abandon()
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    # The upstream answered, so the model itself is reachable
+                    self.breaker(candidate).record_success()
+                    raise
+                self.record(candidate, False)
+                last_error = e
+                continue
+            self.record(candidate, True, time.perf_counter() - started)
+            if candidate != model:
+                self.fallbacks_served += 1
+            return candidate, result
+        if last_error is not None:
+            raise last_error
+        chain = self.candidates(model)
+        retry_after = min(self.breaker(m).retry_after() for m in chain)
+        raise NoUpstreamAvailable(
+            f"All upstream models for '{model}' are temporarily unavailable", max(1, int(retry_after + 0.999))
+        )
+
+    def stats(self):
+        models = sorted(set(self.breakers) | set(self.health))
+        return {
+            "fallbacks_served": self.fallbacks_served,
+            "models": {
+                m: {
+                    "breaker": self.breaker(m).state,
+                    "opens": self.breaker(m).opens,
+                    "ewma_latency_ms": round(self.model_health(m).latency * 1000, 1) if self.model_health(m).latency is not None else None,
+                    "ewma_success": round(self.model_health(m).success, 3),
+                    "samples": self.model_health(m).samples,
+                }
+                for m in models
+            },
+        }
@@ -0,0 +1,411 @@
+# Asynchronous generation jobs: a persisted job table, a bounded worker pool and webhook delivery.
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+
+import httpx
+
+from shared import pid_alive
+
+logger = logging.getLogger(__name__)
+
+FINISHED = ("succeeded", "failed")
+
+
+class JobFailed(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class QueueFull(Exception):
+    pass
+
+
+def validate_webhook_url(url):
+    try:
+        parsed = httpx.URL(url) if isinstance(url, str) else None
+    except httpx.InvalidURL:
+        parsed = None
+    if parsed is None or parsed.scheme not in ("http", "https") or not parsed.host:
+        raise ValueError("webhook_url must be an http(s) URL")
+    return str(parsed)
+
+
+def parse_networks(value):
+    """Comma-separated addresses or CIDR ranges, e.g. "127.0.0.1,10.0.0.0/8"."""
+    return [ipaddress.ip_network(item.strip(), strict=False) for item in value.split(",") if item.strip()]
+
+
+async def check_webhook_host(url, allowed=()):
+    """Raise ValueError unless every address `url`'s host resolves to is public or inside `allowed`.
+
+    Keeps webhooks from reaching loopback, private, link-local and other
+    internal addresses (cloud metadata endpoints among them).
+    """
+    host = httpx.URL(url).host
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    except socket.gaierror:
+        raise ValueError(f"webhook_url host {host} does not resolve")
+    for *_, sockaddr in infos:
+        address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if (not address.is_global or address.is_multicast) and not any(address in net for net in allowed):
+            raise ValueError(f"webhook_url host {host} resolves to a non-public address ({address})")
+
+
+def sign_webhook(secret, timestamp, body):
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+class JobStore:
+    """Jobs in SQLite, owned by the API key that submitted them.
+
+    Each job remembers the process that runs it, by pid and by a token
+    picked when the store is opened, so after a restart (or a crashed
+    worker) `claim_orphans()` hands unfinished jobs to a live process, even
+    when the new process was given the old one's pid. Finished jobs are deleted `ttl` seconds after they finish.
+    """
+
+    def __init__(self, path, ttl=86400, busy_timeout=5.0, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self._clock = clock
+        self.owner_token = secrets.token_hex(8)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    apikey TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    request TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    webhook_url TEXT,
+                    webhook_status TEXT,
+                    webhook_attempts INTEGER NOT NULL DEFAULT 0,
+                    owner_pid INTEGER NOT NULL,
+                    owner_token TEXT NOT NULL DEFAULT '',
+                    created REAL NOT NULL,
+                    started REAL,
+                    finished REAL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+                CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished);
+            """)
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(jobs)")]
+            if "owner_token" not in columns:
+                self._db.execute("ALTER TABLE jobs ADD COLUMN owner_token TEXT NOT NULL DEFAULT ''")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            return cursor.fetchall(), cursor.rowcount
+
+    def create(self, apikey, request, webhook_url=None):
+        job_id = secrets.token_urlsafe(16)
+        self._execute(
+            "INSERT INTO jobs (id, apikey, status, request, webhook_url, webhook_status, owner_pid, owner_token,"
+            " created) VALUES (?, ?, 'queued', ?, ?, ?, ?, ?, ?)",
+            (job_id, apikey, json.dumps(request, ensure_ascii=False), webhook_url,
+             "pending" if webhook_url else None, os.getpid(), self.owner_token, self._clock()),
+        )
+        return job_id
+
+    def _row(self, row):
+        return {
+            "id": row[0],
+            "apikey": row[1],
+            "status": row[2],
+            "request": json.loads(row[3]),
+            "result": json.loads(row[4]) if row[4] else None,
+            "error": json.loads(row[5]) if row[5] else None,
+            "webhook_url": row[6],
+            "webhook_status": row[7],
+            "webhook_attempts": row[8],
+            "created": row[9],
+            "started": row[10],
+            "finished": row[11],
+        }
+
+    def get(self, job_id, apikey=None):
+        """The job, or None if it does not exist, expired or belongs to another key."""
+        rows, _ = self._execute(
+            "SELECT id, apikey, status, request, result, error, webhook_url, webhook_status, webhook_attempts,"
+            " created, started, finished FROM jobs WHERE id = ?",
+            (job_id,),
+        )
+        if not rows or (apikey is not None and rows[0][1] != apikey):
+            return None
+        return self._row(rows[0])
+
+    def start(self, job_id):
+        self._execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (self._clock(), job_id))
+
+    def finish(self, job_id, result=None, error=None):
+        self._execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ? WHERE id = ?",
+            ("failed" if error is not None else "succeeded",
+             json.dumps(result, ensure_ascii=False) if result is not None else None,
+             json.dumps(error) if error is not None else None, self._clock(), job_id),
+        )
+
+    def webhook_attempted(self, job_id, attempts, status):
+        self._execute("UPDATE jobs SET webhook_attempts = ?, webhook_status = ? WHERE id = ?",
+                      (attempts, status, job_id))
+
+    def claim_orphans(self):
+        """Take over unfinished jobs and undelivered webhooks whose process is gone; returns their ids."""
+        rows, _ = self._execute(
+            "SELECT id, owner_pid, owner_token FROM jobs"
+            " WHERE status NOT IN ('succeeded', 'failed') OR webhook_status = 'pending'"
+        )
+        claimed = []
+        for job_id, pid, token in rows:
+            # A row with our pid but another token was left by an earlier process that had the same pid
+            if token == self.owner_token or (pid != os.getpid() and pid_alive(pid)):
+                continue
+            _, count = self._execute(
+                "UPDATE jobs SET owner_pid = ?, owner_token = ?,"
+                " status = CASE WHEN status = 'running' THEN 'queued' ELSE status END"
+                " WHERE id = ? AND owner_token = ?",
+                (os.getpid(), self.owner_token, job_id, token),
+            )
+            if count:
+                claimed.append(job_id)
+        return claimed
+
+    def sweep(self):
+        _, removed = self._execute("DELETE FROM jobs WHERE finished < ? AND (webhook_status IS NULL OR"
+                                   " webhook_status != 'pending')", (self._clock() - self.ttl,))
+        return removed
+
+    def counts(self):
+        rows, _ = self._execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class JobRunner:
+    """Runs jobs from `store` through `run(job)` on a fixed number of worker tasks.
+
+    `submit()` refuses new jobs once `max_queue` are waiting. `run` returns
+    the job's result or raises JobFailed. When a job has a webhook URL the
+    finished job is POSTed there; 429, 5xx and connection errors are retried
+    up to `webhook_attempts` times with exponential backoff starting at
+    `webhook_backoff` seconds. `wait()` lets clients long-poll: jobs run by
+    this process wake their waiters directly, others are re-read every
+    `poll_interval` seconds.
+
+    Each delivery re-checks the webhook host against `webhook_allow` (see
+    `check_webhook_host`) and is signed: `X-RouterAI-Signature` is
+    "sha256=" + HMAC-SHA256 over "<X-RouterAI-Timestamp>.<body>", keyed with
+    `webhook_secret(apikey)`. Jobs whose key no longer has a secret are not
+    delivered.
+    """
+
+    def __init__(self, store, run, webhook_secret, workers=4, max_queue=1000, webhook_attempts=5,
+                 webhook_backoff=1.0, webhook_timeout=10.0, webhook_allow=(), poll_interval=0.5,
+                 sweep_interval=60.0):
+        self.store = store
+        self.run = run
+        self.webhook_secret = webhook_secret
+        self.webhook_allow = webhook_allow
+        self.workers = workers
+        self.max_queue = max_queue
+        self.webhook_attempts = webhook_attempts
+        self.webhook_backoff = webhook_backoff
+        self.webhook_timeout = webhook_timeout
+        self.poll_interval = poll_interval
+        self.sweep_interval = sweep_interval
+        self._queue = None
+        self._tasks = []
+        self._deliveries = set()
+        # job id -> [event, number of waiters]
+        self._waiters = {}
+        self._http = None
+        self.running = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.webhooks_delivered = 0
+        self.webhooks_failed = 0
+        self.webhook_retries = 0
+        self.swept = 0
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._http = httpx.AsyncClient(timeout=self.webhook_timeout)
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.ensure_future(self._maintain()))
+
+    async def stop(self):
+        for task in self._tasks + list(self._deliveries):
+            task.cancel()
+        for task in self._tasks + list(self._deliveries):
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        if self._http is not None:
+            await self._http.aclose()
+
+    async def submit(self, apikey, request, webhook_url=None):
+        if self._queue is None or self._queue.qsize() >= self.max_queue:
+            raise QueueFull("Too many queued jobs, try again later")
+        job_id = await asyncio.to_thread(self.store.create, apikey, request, webhook_url)
+        self._queue.put_nowait(job_id)
+        return job_id
+
+    async def _work(self):
+        while True:
+            job_id = await self._queue.get()
+            job = await asyncio.to_thread(self.store.get, job_id)
+            if job is None or job["status"] in FINISHED:
+                continue
+            self.running += 1
+            try:
+                await asyncio.to_thread(self.store.start, job_id)
+                try:
+                    result, error = await self.run(job), None
+                except JobFailed as e:
+                    result, error = None, {"status": e.status_code, "detail": e.detail}
+                except Exception as e:
+                    logger.exception("Job %s failed", job_id)
+                    result, error = None, {"status": 500, "detail": str(e)}
+                await asyncio.to_thread(self.store.finish, job_id, result, error)
+            finally:
+                self.running -= 1
+            if error is None:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            waiters = self._waiters.get(job_id)
+            if waiters is not None:
+                waiters[0].set()
+            if job["webhook_url"]:
+                self._deliver_later(job_id)
+
+    def _deliver_later(self, job_id):
+        task = asyncio.ensure_future(self._deliver(job_id))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, job_id):
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job is None:
+            return
+        body = json.dumps(public_view(job), ensure_ascii=False).encode()
+        secret = self.webhook_secret(job["apikey"])
+        if not secret:
+            logger.warning("Job %s webhook not delivered: its API key has no webhook_secret", job_id)
+        attempts = job["webhook_attempts"]
+        delivered = False
+        while secret and attempts < self.webhook_attempts:
+            if attempts:
+                self.webhook_retries += 1
+                await asyncio.sleep(self.webhook_backoff * 2 ** (attempts - 1))
+            attempts += 1
+            try:
+                # Resolved again here so a host that changed its DNS since submission is still refused
+                await check_webhook_host(job["webhook_url"], self.webhook_allow)
+            except ValueError as e:
+                logger.warning("Job %s webhook not delivered: %s", job_id, e)
+                break
+            timestamp = str(int(time.time()))
+            headers = {"Content-Type": "application/json", "X-RouterAI-Job": job_id,
+                       "X-RouterAI-Timestamp": timestamp, "X-RouterAI-Signature": sign_webhook(secret, timestamp, body)}
+            try:
+                response = await self._http.post(job["webhook_url"], content=body, headers=headers)
+                retry = response.status_code == 429 or response.status_code >= 500
+                delivered = response.is_success
+            except httpx.HTTPError:
+                retry, delivered = True, False
+            if delivered or not retry:
+                break
+            await asyncio.to_thread(self.store.webhook_attempted, job_id, attempts, "pending")
+        status = "delivered" if delivered else "failed"
+        await asyncio.to_thread(self.store.webhook_attempted, job_id, attempts, status)
+        if delivered:
+            self.webhooks_delivered += 1
+        else:
+            self.webhooks_failed += 1
+
+    async def _maintain(self):
+        while True:
+            for job_id in await asyncio.to_thread(self.store.claim_orphans):
+                job = await asyncio.to_thread(self.store.get, job_id)
+                if job["status"] in FINISHED:
+                    self._deliver_later(job_id)
+                else:
+                    self._queue.put_nowait(job_id)
+            self.swept += await asyncio.to_thread(self.store.sweep)
+            await asyncio.sleep(self.sweep_interval)
+
+    async def wait(self, job_id, apikey, timeout):
+        """The job once it has finished or `timeout` seconds have passed; None if it does not exist."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        waiters = self._waiters.setdefault(job_id, [asyncio.Event(), 0])
+        waiters[1] += 1
+        try:
+            while True:
+                job = await asyncio.to_thread(self.store.get, job_id, apikey)
+                left = deadline - loop.time()
+                if job is None or job["status"] in FINISHED or left <= 0:
+                    return job
+                try:
+                    await asyncio.wait_for(waiters[0].wait(), min(left, self.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            waiters[1] -= 1
+            if not waiters[1]:
+                self._waiters.pop(job_id, None)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue": self.max_queue,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "webhooks_delivered": self.webhooks_delivered,
+            "webhooks_failed": self.webhooks_failed,
+            "webhook_retries": self.webhook_retries,
+            "webhooks_in_progress": len(self._deliveries),
+            "swept": self.swept,
+            "stored": self.store.counts(),
+        }
+
+
+def public_view(job):
+    view = {"id": job["id"], "status": job["status"], "created": job["created"], "started": job["started"],
+            "finished": job["finished"], "result": job["result"], "error": job["error"]}
+    if job["webhook_url"]:
+        view["webhook"] = {"url": job["webhook_url"], "status": job["webhook_status"],
+                           "attempts": job["webhook_attempts"]}
+    return view
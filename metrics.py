@@ -0,0 +1,161 @@
+# In-process counters, gauges and histograms rendered in the Prometheus text format.
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+OVERHEAD_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+# Label values past this many series per metric are folded into one, so a
+# client sending random worktypes cannot grow memory without bound
+MAX_SERIES = 5000
+OVERFLOW = "__other__"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, *extra):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(e for e in extra if e)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # Labels every series of this metric carries, e.g. 'worker="2"'; set by MetricSet
+        self.const = ""
+        self._series = {}
+
+    def _key(self, labels):
+        # Plain dict updates; the event loop is single-threaded, so no locks are needed
+        if labels in self._series or len(self._series) < MAX_SERIES:
+            return labels
+        return (OVERFLOW,) * len(self.labelnames)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+    def samples(self):
+        return [f"{self.name}{_labels(self.labelnames, labels, self.const)} {_number(value)}"
+                for labels, value in self._series.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        self._series[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            # Per-bucket (non-cumulative) counts plus the overflow bucket, then sum
+            series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        lines = []
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = f'le="{_number(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, self.const, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels, self.const)}"
+                         f" {_number(round(series[-1], 6))}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels, self.const)} {cumulative}")
+        return lines
+
+
+class MetricSet:
+    """The metrics of one worker process.
+
+    `collector(fn)` registers a callback run at scrape time that returns
+    (name, kind, help, value) samples, for numbers that already live in
+    other components' stats. `const_labels` are added to every series, so
+    several workers' metrics can be told apart; `render(others)` merges
+    other workers' `families()` snapshots into one exposition.
+    """
+
+    def __init__(self, const_labels=None):
+        self.metrics = []
+        self.collectors = []
+        self.const = ",".join(f'{n}="{_escape(v)}"' for n, v in (const_labels or {}).items())
+
+    def _add(self, metric):
+        metric.const = self.const
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    def families(self):
+        """{name: [help, kind, sample lines]} for every metric of this process."""
+        families = {}
+        for metric in self.metrics:
+            families[metric.name] = [metric.help, metric.kind, metric.samples()]
+        for fn in self.collectors:
+            for name, kind, help, value in fn():
+                if value is not None:
+                    families[name] = [help, kind, [f"{name}{_labels((), (), self.const)} {_number(value)}"]]
+        return families
+
+    def render(self, others=()):
+        families = self.families()
+        # The text format wants each metric's samples in one group, so other workers' lines join ours by name
+        for other in others:
+            for name, (help, kind, samples) in other.items():
+                if name in families:
+                    families[name][2].extend(samples)
+                else:
+                    families[name] = [help, kind, list(samples)]
+        lines = []
+        for name, (help, kind, samples) in families.items():
+            lines.extend([f"# HELP {name} {help}", f"# TYPE {name} {kind}"])
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,156 @@
+# Approximate response cache: prompts that are near-duplicates (MinHash/LSH) share an answer.
+import hashlib
+import heapq
+import json
+import random
+import time
+from array import array
+from collections import Counter, OrderedDict
+
+MASK64 = (1 << 64) - 1
+
+
+def normalize(text):
+    return " ".join(text.lower().split())
+
+
+def shingles(text, size):
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class NearDuplicateCache:
+    """LRU of responses indexed by a MinHash signature of the normalized prompt.
+
+    Prompts are lowercased, whitespace-collapsed and cut into character
+    shingles; each of the `num_perm` signature slots is the minimum of the
+    shingle hashes XORed with a fixed random mask. An LSH table splits the
+    signature into `bands` and buckets entries by band, so a lookup only
+    compares against entries sharing at least one band. Buckets keep their
+    `bucket_size` newest entries and only the `max_candidates` entries sharing
+    the most bands are compared, so templated prompts that all collide keep
+    lookups cheap. MinHash only finds candidates: each entry also keeps its
+    shingle hashes, and a candidate is a hit when the exact Jaccard
+    similarity of the two shingle sets is at least `threshold` and the model
+    and generation parameters are identical.
+    Very long prompts are sampled down to the `max_shingles` smallest hashes
+    for the MinHash, which keeps that cost flat and similar prompts still
+    sample alike. `signature()` does not touch the cache, so callers can run
+    it off the event loop.
+    Shingle hashes use Python's `hash()`, so signatures are only meaningful
+    inside one process.
+    """
+
+    def __init__(self, threshold=0.9, max_entries=2048, ttl=3600, num_perm=64, bands=8,
+                 shingle_size=5, max_shingles=128, bucket_size=128, max_candidates=16, seed=1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.max_shingles = max_shingles
+        self.bucket_size = bucket_size
+        self.max_candidates = max_candidates
+        rng = random.Random(seed)
+        self._masks = [rng.getrandbits(64) for _ in range(num_perm)]
+        # entry id -> (expires_at, model, scope, signature, band keys, value)
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def scope(self, model, params):
+        canonical = json.dumps({"model": model, "params": params}, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(canonical.encode()).hexdigest()[:16]
+
+    def signature(self, prompt):
+        """(MinHash slots, shingle hashes) of `prompt`."""
+        hashes = {hash(s) & MASK64 for s in shingles(normalize(prompt), self.shingle_size)}
+        sample = heapq.nsmallest(self.max_shingles, hashes) if len(hashes) > self.max_shingles else hashes
+        return array("Q", [min(h ^ mask for h in sample) for mask in self._masks]), frozenset(hashes)
+
+    def _band_keys(self, scope, signature):
+        rows = self.rows
+        return [hash((scope, band, tuple(signature[band * rows:(band + 1) * rows]))) for band in range(self.bands)]
+
+    def _remove(self, entry_id):
+        _, _, _, _, band_keys, _ = self._entries.pop(entry_id)
+        for band_key in band_keys:
+            ids = self._buckets.get(band_key)
+            if ids is not None:
+                ids.pop(entry_id, None)
+                if not ids:
+                    del self._buckets[band_key]
+
+    def get(self, model, params, signature):
+        """Return (value, similarity) for the closest cached prompt at or above the threshold, else None."""
+        scope = self.scope(model, params)
+        minhash, hashes = signature
+        band_hits = Counter()
+        for band_key in self._band_keys(scope, minhash):
+            band_hits.update(self._buckets.get(band_key, {}).keys())
+        now = time.time()
+        best_id, best = None, 0.0
+        for entry_id, _ in band_hits.most_common(self.max_candidates):
+            expires_at, _, entry_scope, (_, entry_hashes), _, _ = self._entries[entry_id]
+            if expires_at < now:
+                self._remove(entry_id)
+                continue
+            if entry_scope != scope:
+                continue
+            shared = len(hashes.intersection(entry_hashes))
+            similarity = shared / (len(hashes) + len(entry_hashes) - shared)
+            if similarity > best:
+                best_id, best = entry_id, similarity
+        if best_id is None or best < self.threshold:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(best_id)
+        self.hits += 1
+        return self._entries[best_id][5], best
+
+    def set(self, model, params, signature, value):
+        if self.max_entries <= 0:
+            return
+        scope = self.scope(model, params)
+        band_keys = self._band_keys(scope, signature[0])
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = (time.time() + self.ttl, model, scope, signature, band_keys, value)
+        for band_key in band_keys:
+            # Dicts keep insertion order, so the first id is the oldest in the bucket
+            ids = self._buckets.get(band_key)
+            if ids is None:
+                ids = self._buckets[band_key] = {}
+            ids[entry_id] = None
+            if len(ids) > self.bucket_size:
+                del ids[next(iter(ids))]
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def purge(self, model=None):
+        ids = [entry_id for entry_id, entry in self._entries.items() if model is None or entry[1] == model]
+        for entry_id in ids:
+            self._remove(entry_id)
+        return len(ids)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "buckets": len(self._buckets),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
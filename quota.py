@@ -0,0 +1,298 @@
+# Per-key, per-model token counters with durable storage and daily/monthly budgets.
+import asyncio
+import calendar
+import sqlite3
+import threading
+import time
+
+from ratelimit import RateLimited
+
+BUDGET_FIELDS = ("daily_token_budget", "monthly_token_budget")
+COUNTERS = ("requests", "prompt_tokens", "completion_tokens", "total_tokens")
+
+
+class _KeyTotals:
+    __slots__ = ("day", "day_tokens", "month_tokens")
+
+    def __init__(self, day, day_tokens, month_tokens):
+        self.day = day
+        self.day_tokens = day_tokens
+        self.month_tokens = month_tokens
+
+
+class TokenLedger:
+    """Token usage per (key, model, UTC day), counted in memory and flushed to SQLite in batches.
+
+    `record()` only adds to in-memory counters; a background task writes the
+    pending deltas every `flush_interval` seconds as one transaction of
+    upserts, so several worker processes can share the database. Budget
+    checks only read memory: per-key day and month totals that the same task
+    re-reads from the database after every flush (to pick up other workers'
+    usage), plus this process's usage since. A key checked for the first
+    time counts only this process's usage until the task, woken at once,
+    has read its totals. Reads go through their own connection so a flush
+    waiting on the database never delays them.
+    """
+
+    def __init__(self, path, flush_interval=2.0, busy_timeout=5.0, clock=time.time):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS token_usage (
+                    key TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    requests INTEGER NOT NULL DEFAULT 0,
+                    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                    completion_tokens INTEGER NOT NULL DEFAULT 0,
+                    total_tokens INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (key, day, model)
+                ) WITHOUT ROWID
+            """)
+        self._reader = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        # key -> {(model, day): [requests, prompt, completion, total]} not yet written
+        self._pending = {}
+        self._flushing = {}
+        self._totals = {}
+        # Keys whose totals have not been read from the database yet
+        self._unloaded = set()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._wake = None
+        self._stopping = False
+        self.recorded = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.errors = 0
+        self.rejected = {"daily": 0, "monthly": 0}
+
+    def _day(self, ts):
+        return time.strftime("%Y-%m-%d", time.gmtime(ts))
+
+    def record(self, key, model, usage):
+        if not usage:
+            return
+        counts = (1, usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0,
+                  usage.get("total_tokens") or 0)
+        day = self._day(self._clock())
+        per_key = self._pending.setdefault(key, {})
+        entry = per_key.get((model, day))
+        if entry is None:
+            per_key[(model, day)] = list(counts)
+        else:
+            for i, value in enumerate(counts):
+                entry[i] += value
+        totals = self._totals.get(key)
+        if totals is not None and totals.day == day:
+            totals.day_tokens += counts[3]
+            totals.month_tokens += counts[3]
+        self.recorded += 1
+
+    def _query(self, sql, params=()):
+        with self._read_lock:
+            return self._reader.execute(sql, params).fetchall()
+
+    def _local(self, key, day):
+        # This process's unflushed (day, month) tokens for `key`
+        month = day[:7]
+        day_tokens = month_tokens = 0
+        for pending in (self._pending, self._flushing):
+            for (_, pending_day), counts in pending.get(key, {}).items():
+                if pending_day == day:
+                    day_tokens += counts[3]
+                if pending_day[:7] == month:
+                    month_tokens += counts[3]
+        return day_tokens, month_tokens
+
+    def _read_totals(self, keys, day):
+        month = day[:7]
+        stored = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self._query(
+                "SELECT key, COALESCE(SUM(CASE WHEN day = ? THEN total_tokens END), 0), SUM(total_tokens)"
+                f" FROM token_usage WHERE day >= ? AND day <= ? AND key IN ({','.join('?' * len(chunk))})"
+                " GROUP BY key",
+                (day, month + "-01", month + "-31", *chunk),
+            )
+            stored.update((row[0], (row[1], row[2])) for row in rows)
+        return stored
+
+    async def refresh(self, keys=None):
+        """Re-read the stored day and month totals of `keys` (default: every tracked key) in a thread."""
+        keys = list(self._totals) if keys is None else list(keys)
+        if not keys:
+            return
+        day = self._day(self._clock())
+        # No flush can move pending usage into the database between the read and adding it back
+        async with self._flush_lock:
+            stored = await asyncio.to_thread(self._read_totals, keys, day)
+            for key in keys:
+                day_tokens, month_tokens = stored.get(key, (0, 0))
+                local_day, local_month = self._local(key, day)
+                self._totals[key] = _KeyTotals(day, day_tokens + local_day, month_tokens + local_month)
+
+    def current(self, key):
+        """This key's (day_tokens, month_tokens) for the current UTC day and month, from memory."""
+        day = self._day(self._clock())
+        totals = self._totals.get(key)
+        if totals is None or totals.day != day:
+            day_tokens, month_tokens = self._local(key, day)
+            if totals is not None and totals.day[:7] == day[:7]:
+                # Today's usage was not added to yesterday's totals
+                month_tokens = totals.month_tokens + day_tokens
+            totals = self._totals[key] = _KeyTotals(day, day_tokens, month_tokens)
+            self._unloaded.add(key)
+            if self._wake is not None:
+                self._wake.set()
+        return totals.day_tokens, totals.month_tokens
+
+    def check(self, key_obj):
+        daily = key_obj.get("daily_token_budget")
+        monthly = key_obj.get("monthly_token_budget")
+        if not (daily or monthly):
+            return
+        day_tokens, month_tokens = self.current(key_obj["key"])
+        now = self._clock()
+        if daily and day_tokens >= daily:
+            self.rejected["daily"] += 1
+            raise RateLimited("budget", "Daily token budget exhausted", max(1, int(86400 - now % 86400)))
+        if monthly and month_tokens >= monthly:
+            self.rejected["monthly"] += 1
+            gmt = time.gmtime(now)
+            next_month = calendar.timegm((gmt.tm_year + gmt.tm_mon // 12, gmt.tm_mon % 12 + 1, 1, 0, 0, 0))
+            raise RateLimited("budget", "Monthly token budget exhausted", max(1, int(next_month - now)))
+
+    def forget(self, key):
+        self._totals.pop(key, None)
+        self._unloaded.discard(key)
+
+    def _write(self, rows):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    "INSERT INTO token_usage (key, day, model, requests, prompt_tokens, completion_tokens, total_tokens)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (key, day, model) DO UPDATE SET"
+                    " requests = requests + excluded.requests,"
+                    " prompt_tokens = prompt_tokens + excluded.prompt_tokens,"
+                    " completion_tokens = completion_tokens + excluded.completion_tokens,"
+                    " total_tokens = total_tokens + excluded.total_tokens",
+                    rows,
+                )
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+            self._flushing = pending
+            rows = [(key, day, model, *counts)
+                    for key, per_key in pending.items() for (model, day), counts in per_key.items()]
+            try:
+                await asyncio.to_thread(self._write, rows)
+            except sqlite3.Error:
+                self._flushing = {}
+                self.errors += 1
+                # Put the deltas back so the next flush retries them
+                for key, per_key in pending.items():
+                    for (model, day), counts in per_key.items():
+                        entry = self._pending.setdefault(key, {}).setdefault((model, day), [0, 0, 0, 0])
+                        for i, value in enumerate(counts):
+                            entry[i] += value
+                return 0
+            self._flushing = {}
+            self.flushes += 1
+            self.rows_written += len(rows)
+            return len(rows)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_flush = loop.time() + self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(0.0, next_flush - loop.time()))
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                if self._stopping:
+                    await self.flush()
+                    return
+                if loop.time() >= next_flush:
+                    await self.flush()
+                    next_flush = loop.time() + self.flush_interval
+                    keys = list(self._totals)
+                else:
+                    keys = list(self._unloaded)
+                self._unloaded.difference_update(keys)
+                await self.refresh(keys)
+            except sqlite3.Error:
+                self.errors += 1
+
+    async def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._wake = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        await self._task
+        self._task = None
+
+    def usage(self, key=None, model=None, granularity="day", since=None, until=None):
+        """Flushed usage grouped by key, model and day or month ("YYYY-MM-DD" / "YYYY-MM" periods)."""
+        width = 10 if granularity == "day" else 7
+        where, params = [], []
+        if key is not None:
+            where.append("key = ?")
+            params.append(key)
+        if model is not None:
+            where.append("model = ?")
+            params.append(model)
+        if since:
+            where.append("day >= ?")
+            params.append(since)
+        if until:
+            where.append("substr(day, 1, ?) <= ?")
+            params.extend((len(until), until))
+        rows = self._query(
+            f"SELECT key, model, substr(day, 1, {width}) AS period, SUM(requests), SUM(prompt_tokens),"
+            " SUM(completion_tokens), SUM(total_tokens) FROM token_usage"
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + " GROUP BY key, model, period ORDER BY period, key, model",
+            params,
+        )
+        return [{"key": r[0], "model": r[1], "period": r[2], **dict(zip(COUNTERS, r[3:]))} for r in rows]
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "pending_keys": len(self._pending),
+            "tracked_keys": len(self._totals),
+            "recorded": self.recorded,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "errors": self.errors,
+            "rejected": dict(self.rejected),
+        }
+
+    def close(self):
+        with self._lock, self._read_lock:
+            self._db.close()
+            self._reader.close()
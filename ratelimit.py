@@ -0,0 +1,101 @@
+# Per-API-key request rate and concurrency enforcement.
+import time
+
+# Token budgets are enforced by quota.TokenLedger; all are validated here
+LIMIT_FIELDS = ("rate_limit_rpm", "max_concurrency", "daily_token_budget", "monthly_token_budget")
+
+
+class RateLimited(Exception):
+    def __init__(self, reason, detail, retry_after):
+        super().__init__(detail)
+        self.reason = reason
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def validate_limits(data):
+    """Pick the limit fields out of an admin payload; None (or 0) means unlimited."""
+    limits = {}
+    for field in LIMIT_FIELDS:
+        if field not in data:
+            continue
+        value = data[field]
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 0):
+            raise ValueError(f"{field} must be a non-negative integer or null")
+        limits[field] = value or None
+    return limits
+
+
+class _KeyState:
+    __slots__ = ("tokens", "updated", "in_flight")
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.in_flight = 0
+
+
+class Lease:
+    __slots__ = ("_state",)
+
+    def __init__(self, state):
+        self._state = state
+
+    def release(self):
+        if self._state is not None:
+            self._state.in_flight -= 1
+            self._state = None
+
+
+class RateLimiter:
+    """In-memory limiter; every check is a dict lookup plus a few float ops.
+
+    Limits are read from the key record on each call, so admin edits take
+    effect on the next request without resetting counters.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._states = {}
+        self.allowed = 0
+        self.rejected = {"rate": 0, "concurrency": 0}
+
+    def _state(self, key, capacity, now):
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _KeyState(capacity, now)
+        return state
+
+    def _reject(self, reason, detail, retry_after):
+        self.rejected[reason] += 1
+        raise RateLimited(reason, detail, max(1, int(retry_after + 0.999)))
+
+    def acquire(self, key_obj):
+        rpm = key_obj.get("rate_limit_rpm")
+        max_concurrency = key_obj.get("max_concurrency")
+        now = self._clock()
+        state = self._state(key_obj["key"], rpm or 0, now)
+        if max_concurrency and state.in_flight >= max_concurrency:
+            self._reject("concurrency", "Too many concurrent requests for this API key", 1)
+        if rpm:
+            rate = rpm / 60.0
+            state.tokens = min(rpm, state.tokens + (now - state.updated) * rate)
+            state.updated = now
+            if state.tokens < 1:
+                self._reject("rate", "Rate limit exceeded for this API key", (1 - state.tokens) / rate)
+            state.tokens -= 1
+        state.in_flight += 1
+        self.allowed += 1
+        return Lease(state)
+
+    def forget(self, key):
+        self._states.pop(key, None)
+
+    def usage(self, key):
+        state = self._states.get(key)
+        if state is None:
+            return {"in_flight": 0}
+        return {"in_flight": state.in_flight}
+
+    def stats(self):
+        return {"tracked_keys": len(self._states), "allowed": self.allowed, "rejected": dict(self.rejected)}
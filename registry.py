@@ -0,0 +1,125 @@
+# In-memory index of API keys and allowed models for the request hot path.
+import asyncio
+import logging
+
+from search import RecordIndex
+
+logger = logging.getLogger(__name__)
+
+
+class Registry:
+    """Holds a hash index of API keys and a frozen set of allowed models.
+
+    Lookups only read the current snapshot. `start()` loads it and then a
+    background task checks the store's generation every `check_interval`
+    seconds, reloading in a worker thread when another process wrote to the
+    store. Changes made in this process are applied in place through
+    `put_key`/`drop_key`/`put_model`/`drop_model` when nothing else changed
+    since the last load, and reload otherwise. `key_index` and
+    `model_index` serve the admin list endpoints and follow the same changes.
+    """
+
+    def __init__(self, store, check_interval=1.0):
+        self.store = store
+        self.check_interval = check_interval
+        self.models = frozenset()
+        self.keys = {}
+        self._generation = None
+        self._reloading = asyncio.Lock()
+        self._task = None
+        self.reloads = 0
+        self.key_index = RecordIndex("key", ("key", "owner", "note"))
+        self.model_index = RecordIndex("model", ("model",))
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def _read(self):
+        # The generation is read first, so a write racing the listing shows up on the next check
+        return self.store.generation(), self.store.list_models(), self.store.list_keys()
+
+    async def reload(self):
+        async with self._reloading:
+            while True:
+                seen = self._generation
+                generation, models, keys = await asyncio.to_thread(self._read)
+                # A change applied in place while we read may be missing from what we read
+                if self._generation == seen:
+                    break
+            self.models = frozenset(models)
+            self.keys = {k["key"]: k for k in keys}
+            self.model_index.load(lambda: [{"model": m} for m in models])
+            self.key_index.load(lambda: keys)
+            self._generation = generation
+            self.reloads += 1
+
+    async def refresh(self):
+        if await asyncio.to_thread(self.store.generation) != self._generation:
+            await self.reload()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Registry refresh failed")
+
+    async def start(self):
+        if self._task is None:
+            await self.reload()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _advance(self, generation):
+        # Only a counter that moved by exactly one proves ours was the only change
+        if isinstance(generation, int) and isinstance(self._generation, int) and generation == self._generation + 1:
+            self._generation = generation
+            return True
+        return False
+
+    async def put_key(self, record, generation):
+        if not self._advance(generation):
+            await self.reload()
+            return
+        self.keys[record["key"]] = record
+        self.key_index.put(record)
+
+    async def drop_key(self, key, generation):
+        if not self._advance(generation):
+            await self.reload()
+            return
+        self.keys.pop(key, None)
+        self.key_index.drop(key)
+
+    async def put_model(self, model, generation):
+        if not self._advance(generation):
+            await self.reload()
+            return
+        self.models = self.models | {model}
+        self.model_index.put({"model": model})
+
+    async def drop_model(self, model, generation):
+        if not self._advance(generation):
+            await self.reload()
+            return
+        self.models = self.models - {model}
+        self.model_index.drop(model)
+
+    def is_model_allowed(self, model):
+        return model in self.models
+
+    def get_active_key(self, apikey):
+        key_obj = self.keys.get(apikey)
+        if key_obj is None or not key_obj.get("active"):
+            return None
+        return key_obj
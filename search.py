@@ -0,0 +1,215 @@
+# Server-side search and paging over the admin key and model lists.
+import asyncio
+import base64
+import json
+from bisect import bisect_left, bisect_right, insort
+
+MATCH_MODES = ("substring", "prefix")
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def encode_cursor(entry):
+    return base64.urlsafe_b64encode(json.dumps(list(entry)).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        value, record_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    return (value, record_id)
+
+
+class RecordIndex:
+    """Prefix and substring search with stable paging over records keyed by `id_field`.
+
+    Every field in `fields` has a sorted (lowercase value, id) list, used for
+    ordering, prefix lookups and cursors; the lowercase text of all fields is
+    indexed by trigram for substring queries. `load()` defers a full rebuild
+    to the next `ensure()`, while `put()`/`drop()` update the index in place
+    (or are replayed on top of a rebuild still in progress).
+    """
+
+    def __init__(self, id_field, fields):
+        self.id_field = id_field
+        self.fields = tuple(fields)
+        self.sorts = ("created",) + self.fields
+        self.records = {}
+        self._source = None
+        self._building = None
+        self._pending = []
+        self._seq = {}
+        self._next_seq = 0
+        self._texts = {}
+        self._sorted = {f: [] for f in self.fields}
+        self._created = []
+        self._grams = {}
+        self.builds = 0
+
+    def load(self, source):
+        # `source()` returns the records in creation order; built by the next `ensure()`
+        self._source = source
+        self._pending = []
+
+    async def ensure(self):
+        """Apply the last `load()` and any changes made since.
+
+        The rebuild runs in a worker thread and is swapped in at once, so the
+        event loop keeps serving requests while a large index is built.
+        """
+        while self._source is not None or self._building is not None:
+            if self._building is None:
+                self._building = asyncio.ensure_future(self._rebuild())
+            # A caller that goes away must not cancel the build others are waiting on
+            await asyncio.shield(self._building)
+
+    async def _rebuild(self):
+        source, self._source = self._source, None
+        try:
+            built = await asyncio.to_thread(self._build, source)
+        finally:
+            self._building = None
+        if self._source is not None:
+            # Loaded again meanwhile; the next build supersedes this one
+            return
+        self.records, self._seq, self._next_seq, self._texts, self._sorted, self._created, self._grams = built
+        self.builds += 1
+        pending, self._pending = self._pending, []
+        for method, arg in pending:
+            method(arg)
+
+    def _build(self, source):
+        records, seq, texts, grams = {}, {}, {}, {}
+        entries = {f: [] for f in self.fields}
+        for record in source():
+            record_id = record[self.id_field]
+            records[record_id] = record
+            seq[record_id] = len(seq)
+            for f in self.fields:
+                entries[f].append((self._value(record, f), record_id))
+            self._index_text(record_id, record, texts, grams)
+        created = [(n, record_id) for record_id, n in seq.items()]
+        return records, seq, len(seq), texts, {f: sorted(v) for f, v in entries.items()}, created, grams
+
+    def _value(self, record, field):
+        return str(record.get(field) or "").lower()
+
+    def _index_text(self, record_id, record, texts, grams):
+        # NUL keeps trigrams from spanning two fields
+        text = "\0".join(self._value(record, f) for f in self.fields)
+        texts[record_id] = text
+        for gram in trigrams(text):
+            ids = grams.get(gram)
+            if ids is None:
+                ids = grams[gram] = set()
+            ids.add(record_id)
+
+    def _remove(self, record_id):
+        record = self.records.pop(record_id)
+        for f in self.fields:
+            entries = self._sorted[f]
+            del entries[bisect_left(entries, (self._value(record, f), record_id))]
+        for gram in trigrams(self._texts.pop(record_id)):
+            ids = self._grams[gram]
+            ids.discard(record_id)
+            if not ids:
+                del self._grams[gram]
+
+    def put(self, record):
+        if self._source is not None or self._building is not None:
+            self._pending.append((self.put, record))
+            return
+        record_id = record[self.id_field]
+        if record_id in self.records:
+            self._remove(record_id)
+        else:
+            self._seq[record_id] = self._next_seq
+            self._next_seq += 1
+            self._created.append((self._seq[record_id], record_id))
+        self.records[record_id] = record
+        for f in self.fields:
+            insort(self._sorted[f], (self._value(record, f), record_id))
+        self._index_text(record_id, record, self._texts, self._grams)
+
+    def drop(self, record_id):
+        if self._source is not None or self._building is not None:
+            self._pending.append((self.drop, record_id))
+            return
+        if record_id not in self.records:
+            return
+        self._remove(record_id)
+        seq = self._seq.pop(record_id)
+        del self._created[bisect_left(self._created, (seq, record_id))]
+
+    def _substring(self, q):
+        grams = trigrams(q)
+        if not grams:
+            return {record_id for record_id, text in self._texts.items() if q in text}
+        postings = sorted((self._grams.get(g, set()) for g in grams), key=len)
+        candidates = set(postings[0])
+        for ids in postings[1:]:
+            candidates &= ids
+            if not candidates:
+                break
+        # Trigram hits are only candidates; confirm the whole query occurs
+        return {record_id for record_id in candidates if q in self._texts[record_id]}
+
+    def _prefix(self, q):
+        matches = set()
+        for entries in self._sorted.values():
+            start = bisect_left(entries, (q,))
+            for value, record_id in entries[start:]:
+                if not value.startswith(q):
+                    break
+                matches.add(record_id)
+        return matches
+
+    def _sort_entry(self, record_id, sort):
+        if sort == "created":
+            return (self._seq[record_id], record_id)
+        return (self._value(self.records[record_id], sort), record_id)
+
+    def page(self, q="", match="substring", sort="created", order="asc", offset=0, cursor=None, limit=50):
+        """Return {"items", "total", "offset", "limit", "next_cursor"} for one page.
+
+        A `cursor` (from a previous page's next_cursor) takes precedence over
+        `offset` and stays correct while records are added or removed.
+        Serves what is built; await `ensure()` first to pick up a `load()`.
+        """
+        if sort not in self.sorts:
+            raise ValueError(f"sort must be one of {list(self.sorts)}")
+        if match not in MATCH_MODES:
+            raise ValueError(f"match must be one of {list(MATCH_MODES)}")
+        if order not in ("asc", "desc"):
+            raise ValueError("order must be 'asc' or 'desc'")
+        q = q.strip().lower()
+        if q:
+            matches = self._prefix(q) if match == "prefix" else self._substring(q)
+            entries = sorted(self._sort_entry(record_id, sort) for record_id in matches)
+        else:
+            entries = self._created if sort == "created" else self._sorted[sort]
+        total = len(entries)
+        after = decode_cursor(cursor) if cursor else None
+        if after and not (isinstance(after[0], int if sort == "created" else str) and isinstance(after[1], str)):
+            raise ValueError("Invalid cursor")
+        if order == "desc":
+            end = bisect_left(entries, after) if after else total - offset
+            end = max(0, min(total, end))
+            window = entries[max(0, end - limit):end][::-1]
+            has_more = end - limit > 0
+            offset = total - end
+        else:
+            start = bisect_right(entries, after) if after else offset
+            window = entries[start:start + limit]
+            has_more = start + limit < total
+            offset = start
+        return {
+            "items": [self.records[record_id] for _, record_id in window],
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "next_cursor": encode_cursor(window[-1]) if has_more and window else None,
+        }
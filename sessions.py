@@ -0,0 +1,176 @@
+# Server-side conversation history for /api/chat, so clients only send the new turn.
+import json
+import secrets
+import sqlite3
+import threading
+import time
+
+ROLES = ("system", "user", "assistant")
+
+
+def validate_messages(messages, max_messages):
+    """Check a client `messages` array; returns it as plain role/content dicts."""
+    if not isinstance(messages, list) or not messages:
+        raise ValueError("messages must be a non-empty list")
+    if len(messages) > max_messages:
+        raise ValueError(f"At most {max_messages} messages per request")
+    cleaned = []
+    for message in messages:
+        if not isinstance(message, dict) or message.get("role") not in ROLES:
+            raise ValueError(f"Each message needs a role in {list(ROLES)}")
+        if not isinstance(message.get("content"), str) or not message["content"]:
+            raise ValueError("Each message needs non-empty string content")
+        cleaned.append({"role": message["role"], "content": message["content"]})
+    return cleaned
+
+
+def estimate_tokens(message):
+    # Roughly four characters per token plus per-message framing
+    return len(message["content"]) // 4 + 4
+
+
+def truncate(messages, max_tokens, max_messages):
+    """Drop the oldest non-system messages until the history fits both budgets.
+
+    Leading system messages and the newest message are always kept.
+    """
+    head = 0
+    while head < len(messages) - 1 and messages[head]["role"] == "system":
+        head += 1
+    system, rest = messages[:head], messages[head:]
+    tokens = sum(estimate_tokens(m) for m in messages)
+    drop = 0
+    while drop < len(rest) - 1 and (tokens > max_tokens or len(system) + len(rest) - drop > max_messages):
+        tokens -= estimate_tokens(rest[drop])
+        drop += 1
+    return system + rest[drop:], tokens
+
+
+class SessionStore:
+    """Conversation histories in SQLite, owned by the API key that created them.
+
+    Sessions expire `ttl` seconds after their last use. Histories are cut to
+    `max_tokens` (estimated) and `max_messages` on every save, and at most
+    `max_sessions` are kept: a sweep, run when a new session is first saved
+    at most every `sweep_interval` seconds, deletes expired sessions and then
+    the least recently used ones over the limit. A session id from `new_id()`
+    is only stored by its first `save()`, so a conversation whose first reply
+    failed leaves nothing behind. Later saves pass the version `get()`
+    returned and fail if another turn was saved in between, so concurrent
+    turns cannot silently overwrite each other. SQLite lets every worker
+    serve any session; the methods block, so async callers run them in a
+    thread.
+    """
+
+    def __init__(self, path, ttl=3600, max_sessions=10000, max_tokens=8000, max_messages=200,
+                 sweep_interval=60, busy_timeout=5.0, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_tokens = max_tokens
+        self.max_messages = max_messages
+        self.sweep_interval = sweep_interval
+        self._clock = clock
+        self._next_sweep = 0.0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    apikey TEXT NOT NULL,
+                    messages TEXT NOT NULL DEFAULT '[]',
+                    tokens INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated);
+            """)
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(sessions)")]
+            if "version" not in columns:
+                self._db.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+        self.truncated = 0
+        self.conflicts = 0
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            return cursor.fetchall(), cursor.rowcount
+
+    def new_id(self):
+        return secrets.token_urlsafe(16)
+
+    def get(self, session_id, apikey):
+        """(history, version), or None if the session does not exist, expired or belongs to another key."""
+        rows, _ = self._execute("SELECT apikey, messages, updated, version FROM sessions WHERE id = ?",
+                                (session_id,))
+        if not rows or rows[0][0] != apikey or rows[0][2] < self._clock() - self.ttl:
+            return None
+        return json.loads(rows[0][1]), rows[0][3]
+
+    def save(self, session_id, apikey, messages, version=None):
+        """Store `messages`; `version` None creates the session. False if it changed since `version`."""
+        history, tokens = truncate(messages, self.max_tokens, self.max_messages)
+        now = self._clock()
+        encoded = json.dumps(history, ensure_ascii=False)
+        if version is None:
+            if now >= self._next_sweep:
+                self._next_sweep = now + self.sweep_interval
+                self.sweep()
+            self._execute("INSERT INTO sessions (id, apikey, messages, tokens, created, updated)"
+                          " VALUES (?, ?, ?, ?, ?, ?)", (session_id, apikey, encoded, tokens, now, now))
+            self.created += 1
+        else:
+            _, count = self._execute(
+                "UPDATE sessions SET messages = ?, tokens = ?, updated = ?, version = version + 1"
+                " WHERE id = ? AND apikey = ? AND version = ?",
+                (encoded, tokens, now, session_id, apikey, version),
+            )
+            if not count:
+                self.conflicts += 1
+                return False
+        if len(history) < len(messages):
+            self.truncated += 1
+        return True
+
+    def delete(self, session_id, apikey):
+        _, count = self._execute("DELETE FROM sessions WHERE id = ? AND apikey = ?", (session_id, apikey))
+        return count > 0
+
+    def sweep(self):
+        _, expired = self._execute("DELETE FROM sessions WHERE updated < ?", (self._clock() - self.ttl,))
+        rows, _ = self._execute("SELECT COUNT(*) FROM sessions")
+        evicted = 0
+        if rows[0][0] > self.max_sessions:
+            _, evicted = self._execute(
+                "DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY updated LIMIT ?)",
+                (rows[0][0] - self.max_sessions,),
+            )
+        self.expired += expired
+        self.evicted += evicted
+        return expired, evicted
+
+    def stats(self):
+        rows, _ = self._execute("SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM sessions")
+        return {
+            "sessions": rows[0][0],
+            "stored_tokens": rows[0][1],
+            "max_sessions": self.max_sessions,
+            "ttl": self.ttl,
+            "max_tokens": self.max_tokens,
+            "created": self.created,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "truncated": self.truncated,
+            "conflicts": self.conflicts,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,416 @@
+# Host-local shared state for running several uvicorn workers: worker slots,
+# a config-change event log, metric snapshots and a cross-process per-key limiter.
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+
+from ratelimit import RateLimited
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def file_lock(fd):
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def claim_worker_slot(state_dir, max_workers):
+    """Hold an exclusive lock on the first free worker-N.lock and return (N, fd).
+
+    The lock is released by the kernel when the process exits, so a
+    replacement worker inherits a crashed worker's slot.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    for index in range(max_workers):
+        fd = os.open(os.path.join(state_dir, f"worker-{index}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        return index, fd
+    raise RuntimeError(f"All {max_workers} worker slots in {state_dir} are taken")
+
+
+def idle_worker_slots(state_dir, max_workers):
+    """Slots whose lock nobody holds, e.g. left over from a run with more workers."""
+    idle = []
+    for index in range(max_workers):
+        path = os.path.join(state_dir, f"worker-{index}.lock")
+        if not os.path.exists(path):
+            idle.append(index)
+            continue
+        fd = os.open(path, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            idle.append(index)
+        except BlockingIOError:
+            pass
+        finally:
+            os.close(fd)
+    return idle
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ConfigBus:
+    """Append-only log of admin changes that every worker replays.
+
+    `publish()` appends an event under a file lock and bumps a sequence
+    number in a small memory-mapped file. Each worker polls that number
+    every `poll_interval` seconds (a memory read, no syscall) and, when it
+    moved, reads the new events and runs the handlers registered for their
+    type. Events from the publishing process are skipped since it already
+    applied them. A new worker replays the whole log, so runtime settings
+    survive worker restarts.
+
+    The log belongs to one `group`, by default the parent process (the
+    uvicorn supervisor), so a full restart starts from the configured
+    defaults again. Logs of groups whose process is gone are removed.
+    """
+
+    def __init__(self, state_dir, poll_interval=0.5, group=None):
+        os.makedirs(state_dir, exist_ok=True)
+        group = os.getppid() if group is None else group
+        self._remove_stale(state_dir, group)
+        self.path = os.path.join(state_dir, f"events-{group}.jsonl")
+        self.poll_interval = poll_interval
+        self._fd = os.open(os.path.join(state_dir, f"events-{group}.seq"), os.O_RDWR | os.O_CREAT, 0o644)
+        with file_lock(self._fd):
+            if os.fstat(self._fd).st_size < 8:
+                os.ftruncate(self._fd, 8)
+        self._seq = mmap.mmap(self._fd, 8)
+        self.handlers = {}
+        self._offset = 0
+        self._seen = 0
+        self._task = None
+        self.published = 0
+        self.applied = 0
+
+    def _remove_stale(self, state_dir, group):
+        for name in os.listdir(state_dir):
+            stem, ext = os.path.splitext(name)
+            if not stem.startswith("events-") or ext not in (".jsonl", ".seq"):
+                continue
+            other = stem[len("events-"):]
+            if other.isdigit() and int(other) != group and not pid_alive(int(other)):
+                try:
+                    os.remove(os.path.join(state_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def on(self, event_type, handler):
+        self.handlers[event_type] = handler
+
+    def sequence(self):
+        return struct.unpack_from("<Q", self._seq, 0)[0]
+
+    def publish(self, event_type, **data):
+        line = json.dumps({"type": event_type, "pid": os.getpid(), "data": data}, separators=(",", ":")) + "\n"
+        with file_lock(self._fd):
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+            struct.pack_into("<Q", self._seq, 0, self.sequence() + 1)
+        self.published += 1
+
+    def _read_new(self):
+        with file_lock(self._fd):
+            seq = self.sequence()
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    f.seek(self._offset)
+                    lines = f.readlines()
+                    self._offset = f.tell()
+            except FileNotFoundError:
+                lines = []
+        self._seen = seq
+        return [json.loads(line) for line in lines if line.endswith("\n")]
+
+    async def poll(self):
+        if self.sequence() == self._seen:
+            return 0
+        events = await asyncio.to_thread(self._read_new)
+        applied = 0
+        for event in events:
+            handler = self.handlers.get(event["type"])
+            if handler is None or event["pid"] == os.getpid():
+                continue
+            try:
+                result = handler(**event["data"])
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                logger.exception("Failed to apply %s event", event["type"])
+                continue
+            applied += 1
+        self.applied += applied
+        return applied
+
+    async def _run(self):
+        while True:
+            await self.poll()
+            await asyncio.sleep(self.poll_interval)
+
+    async def start(self):
+        if self._task is None:
+            await self.poll()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {"sequence": self.sequence(), "published": self.published, "applied": self.applied}
+
+
+class MetricsExchange:
+    """Per-worker metric snapshots in `state_dir`, so any worker can answer a scrape for all of them.
+
+    Every `interval` seconds the worker writes `snapshot()` (its
+    MetricSet.families()) to metrics-<slot>.json, via a temporary file and a
+    rename so readers never see half of one. `others()` returns the latest
+    snapshots of the other workers whose slot lock is still held, so a
+    worker that exited drops out of the scrape instead of freezing.
+    """
+
+    def __init__(self, state_dir, worker, snapshot, max_workers=16, interval=2.0):
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_dir = state_dir
+        self.worker = worker
+        self.snapshot = snapshot
+        self.max_workers = max_workers
+        self.interval = interval
+        self._task = None
+        self.written = 0
+
+    def _path(self, worker):
+        return os.path.join(self.state_dir, f"metrics-{worker}.json")
+
+    def _write(self, families):
+        path = self._path(self.worker)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(families, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+        self.written += 1
+
+    def others(self):
+        idle = set(idle_worker_slots(self.state_dir, self.max_workers))
+        snapshots = []
+        for worker in range(self.max_workers):
+            if worker == self.worker or worker in idle:
+                continue
+            try:
+                with open(self._path(worker), "r", encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (FileNotFoundError, ValueError):
+                continue
+        return snapshots
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self._write, self.snapshot())
+            except Exception:
+                logger.exception("Failed to write metrics snapshot")
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            try:
+                os.remove(self._path(self.worker))
+            except FileNotFoundError:
+                pass
+
+
+class _SharedLease:
+    __slots__ = ("_limiter", "_slot", "_hash")
+
+    def __init__(self, limiter, slot, key_hash):
+        self._limiter = limiter
+        self._slot = slot
+        self._hash = key_hash
+
+    def release(self):
+        if self._limiter is not None:
+            self._limiter._release(self._slot, self._hash)
+            self._limiter = None
+
+
+class SharedRateLimiter:
+    """Per-key rate and concurrency limits enforced across every worker on the host.
+
+    Same interface and rules as ratelimit.RateLimiter, but the per-key state
+    lives in a memory-mapped open-addressing table guarded by a file lock.
+    Each key's in-flight count is kept per worker slot; a worker clears its
+    own column and those of `idle_workers` on start, so requests held by a
+    crashed or retired worker do not count against the key forever.
+    """
+
+    MAGIC = b"RTRLIM02"
+    HEADER = struct.Struct("<8sII")
+    MAX_PROBE = 64
+
+    def __init__(self, state_dir, worker, max_workers=16, slots=16384, idle_workers=(), clock=time.monotonic):
+        self.worker = worker
+        self.max_workers = max_workers
+        self.slots = slots
+        self._clock = clock
+        # hash, tokens, updated, then one in-flight count per worker
+        self._entry = struct.Struct(f"<Qdd{max_workers}i")
+        self._in_flight = struct.Struct("<i")
+        self._entry_size = (self._entry.size + 63) // 64 * 64
+        self._header_size = 64
+        size = self._header_size + slots * self._entry_size
+        path = os.path.join(state_dir, "ratelimits.bin")
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with file_lock(self._fd):
+            if os.fstat(self._fd).st_size != size:
+                # New file, or one laid out for other settings: start from empty counters
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+            self._mm = mmap.mmap(self._fd, size)
+            magic, file_slots, file_workers = self.HEADER.unpack_from(self._mm, 0)
+            if magic != self.MAGIC or file_slots != slots or file_workers != max_workers:
+                self._mm[:] = bytes(size)
+                self.HEADER.pack_into(self._mm, 0, self.MAGIC, slots, max_workers)
+            for index in {worker, *idle_workers}:
+                self._clear_worker_column(index)
+        self.allowed = 0
+        self.table_full = 0
+        self.rejected = {"rate": 0, "concurrency": 0}
+
+    def _offset(self, slot):
+        return self._header_size + slot * self._entry_size
+
+    def _in_flight_offset(self, slot, worker):
+        return self._offset(slot) + 24 + 4 * worker
+
+    def _clear_worker_column(self, worker):
+        for slot in range(self.slots):
+            offset = self._in_flight_offset(slot, worker)
+            if self._mm[offset:offset + 4] != b"\0\0\0\0":
+                self._in_flight.pack_into(self._mm, offset, 0)
+
+    def _hash(self, key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") | 1
+
+    def _find(self, key_hash, capacity, now, create=True):
+        start = key_hash % self.slots
+        victim = None
+        for i in range(self.MAX_PROBE):
+            slot = (start + i) % self.slots
+            entry = self._entry.unpack_from(self._mm, self._offset(slot))
+            if entry[0] == key_hash:
+                return slot, entry
+            if entry[0] == 0:
+                victim = slot
+                break
+            # Reuse the least recently used idle slot if the probe window is full
+            if not any(entry[3:]) and (victim is None or entry[2] < victim_updated):
+                victim, victim_updated = slot, entry[2]
+        if not create or victim is None:
+            return None, None
+        entry = (key_hash, float(capacity), now) + (0,) * self.max_workers
+        self._entry.pack_into(self._mm, self._offset(victim), *entry)
+        return victim, entry
+
+    def _reject(self, reason, detail, retry_after):
+        self.rejected[reason] += 1
+        raise RateLimited(reason, detail, max(1, int(retry_after + 0.999)))
+
+    def acquire(self, key_obj):
+        rpm = key_obj.get("rate_limit_rpm")
+        max_concurrency = key_obj.get("max_concurrency")
+        if not (rpm or max_concurrency):
+            # Unlimited keys never touch the shared table
+            self.allowed += 1
+            return _SharedLease(None, None, None)
+        now = self._clock()
+        key_hash = self._hash(key_obj["key"])
+        with file_lock(self._fd):
+            slot, entry = self._find(key_hash, rpm or 0, now)
+            if slot is None:
+                # Table full of busy keys: fail open rather than refuse traffic
+                self.table_full += 1
+                self.allowed += 1
+                return _SharedLease(None, None, None)
+            _, tokens, updated = entry[:3]
+            in_flight = list(entry[3:])
+            if max_concurrency and sum(in_flight) >= max_concurrency:
+                self._reject("concurrency", "Too many concurrent requests for this API key", 1)
+            if rpm:
+                rate = rpm / 60.0
+                tokens = min(rpm, tokens + (now - updated) * rate)
+                updated = now
+                if tokens < 1:
+                    self._reject("rate", "Rate limit exceeded for this API key", (1 - tokens) / rate)
+                tokens -= 1
+            in_flight[self.worker] += 1
+            self._entry.pack_into(self._mm, self._offset(slot), key_hash, tokens, updated, *in_flight)
+        self.allowed += 1
+        return _SharedLease(self, slot, key_hash)
+
+    def _release(self, slot, key_hash):
+        offset = self._in_flight_offset(slot, self.worker)
+        with file_lock(self._fd):
+            if self._entry.unpack_from(self._mm, self._offset(slot))[0] != key_hash:
+                return
+            count = self._in_flight.unpack_from(self._mm, offset)[0]
+            if count > 0:
+                self._in_flight.pack_into(self._mm, offset, count - 1)
+
+    def forget(self, key):
+        key_hash = self._hash(key)
+        with file_lock(self._fd):
+            slot, entry = self._find(key_hash, 0, 0.0, create=False)
+            if slot is not None:
+                # Keep the hash so probe chains stay intact; reset the bucket
+                self._entry.pack_into(self._mm, self._offset(slot), key_hash, 0.0, 0.0, *entry[3:])
+
+    def usage(self, key):
+        with file_lock(self._fd):
+            _, entry = self._find(self._hash(key), 0, 0.0, create=False)
+        if entry is None:
+            return {"in_flight": 0}
+        return {"in_flight": sum(entry[3:])}
+
+    def stats(self):
+        tracked = sum(1 for slot in range(self.slots) if struct.unpack_from("<Q", self._mm, self._offset(slot))[0])
+        return {"tracked_keys": tracked, "allowed": self.allowed, "rejected": dict(self.rejected),
+                "worker": self.worker, "table_full": self.table_full}
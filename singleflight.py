@@ -0,0 +1,155 @@
+# In-flight deduplication of identical upstream calls.
+import asyncio
+
+
+class _Call:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Concurrent `do(key, fn)` calls with the same key share one `fn()` run.
+
+    The shared call runs in its own task, so one waiter being cancelled does
+    not affect the others; the task is only cancelled once every waiter has
+    gone away.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(self, key, fn):
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self._calls[key] = call
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def stats(self):
+        return {"in_flight": len(self._calls), "leaders": self.leaders, "coalesced": self.coalesced}
+
+
+_CLOSED = object()
+
+
+class _Broadcast:
+    def __init__(self, max_replay):
+        self.opened = asyncio.get_running_loop().create_future()
+        self.subscribers = set()
+        self.replay = []
+        self.max_replay = max_replay
+        self.joinable = True
+        self.task = None
+
+    def publish(self, item):
+        if self.joinable:
+            self.replay.append(item)
+            if len(self.replay) > self.max_replay:
+                self.joinable = False
+                self.replay = []
+        for queue in self.subscribers:
+            queue.put_nowait(item)
+
+
+class StreamFlight:
+    """Single-flight for streamed responses: one upstream stream, fanned out to every subscriber.
+
+    Late joiners receive the items published so far before the live ones. To
+    keep memory bounded, a flight stops accepting joiners once it has
+    published more than `max_replay` items; later identical requests start a
+    new flight.
+    """
+
+    def __init__(self, max_replay=4096):
+        self.max_replay = max_replay
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _forget(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def _pump(self, key, flight, open_fn, relay_fn):
+        try:
+            try:
+                upstream = await open_fn()
+            except asyncio.CancelledError:
+                flight.opened.cancel()
+                raise
+            except Exception as e:
+                # Subscribers get the error from `opened`; nobody awaits this task
+                flight.opened.set_exception(e)
+                return
+            flight.opened.set_result(None)
+            async for item in relay_fn(upstream):
+                flight.publish(item)
+                if not flight.joinable:
+                    self._forget(key, flight)
+        finally:
+            self._forget(key, flight)
+            flight.joinable = False
+            for queue in flight.subscribers:
+                queue.put_nowait(_CLOSED)
+
+    async def subscribe(self, key, open_fn, relay_fn):
+        """Join (or start) the flight for `key` and return an async iterator of its items.
+
+        Raises whatever `open_fn` raised if the upstream stream could not be opened.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Broadcast(self.max_replay)
+            self._flights[key] = flight
+            flight.task = asyncio.ensure_future(self._pump(key, flight, open_fn, relay_fn))
+            flight.opened.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        queue = asyncio.Queue()
+        for item in flight.replay:
+            queue.put_nowait(item)
+        flight.subscribers.add(queue)
+        try:
+            await asyncio.shield(flight.opened)
+        except BaseException:
+            self._leave(flight, queue)
+            raise
+        return self._iterate(flight, queue)
+
+    def _leave(self, flight, queue):
+        flight.subscribers.discard(queue)
+        if not flight.subscribers and not flight.task.done():
+            flight.task.cancel()
+
+    async def _iterate(self, flight, queue):
+        try:
+            while True:
+                item = await queue.get()
+                if item is _CLOSED:
+                    return
+                yield item
+        finally:
+            self._leave(flight, queue)
+
+    def stats(self):
+        return {"in_flight": len(self._flights), "leaders": self.leaders, "coalesced": self.coalesced}
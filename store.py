@@ -0,0 +1,303 @@
+# Storage backends for allowed models and API keys.
+#
+#   python store.py import [--db routerai.db] [--models allowed_models.json] [--keys api_keys.json]
+import argparse
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Columns every key record has; anything else (limits, quotas, ...) lives in attrs
+KEY_COLUMNS = ("key", "owner", "active", "note")
+
+
+def split_key_record(record):
+    base = {"key": record["key"], "owner": record.get("owner", ""),
+            "active": bool(record.get("active", True)), "note": record.get("note", "")}
+    attrs = {k: v for k, v in record.items() if k not in KEY_COLUMNS}
+    return base, attrs
+
+
+class JsonStore:
+    """The original allowed_models.json / api_keys.json files.
+
+    Writes rewrite the whole file, but atomically (temp file + rename) and
+    under an exclusive lock file, so readers never see a partial file and
+    concurrent writers, including other worker processes, do not lose
+    updates. The generation is the files' (mtime, size) stamps.
+    """
+
+    backend = "json"
+
+    def __init__(self, models_path, keys_path):
+        self.models_path = models_path
+        self.keys_path = keys_path
+        self._lock = threading.Lock()
+
+    def _read(self, path):
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _write(self, path, data):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock, open(self.keys_path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def generation(self):
+        stamp = []
+        for path in (self.models_path, self.keys_path):
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def list_models(self):
+        return self._read(self.models_path)
+
+    def add_model(self, model):
+        with self._locked():
+            models = self._read(self.models_path)
+            if model in models:
+                return None
+            models.append(model)
+            self._write(self.models_path, models)
+            return self.generation()
+
+    def remove_model(self, model):
+        with self._locked():
+            models = self._read(self.models_path)
+            if model not in models:
+                return None
+            models.remove(model)
+            self._write(self.models_path, models)
+            return self.generation()
+
+    def list_keys(self):
+        return self._read(self.keys_path)
+
+    def get_key(self, key):
+        return next((k for k in self._read(self.keys_path) if k["key"] == key), None)
+
+    def keys_by_owner(self, owner):
+        return [k for k in self._read(self.keys_path) if k.get("owner", "") == owner]
+
+    def add_key(self, record):
+        with self._locked():
+            keys = self._read(self.keys_path)
+            if any(k["key"] == record["key"] for k in keys):
+                return None
+            keys.append(record)
+            self._write(self.keys_path, keys)
+            return self.generation()
+
+    def update_key(self, key, changes):
+        """Merge `changes` into the key's record; returns (record, generation) or (None, None)."""
+        with self._locked():
+            keys = self._read(self.keys_path)
+            for k in keys:
+                if k["key"] == key:
+                    k.update(changes)
+                    self._write(self.keys_path, keys)
+                    return k, self.generation()
+            return None, None
+
+    def remove_key(self, key):
+        with self._locked():
+            keys = self._read(self.keys_path)
+            remaining = [k for k in keys if k["key"] != key]
+            if len(remaining) == len(keys):
+                return None
+            self._write(self.keys_path, remaining)
+            return self.generation()
+
+    def close(self):
+        pass
+
+
+class SqliteStore:
+    """Models and keys in a SQLite database in WAL mode.
+
+    Each admin change is a single-row statement in its own transaction, and
+    bumps a generation counter in the same transaction so other processes
+    can tell cheaply whether anything changed. Keys are indexed by key
+    (primary key) and owner; fields beyond key/owner/active/note are kept in
+    a JSON `attrs` column.
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, path, busy_timeout=5.0):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS models (model TEXT PRIMARY KEY);
+                CREATE TABLE IF NOT EXISTS api_keys (
+                    key TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL DEFAULT '',
+                    active INTEGER NOT NULL DEFAULT 1,
+                    note TEXT NOT NULL DEFAULT '',
+                    attrs TEXT NOT NULL DEFAULT '{}'
+                );
+                CREATE INDEX IF NOT EXISTS api_keys_owner ON api_keys (owner);
+                CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+                INSERT OR IGNORE INTO meta (name, value) VALUES ('generation', 0);
+            """)
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so read-modify-write cannot interleave
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _bump(self, db):
+        db.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+        return db.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()[0]
+
+    def generation(self):
+        return self._query("SELECT value FROM meta WHERE name = 'generation'")[0][0]
+
+    def is_empty(self):
+        return not self._query("SELECT 1 FROM models LIMIT 1") and not self._query("SELECT 1 FROM api_keys LIMIT 1")
+
+    def list_models(self):
+        return [row[0] for row in self._query("SELECT model FROM models ORDER BY rowid")]
+
+    def add_model(self, model):
+        with self._transaction() as db:
+            if db.execute("INSERT OR IGNORE INTO models (model) VALUES (?)", (model,)).rowcount == 0:
+                return None
+            return self._bump(db)
+
+    def remove_model(self, model):
+        with self._transaction() as db:
+            if db.execute("DELETE FROM models WHERE model = ?", (model,)).rowcount == 0:
+                return None
+            return self._bump(db)
+
+    def _record(self, row):
+        key, owner, active, note, attrs = row
+        return {"key": key, "owner": owner, "active": bool(active), "note": note, **json.loads(attrs)}
+
+    def list_keys(self):
+        return [self._record(row) for row in
+                self._query("SELECT key, owner, active, note, attrs FROM api_keys ORDER BY rowid")]
+
+    def get_key(self, key):
+        rows = self._query("SELECT key, owner, active, note, attrs FROM api_keys WHERE key = ?", (key,))
+        return self._record(rows[0]) if rows else None
+
+    def keys_by_owner(self, owner):
+        return [self._record(row) for row in
+                self._query("SELECT key, owner, active, note, attrs FROM api_keys WHERE owner = ? ORDER BY rowid",
+                            (owner,))]
+
+    def _insert_key(self, db, record, replace=False):
+        base, attrs = split_key_record(record)
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        return db.execute(
+            f"{verb} INTO api_keys (key, owner, active, note, attrs) VALUES (?, ?, ?, ?, ?)",
+            (base["key"], base["owner"], int(base["active"]), base["note"], json.dumps(attrs)),
+        ).rowcount
+
+    def add_key(self, record):
+        with self._transaction() as db:
+            if self._insert_key(db, record) == 0:
+                return None
+            return self._bump(db)
+
+    def update_key(self, key, changes):
+        """Merge `changes` into the key's record; returns (record, generation) or (None, None)."""
+        with self._transaction() as db:
+            row = db.execute("SELECT key, owner, active, note, attrs FROM api_keys WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, None
+            record = {**self._record(row), **changes, "key": key}
+            base, attrs = split_key_record(record)
+            db.execute(
+                "UPDATE api_keys SET owner = ?, active = ?, note = ?, attrs = ? WHERE key = ?",
+                (base["owner"], int(base["active"]), base["note"], json.dumps(attrs), key),
+            )
+            return record, self._bump(db)
+
+    def remove_key(self, key):
+        with self._transaction() as db:
+            if db.execute("DELETE FROM api_keys WHERE key = ?", (key,)).rowcount == 0:
+                return None
+            return self._bump(db)
+
+    def import_records(self, models, keys):
+        """Upsert models and key records in one transaction; returns the new generation."""
+        with self._transaction() as db:
+            db.executemany("INSERT OR IGNORE INTO models (model) VALUES (?)", [(m,) for m in models])
+            for record in keys:
+                self._insert_key(db, record, replace=True)
+            return self._bump(db)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def import_json(store, models_path, keys_path):
+    with open(models_path, "r") as f:
+        models = json.load(f)
+    with open(keys_path, "r") as f:
+        keys = json.load(f)
+    store.import_records(models, keys)
+    return len(models), len(keys)
+
+
+def open_store(backend, db_path, models_path, keys_path):
+    """Open the configured backend. A new, empty SQLite database is seeded from the JSON files."""
+    if backend == "json":
+        return JsonStore(models_path, keys_path)
+    if backend != "sqlite":
+        raise ValueError(f"Unknown store backend '{backend}'")
+    store = SqliteStore(db_path)
+    if store.is_empty() and os.path.exists(models_path) and os.path.exists(keys_path):
+        import_json(store, models_path, keys_path)
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="copy the JSON files into the SQLite store")
+    import_parser.add_argument("--db", default=os.getenv("STORE_PATH", "routerai.db"))
+    import_parser.add_argument("--models", default=os.getenv("MODELS_FILE", "allowed_models.json"))
+    import_parser.add_argument("--keys", default=os.getenv("API_KEYS_FILE", "api_keys.json"))
+    args = parser.parse_args()
+    store = SqliteStore(args.db)
+    n_models, n_keys = import_json(store, args.models, args.keys)
+    print(f"imported {n_models} models and {n_keys} keys into {args.db} (generation {store.generation()})")
+    store.close()
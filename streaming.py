@@ -0,0 +1,84 @@
+# Server-Sent-Events helpers for streaming upstream completions to clients.
+import json
+import time
+
+
+def sse_event(data, event=None):
+    payload = json.dumps(data, separators=(",", ":"))
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
+
+async def open_stream(client, model, messages, **params):
+    # Opened before the response starts so upstream errors still map to an HTTP status
+    return await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True},
+        **params,
+    )
+
+
+async def relay_stream(upstream, model, started=None, on_done=None, on_error=None):
+    """Forward upstream chunks as SSE `data` events, then a final `done` summary.
+
+    Nothing is buffered: each delta is yielded as soon as it arrives, so memory
+    stays flat regardless of completion length.
+    """
+    started = started if started is not None else time.perf_counter()
+    first_token_at = None
+    finish_reason = None
+    usage = None
+    chunks = 0
+    try:
+        async for chunk in upstream:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage.model_dump(exclude_none=True)
+            for choice in chunk.choices:
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+                data = {}
+                content = choice.delta.content
+                # OpenRouter streams reasoning tokens for r1-style models separately
+                reasoning = getattr(choice.delta, "reasoning", None)
+                if reasoning:
+                    data["reasoning"] = reasoning
+                if content:
+                    data["delta"] = content
+                if data:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    chunks += 1
+                    yield sse_event(data)
+    except Exception as e:
+        if on_error is not None:
+            on_error(e)
+        yield sse_event({"detail": str(e)}, event="error")
+        return
+    finally:
+        await upstream.close()
+    now = time.perf_counter()
+    summary = {
+        "model": model,
+        "finish_reason": finish_reason,
+        "usage": usage,
+        "chunks": chunks,
+        "ttft_ms": round((first_token_at - started) * 1000, 1) if first_token_at else None,
+        "latency_ms": round((now - started) * 1000, 1),
+    }
+    if on_done is not None:
+        on_done(summary)
+    yield sse_event(summary, event="done")
+
+
+async def replay_cached(value, model):
+    yield sse_event({"delta": value["response"]})
+    yield sse_event({
+        "model": value.get("model", model),
+        "finish_reason": value.get("finish_reason"),
+        "usage": value.get("usage"),
+        "chunks": 1,
+        "cached": True,
+    }, event="done")
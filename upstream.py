@@ -0,0 +1,116 @@
+# Managed OpenRouter client: tunable connection pool, pre-warming, draining and pool stats.
+import asyncio
+import logging
+
+import httpx
+import openai
+
+logger = logging.getLogger(__name__)
+
+
+def http2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class UpstreamPool:
+    """Owns the AsyncOpenAI client and the httpx connection pool under it.
+
+    The client exists from construction so it can be used without a running
+    lifespan; `start()` pre-warms `prewarm` connections and `close()` waits up
+    to `drain_timeout` seconds for in-flight requests before closing.
+    """
+
+    def __init__(self, base_url, api_key, max_connections=100, max_keepalive=20,
+                 keepalive_expiry=30.0, http2=False, connect_timeout=5.0, read_timeout=120.0,
+                 write_timeout=30.0, pool_timeout=10.0, max_retries=2, prewarm=0, drain_timeout=10.0):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(connect=connect_timeout, read=read_timeout, write=write_timeout, pool=pool_timeout)
+        if http2 and not http2_available():
+            logger.warning("UPSTREAM_HTTP2 is set but the 'h2' package is not installed; using HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self.max_retries = max_retries
+        self.prewarm = prewarm
+        self.drain_timeout = drain_timeout
+        self.prewarmed = 0
+        self._http = None
+        self.client = None
+        self._build()
+
+    def _build(self):
+        self._http = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, http2=self.http2)
+        self.client = openai.AsyncOpenAI(
+            base_url=self.base_url,
+            api_key=self.api_key,
+            http_client=self._http,
+            timeout=self.timeout,
+            max_retries=self.max_retries,
+        )
+
+    async def start(self):
+        if self._http.is_closed:
+            self._build()
+        if self.prewarm:
+            await self._prewarm()
+
+    async def _prewarm(self):
+        # Concurrent cheap requests force TCP/TLS setup for that many keep-alive connections
+        url = self.base_url.rstrip("/") + "/models"
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        results = await asyncio.gather(
+            *(self._http.get(url, headers=headers) for _ in range(self.prewarm)),
+            return_exceptions=True,
+        )
+        self.prewarmed = sum(1 for r in results if not isinstance(r, Exception))
+        if self.prewarmed < self.prewarm:
+            logger.warning("Pre-warmed %d of %d upstream connections", self.prewarmed, self.prewarm)
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.drain_timeout
+        while self.stats()["requests_active"] and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        await self.client.close()
+
+    def _pool(self):
+        transport = getattr(self._http, "_transport", None)
+        return getattr(transport, "_pool", None)
+
+    def stats(self):
+        stats = {
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive": self.limits.max_keepalive_connections,
+            "prewarmed": self.prewarmed,
+            "connections": 0,
+            "in_use": 0,
+            "idle": 0,
+            "requests_active": 0,
+            "waiters": 0,
+        }
+        # httpcore does not expose pool occupancy publicly; read it defensively
+        pool = self._pool()
+        if pool is None:
+            return stats
+        connections = list(getattr(pool, "connections", []))
+        idle = sum(1 for c in connections if c.is_idle())
+        requests = list(getattr(pool, "_requests", []))
+        queued = sum(1 for r in requests if r.is_queued())
+        stats.update({
+            "connections": len(connections),
+            "in_use": len(connections) - idle,
+            "idle": idle,
+            "requests_active": len(requests) - queued,
+            "waiters": queued,
+        })
+        return stats
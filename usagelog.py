@@ -0,0 +1,178 @@
+# Background, batched writer for the per-request usage log (JSON lines).
+import asyncio
+import fcntl
+import gzip
+import json
+import os
+import shutil
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class UsageLogWriter:
+    """Buffers usage records in memory and appends them from a background task.
+
+    `log()` never blocks: past `high_water` queued records only one in
+    `sample_every` is kept, and once `max_queue` is reached records are
+    dropped. Both are counted. Batches are written off the event loop, and the
+    file is rotated (then gzip-compressed) when it exceeds `max_bytes` or the
+    UTC date changes. With `lock_path` set, writes, rotations and `flush()`
+    callbacks hold an exclusive lock on that file, so several worker
+    processes can share one log.
+    """
+
+    def __init__(self, path, batch_size=500, flush_interval=1.0, max_queue=50000,
+                 high_water=0.5, sample_every=10, max_bytes=64 * 1024 * 1024, lock_path=None):
+        self.path = path
+        self.lock_path = lock_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.high_water = int(max_queue * high_water)
+        self.sample_every = max(1, sample_every)
+        self.max_bytes = max_bytes
+        self.before_rotate = []
+        self._queue = deque()
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = None
+        self._stopping = False
+        self._task = None
+        self._seen_over_high_water = 0
+        self._file_day = None
+        self._file_ino = None
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.batches = 0
+        self.rotations = 0
+        self.errors = 0
+
+    def log(self, record):
+        size = len(self._queue)
+        if size >= self.max_queue:
+            self.dropped += 1
+            return
+        if size >= self.high_water:
+            self._seen_over_high_water += 1
+            if self._seen_over_high_water % self.sample_every:
+                self.sampled_out += 1
+                return
+        self._queue.append(record)
+        if self._wakeup is not None and len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    async def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # Let the writer finish its current batch and drain the queue
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    async def flush(self, then=None):
+        """Write out queued records, then run `then()` in a thread before another flush can start.
+
+        Rotation only happens inside a flush, so `then` never races with it.
+        """
+        await self._flush_all(then)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._flush_all()
+        await self._flush_all()
+
+    async def _flush_all(self, then=None):
+        # Serialises the background flush with explicit flush() calls
+        async with self._flush_lock:
+            while self._queue:
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                lines = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in batch)
+                try:
+                    await asyncio.to_thread(self._write, lines)
+                except OSError:
+                    self.errors += 1
+                    self.dropped += len(batch)
+                    continue
+                self.written += len(batch)
+                self.batches += 1
+            self._seen_over_high_water = 0
+            if then is not None:
+                return await asyncio.to_thread(self._locked_call, then)
+
+    @contextmanager
+    def _process_lock(self):
+        if not self.lock_path:
+            yield
+            return
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _locked_call(self, fn):
+        with self._process_lock():
+            return fn()
+
+    def _utc_day(self, ts):
+        return time.strftime("%Y%m%d", time.gmtime(ts))
+
+    def _write(self, lines):
+        with self._process_lock():
+            today = self._utc_day(time.time())
+            try:
+                st = os.stat(self.path)
+                size = st.st_size
+            except FileNotFoundError:
+                st, size = None, 0
+            if st is not None and st.st_ino != self._file_ino:
+                # First write, or another process rotated the file since ours
+                self._file_day = self._utc_day(st.st_mtime)
+            if size and (size + len(lines) > self.max_bytes or self._file_day != today):
+                self._rotate()
+            self._file_day = today
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+                self._file_ino = os.fstat(f.fileno()).st_ino
+
+    def _rotate(self):
+        for hook in self.before_rotate:
+            hook(self.path)
+        base, ext = os.path.splitext(self.path)
+        stem = f"{base}-{self._file_day}-{time.strftime('%H%M%S', time.gmtime())}"
+        rotated = stem + ext
+        suffix = 0
+        while os.path.exists(rotated + ".gz"):
+            suffix += 1
+            rotated = f"{stem}-{suffix}{ext}"
+        os.replace(self.path, rotated)
+        with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(rotated)
+        self.rotations += 1
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "queued": len(self._queue),
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "batches": self.batches,
+            "rotations": self.rotations,
+            "errors": self.errors,
+        }